@@ -0,0 +1,298 @@
+"""
+Write-behind cart buffering (settings.CART_WRITE_BEHIND).
+
+Cart mutations for logged-in users go to a Redis hash per user
+(cart:buf:<user_id>, product_id -> quantity, 0 = remove) instead of the
+cart_cartitem table, and the user is added to a "dirty" set. Intermediate
+quantities from rapid clicks only ever overwrite the hash.
+
+flush_buffers() (Celery beat, see cart.tasks) drains the dirty set in
+batches: one bulk upsert and one delete per batch. Checkout and
+get_user_cart() flush the user's buffer synchronously first. Reads overlay
+the buffer on the CartItem rows, so they always see the merged state.
+
+Flushes and clear() take a per-user advisory lock, so a flush can't write
+back a cart that was just emptied. A flushed field is removed from the hash
+only once the write has committed the value that was written, so neither a click that lands
+during a flush nor a rolled-back checkout loses anything.
+"""
+
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+import redis
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import OuterRef, Q, Subquery
+
+from products.ledger import live_available, with_live_stock
+from products.models import Product
+from .models import CartItem
+from .services import CartService, CartSnapshot, LineUpdate, plan_operations, with_live_products
+
+KEY_PREFIX = 'cart:buf:'
+DIRTY_KEY = f'{KEY_PREFIX}dirty'
+FLUSH_BATCH = 500
+# Advisory lock namespace for per-user flush/clear locks
+CART_LOCK_NAMESPACE = 7_302
+# A cleared cart's buffer is dropped on commit; until then flushes skip it
+CLEAR_MARKER_TTL = 30
+
+# KEYS: hash, dirty set. ARGV: product_id, quantity in CartItem (-1 = no
+# row), mode ('add' | 'change' | 'set'), value, available, user_id.
+# Returns the new quantity, or -1 if change/set found no line.
+MUTATE_LUA = """
+local cur = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or ARGV[2])
+if cur <= 0 and ARGV[3] ~= 'add' then return -1 end
+if cur < 0 then cur = 0 end
+local q = tonumber(ARGV[4])
+if ARGV[3] ~= 'set' then q = cur + q end
+q = math.max(0, math.min(q, tonumber(ARGV[5])))
+if ARGV[3] == 'add' and q == 0 then return 0 end
+redis.call('HSET', KEYS[1], ARGV[1], q)
+redis.call('SADD', KEYS[2], ARGV[6])
+return q
+"""
+
+# KEYS: hash, dirty set. ARGV: user_id, then product_id/quantity pairs that
+# were written to CartItem. Drops the pairs that haven't changed since, and
+# the user's dirty entry once nothing is left to flush.
+RELEASE_LUA = """
+for i = 2, #ARGV, 2 do
+  if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+    redis.call('HDEL', KEYS[1], ARGV[i])
+  end
+end
+if redis.call('HLEN', KEYS[1]) > 0 then
+  redis.call('SADD', KEYS[2], ARGV[1])
+else
+  redis.call('SREM', KEYS[2], ARGV[1])
+end
+"""
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.CART_BUFFER_REDIS_URL, decode_responses=True)
+    return _client
+
+
+def _buffer_key(user_id):
+    return f'{KEY_PREFIX}{user_id}'
+
+
+def _cleared_key(user_id):
+    return f'{KEY_PREFIX}cleared:{user_id}'
+
+
+def _lock_users(user_ids):
+    """Per-user locks (released at commit) that serialize flushes and clears."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, (u %% 2147483647)::integer) FROM unnest(%s::bigint[]) AS u ORDER BY u",
+            [CART_LOCK_NAMESPACE, sorted(user_ids)],
+        )
+
+
+def read_buffer(user_id):
+    return {int(k): int(v) for k, v in get_redis().hgetall(_buffer_key(user_id)).items()}
+
+
+class BufferedCartService(CartService):
+    """CartService whose mutations land in Redis; see the module docstring."""
+
+    def _buffer(self):
+        return read_buffer(self.user.pk)
+
+    # ----- Reads: CartItem rows with the buffer on top -----
+
+    def snapshot(self):
+        buffered = self._buffer()
+        if not buffered:
+            return super().snapshot()
+
+        lines = {item.product_id: item for item in with_live_products(self.lines())}
+        new_ids = [pid for pid, q in buffered.items() if q > 0 and pid not in lines]
+        for product in with_live_stock(Product.objects.all()).in_bulk(new_ids).values() if new_ids else ():
+            lines[product.id] = CartItem(user=self.user, product=product, quantity=0)
+
+        merged = []
+        for product_id, item in lines.items():
+            quantity = buffered.get(product_id, item.quantity)
+            if quantity <= 0:
+                continue
+            item.quantity = quantity
+            item.line_total = item.product.price * quantity
+            merged.append(item)
+        total = sum((item.line_total for item in merged), Decimal('0.00'))
+        return CartSnapshot(merged, total, sum(item.quantity for item in merged))
+
+    def total(self):
+        return self.snapshot().total
+
+    def summary(self):
+        if not get_redis().exists(_buffer_key(self.user.pk)):
+            return super().summary()
+        return self.snapshot().summary()
+
+    # ----- Mutations: one product read, one Redis script -----
+
+    def _mutate(self, product_id, mode, value):
+        row = (
+            Product.objects.filter(id=product_id)
+            .annotate(
+                available_now=live_available(),
+                in_cart=Subquery(
+                    CartItem.objects.filter(user=self.user, product=OuterRef('pk')).values('quantity')[:1]
+                ),
+            )
+            .values_list('name', 'price', 'available_now', 'in_cart')
+            .first()
+        )
+        if row is None:
+            return None
+        name, price, available, in_cart = row
+
+        script = get_redis().register_script(MUTATE_LUA)
+        quantity = script(
+            keys=[_buffer_key(self.user.pk), DIRTY_KEY],
+            args=[product_id, -1 if in_cart is None else in_cart, mode, value, available, self.user.pk],
+        )
+        if quantity < 0:
+            return None
+        return LineUpdate(name, quantity, price * quantity)
+
+    def add(self, product_id, quantity=1):
+        return self._mutate(product_id, 'add', quantity)
+
+    def change(self, product_id, delta):
+        return self._mutate(product_id, 'change', delta)
+
+    def set_quantity(self, product_id, quantity):
+        return self._mutate(product_id, 'set', quantity)
+
+    def apply(self, operations):
+        product_ids = {op['product_id'] for op in operations}
+        current = dict(
+            CartItem.objects.filter(user=self.user, product_id__in=product_ids)
+            .values_list('product_id', 'quantity')
+        )
+        current.update({pid: q for pid, q in self._buffer().items() if pid in product_ids})
+        available = dict(Product.objects.filter(id__in=product_ids).values_list('id', live_available()))
+
+        targets, adjusted, unknown = plan_operations(operations, current, available)
+        if targets:
+            pipe = get_redis().pipeline()
+            pipe.hset(_buffer_key(self.user.pk), mapping=targets)
+            pipe.sadd(DIRTY_KEY, self.user.pk)
+            pipe.execute()
+        return self.snapshot(), adjusted, unknown
+
+    def flush(self):
+        flush_users([self.user.pk])
+
+    def clear(self):
+        # Rows first, under the user's lock; a flush that read the buffer
+        # before us has committed by then, one that comes after sees the
+        # marker. The buffer itself goes once the clear has committed.
+        user_id = self.user.pk
+        with transaction.atomic():
+            _lock_users([user_id])
+            get_redis().set(_cleared_key(user_id), 1, ex=CLEAR_MARKER_TTL)
+            super().clear()
+            transaction.on_commit(lambda: _drop_buffer(user_id))
+
+    def merge(self, quantities):
+        self.flush()
+        super().merge(quantities)
+
+
+def _write(buffers):
+    """One bulk upsert + one delete for {user_id: {product_id: quantity}}."""
+    product_ids = {pid for buffered in buffers.values() for pid in buffered}
+    existing = set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True))
+
+    upserts, removals = [], []
+    for user_id, buffered in buffers.items():
+        for product_id, quantity in buffered.items():
+            if quantity > 0 and product_id in existing:
+                upserts.append(CartItem(user_id=user_id, product_id=product_id, quantity=quantity))
+            else:
+                removals.append(Q(user_id=user_id, product_id=product_id))
+
+    with transaction.atomic():
+        if upserts:
+            CartItem.objects.bulk_create(
+                upserts,
+                update_conflicts=True,
+                unique_fields=['user', 'product'],
+                update_fields=['quantity', 'updated_at'],
+            )
+        if removals:
+            CartItem.objects.filter(reduce(or_, removals)).delete()
+
+
+def _release(buffers):
+    """Drops what was written from Redis; runs once the write has committed."""
+    client = get_redis()
+    release = client.register_script(RELEASE_LUA)
+    pipe = client.pipeline()
+    for user_id, buffered in buffers.items():
+        args = [user_id]
+        for product_id, quantity in buffered.items():
+            args += [product_id, quantity]
+        release(keys=[_buffer_key(user_id), DIRTY_KEY], args=args, client=pipe)
+    pipe.execute()
+
+
+def _drop_buffer(user_id):
+    pipe = get_redis().pipeline()
+    pipe.delete(_buffer_key(user_id), _cleared_key(user_id))
+    pipe.srem(DIRTY_KEY, user_id)
+    pipe.execute()
+
+
+def flush_users(user_ids):
+    """
+    Writes the given users' buffers to CartItem. Returns lines written.
+    Inside a transaction (checkout) the buffer is only released once it
+    commits, so a rollback leaves the changes buffered. Users whose cart is
+    being cleared are skipped.
+    """
+    user_ids = [int(user_id) for user_id in user_ids]
+    client = get_redis()
+    with transaction.atomic():
+        _lock_users(user_ids)
+        pipe = client.pipeline()
+        for user_id in user_ids:
+            pipe.hgetall(_buffer_key(user_id))
+            pipe.exists(_cleared_key(user_id))
+        results = pipe.execute()
+        buffers = {
+            user_id: {int(k): int(v) for k, v in buffered.items()}
+            for user_id, buffered, cleared in zip(user_ids, results[::2], results[1::2])
+            if not cleared
+        }
+        if not buffers:
+            return 0
+
+        _write({user_id: buffered for user_id, buffered in buffers.items() if buffered})
+        # Empty buffers are released too, which clears their dirty entries
+        transaction.on_commit(lambda: _release(buffers))
+    return sum(len(buffered) for buffered in buffers.values())
+
+
+def flush_buffers(batch_size=FLUSH_BATCH):
+    """
+    Drains up to batch_size dirty users. Returns (users, lines) flushed.
+    Users stay in the dirty set until their release, so a failed write is
+    simply picked up again.
+    """
+    user_ids = get_redis().srandmember(DIRTY_KEY, batch_size)
+    if not user_ids:
+        return 0, 0
+    return len(user_ids), flush_users(user_ids)
@@ -1,8 +1,4 @@
-from .models import CartItem
+from .utils import get_cart_count
 
 def cart_count(request):
-    if request.user.is_authenticated:
-        count = sum(item.quantity for item in CartItem.objects.filter(user=request.user))
-    else:
-        count = 0
-    return {'cart_count': count}
+    return {'cart_count': get_cart_count(request)}
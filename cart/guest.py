@@ -0,0 +1,156 @@
+"""
+Cart for visitors who aren't logged in.
+
+The lines live in a signed cookie (settings.CART_SESSION_ID) as
+{product_id: quantity}, so carting as a guest costs no database writes;
+reads fetch the products in one query. GuestCart has the same interface as
+CartService, and cart.utils.get_cart(request) picks the right one.
+GuestCartMiddleware writes the cookie back when the cart changed. On login
+the lines are merged into CartItem with one upsert (see cart.signals).
+"""
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core import signing
+
+from products.ledger import with_live_stock
+from products.models import Product
+from .models import CartItem
+from .services import CartSnapshot, LineUpdate, cart_for, plan_operations
+
+COOKIE_SALT = 'cart.guest'
+COOKIE_MAX_AGE = 60 * 60 * 24 * 30
+# Keeps the cookie well under the 4 KB browser limit
+MAX_LINES = 50
+
+
+class GuestCart:
+
+    def __init__(self, request):
+        self.request = request
+        self.modified = False
+        self.quantities = self._load()
+
+    def _load(self):
+        data = self.request.COOKIES.get(settings.CART_SESSION_ID)
+        if not data:
+            return {}
+        try:
+            lines = signing.loads(data, salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+            return {int(k): int(v) for k, v in lines.items() if int(v) > 0}
+        except (signing.BadSignature, ValueError, TypeError, AttributeError):
+            return {}
+
+    def write(self, response):
+        if not self.quantities:
+            response.delete_cookie(settings.CART_SESSION_ID)
+            return
+        value = signing.dumps({str(k): v for k, v in self.quantities.items()}, salt=COOKIE_SALT, compress=True)
+        response.set_cookie(
+            settings.CART_SESSION_ID, value, max_age=COOKIE_MAX_AGE,
+            httponly=True, samesite='Lax', secure=self.request.is_secure(),
+        )
+
+    def clear(self):
+        if self.quantities:
+            self.quantities = {}
+            self.modified = True
+
+    @property
+    def quantity(self):
+        """Item count for the navbar; no query."""
+        return sum(self.quantities.values())
+
+    def version(self):
+        """Cart part of the ETag for guests (see core.utils.http)."""
+        return ','.join(f'{k}x{v}' for k, v in sorted(self.quantities.items()))
+
+    def _products(self, product_ids):
+        return with_live_stock(Product.objects.all()).in_bulk(product_ids)
+
+    def _snapshot(self, products):
+        lines = []
+        for product_id, quantity in self.quantities.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            item = CartItem(product=product, quantity=quantity)
+            item.line_total = product.price * quantity
+            lines.append(item)
+        total = sum((item.line_total for item in lines), Decimal('0.00'))
+        return CartSnapshot(lines, total, sum(item.quantity for item in lines))
+
+    def _store(self, product_id, quantity):
+        if quantity > 0:
+            if product_id not in self.quantities and len(self.quantities) >= MAX_LINES:
+                return self.quantities.get(product_id, 0)
+            self.quantities[product_id] = quantity
+        else:
+            self.quantities.pop(product_id, None)
+        self.modified = True
+        return quantity
+
+    def _line(self, product, quantity):
+        return LineUpdate(product.name, quantity, product.price * quantity)
+
+    # ----- Same interface as CartService -----
+
+    def snapshot(self):
+        return self._snapshot(self._products(list(self.quantities)))
+
+    def total(self):
+        return self.snapshot().total
+
+    def add(self, product_id, quantity=1):
+        product = self._products([product_id]).get(product_id)
+        if product is None:
+            return None
+        if product.live_available <= 0:
+            return self._line(product, 0)
+        target = min(self.quantities.get(product_id, 0) + quantity, product.live_available)
+        return self._line(product, self._store(product_id, target))
+
+    def change(self, product_id, delta):
+        if product_id not in self.quantities:
+            return None
+        return self.set_quantity(product_id, self.quantities[product_id] + delta)
+
+    def set_quantity(self, product_id, quantity):
+        if product_id not in self.quantities:
+            return None
+        product = self._products([product_id]).get(product_id)
+        if product is None:
+            self._store(product_id, 0)
+            return None
+        target = max(min(quantity, product.live_available), 0)
+        return self._line(product, self._store(product_id, target))
+
+    def apply(self, operations):
+        product_ids = set(self.quantities) | {op['product_id'] for op in operations}
+        products = self._products(list(product_ids))
+        available = {product_id: p.live_available for product_id, p in products.items()}
+
+        targets, adjusted, unknown = plan_operations(operations, self.quantities, available)
+        for product_id, quantity in targets.items():
+            self._store(product_id, quantity)
+        return self._snapshot(products), adjusted, unknown
+
+
+def get_guest_cart(request):
+    # One instance per request, so the middleware sees the changes
+    if not hasattr(request, '_guest_cart'):
+        request._guest_cart = GuestCart(request)
+    return request._guest_cart
+
+
+def merge_guest_cart(request, user):
+    """Moves the guest cart into user's CartItem rows; called on login."""
+    from .utils import update_cart_summary
+
+    guest = get_guest_cart(request)
+    if not guest.quantities:
+        return
+    cart_for(user).merge(guest.quantities)
+    update_cart_summary(user)
+    guest.clear()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from cart.buffer import FLUSH_BATCH, flush_buffers
+
+
+class Command(BaseCommand):
+    help = "Writes all write-behind cart buffers from Redis to CartItem"
+
+    def handle(self, *args, **options):
+        total_users = total_lines = 0
+        while True:
+            users, lines = flush_buffers()
+            total_users += users
+            total_lines += lines
+            if users < FLUSH_BATCH:
+                break
+        self.stdout.write(f"✅ Flushed {total_lines} cart line(s) for {total_users} user(s)")
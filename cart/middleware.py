@@ -0,0 +1,12 @@
+class GuestCartMiddleware:
+    """Saves the guest cart cookie when a view changed it (see cart.guest)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        guest = getattr(request, '_guest_cart', None)
+        if guest is not None and guest.modified:
+            guest.write(response)
+        return response
@@ -6,6 +6,7 @@ class CartItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('user', 'product')
@@ -15,4 +16,7 @@ class CartItem(models.Model):
 
     @property
     def total_price(self):
+        # Annotated by cart.services.CartService; avoids touching self.product
+        if hasattr(self, 'line_total'):
+            return self.line_total
         return self.product.price * self.quantity
@@ -0,0 +1,298 @@
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum, Window
+
+from products.ledger import live_available, live_available_sql
+from products.models import Product
+from .models import CartItem
+
+LINE_TOTAL = ExpressionWrapper(
+    F('quantity') * F('product__price'),
+    output_field=DecimalField(max_digits=12, decimal_places=2),
+)
+
+
+def cart_for(user):
+    """The user's cart service; Redis-buffered when CART_WRITE_BEHIND is on."""
+    if settings.CART_WRITE_BEHIND:
+        from .buffer import BufferedCartService
+        return BufferedCartService(user)
+    return CartService(user)
+
+
+# Result of a single-line mutation; quantity 0 means the line is gone
+LineUpdate = namedtuple('LineUpdate', 'name quantity line_total')
+
+CART_TABLE = CartItem._meta.db_table
+PRODUCT_TABLE = Product._meta.db_table
+
+# Live stock - allocated (snapshot + pending ledger movements, see products.ledger)
+P_AVAILABLE = live_available_sql('p')
+EXCLUDED_AVAILABLE = (
+    f"(SELECT {live_available_sql('pp')} FROM {PRODUCT_TABLE} pp WHERE pp.id = EXCLUDED.product_id)"
+)
+
+# Upsert clamped to what can still be sold (stock - allocated). Nothing is
+# inserted for a sold-out product; the outer join still returns its name.
+ADD_SQL = f"""
+WITH p AS (
+    SELECT id, name, price, GREATEST({P_AVAILABLE}, 0) AS available
+    FROM {PRODUCT_TABLE} p WHERE id = %(product)s
+),
+line AS (
+    INSERT INTO {CART_TABLE} AS c (user_id, product_id, quantity, updated_at)
+    SELECT %(user)s, p.id, LEAST(%(delta)s, p.available), now() FROM p WHERE p.available > 0
+    ON CONFLICT (user_id, product_id) DO UPDATE SET
+        quantity = LEAST(c.quantity + %(delta)s, GREATEST({EXCLUDED_AVAILABLE}, 0)),
+        updated_at = now()
+    RETURNING quantity
+)
+SELECT p.name, COALESCE(line.quantity, 0), COALESCE(line.quantity * p.price, 0)
+FROM p LEFT JOIN line ON true
+"""
+
+# Change an existing line to LEAST(target, stock - allocated); the line is
+# deleted instead when that comes to zero. The two branches never match the
+# same row, and READ COMMITTED re-checks them if a concurrent click got there
+# first.
+CHANGE_SQL = f"""
+WITH removed AS (
+    DELETE FROM {CART_TABLE} c USING {PRODUCT_TABLE} p
+    WHERE c.user_id = %(user)s AND c.product_id = %(product)s AND p.id = c.product_id
+      AND LEAST({{target}}, {P_AVAILABLE}) <= 0
+    RETURNING p.name
+),
+changed AS (
+    UPDATE {CART_TABLE} c SET quantity = LEAST({{target}}, {P_AVAILABLE}), updated_at = now()
+    FROM {PRODUCT_TABLE} p
+    WHERE c.user_id = %(user)s AND c.product_id = %(product)s AND p.id = c.product_id
+      AND LEAST({{target}}, {P_AVAILABLE}) > 0
+    RETURNING p.name, c.quantity, c.quantity * p.price
+)
+SELECT name, quantity, line_total FROM changed AS t(name, quantity, line_total)
+UNION ALL
+SELECT name, 0, 0 FROM removed
+"""
+
+
+# Inserts/raises lines to the sum of both carts, clamped to stock - allocated
+MERGE_SQL = f"""
+INSERT INTO {CART_TABLE} AS c (user_id, product_id, quantity, updated_at)
+SELECT %(user)s, p.id, LEAST(v.quantity, {P_AVAILABLE}), now()
+FROM unnest(%(products)s::bigint[], %(quantities)s::integer[]) AS v(product_id, quantity)
+JOIN {PRODUCT_TABLE} p ON p.id = v.product_id
+WHERE {P_AVAILABLE} > 0
+ON CONFLICT (user_id, product_id) DO UPDATE SET
+    quantity = LEAST(c.quantity + EXCLUDED.quantity, GREATEST({EXCLUDED_AVAILABLE}, 0)),
+    updated_at = now()
+"""
+
+
+def plan_operations(operations, current, available):
+    """
+    Folds batch operations over the current {product_id: quantity} and clamps
+    the results to {product_id: available}. Returns (targets, adjusted,
+    unknown); a target of 0 means remove the line.
+    """
+    wanted = {}
+    for op in operations:
+        product_id = op['product_id']
+        quantity = wanted.get(product_id, current.get(product_id, 0))
+        if 'quantity' in op:
+            quantity = op['quantity']
+        else:
+            quantity += op['delta']
+        wanted[product_id] = max(quantity, 0)
+
+    targets, adjusted, unknown = {}, [], []
+    for product_id, quantity in wanted.items():
+        if product_id not in available:
+            unknown.append(product_id)
+            continue
+        targets[product_id] = min(quantity, available[product_id])
+        if targets[product_id] != quantity:
+            adjusted.append(product_id)
+    return targets, adjusted, unknown
+
+
+def with_live_products(lines):
+    """
+    Evaluates lines() and hands each product its annotated live stock, which
+    Product.available then reads instead of the compacted snapshot.
+    """
+    lines = list(lines)
+    for item in lines:
+        item.product.live_available = item.product_live_available
+    return lines
+
+
+class CartSnapshot:
+    """Cart lines (CartItem with product + line_total) and their totals."""
+
+    def __init__(self, lines, total, quantity):
+        self.lines = lines
+        self.total = total
+        self.quantity = quantity
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def line(self, product_id):
+        for item in self.lines:
+            if item.product_id == product_id:
+                return item
+        return None
+
+    def summary(self):
+        return {'items': len(self.lines), 'quantity': self.quantity, 'total': self.total}
+
+    def as_json(self):
+        return {
+            'items': [
+                {
+                    'product_id': item.product_id,
+                    'name': item.product.name,
+                    'price': float(item.product.price),
+                    'quantity': item.quantity,
+                    'available': item.product.available,
+                    'item_total': float(item.line_total),
+                }
+                for item in self.lines
+            ],
+            'cart_quantity': self.quantity,
+            'cart_total': float(self.total),
+        }
+
+
+class CartService:
+    """
+    Cart reads for views and checkout. Lines, per-line totals and cart
+    totals come from one joined query (window sums over the user's lines),
+    so the cost doesn't grow with the number of lines.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def lines(self):
+        return (
+            CartItem.objects.filter(user=self.user)
+            .select_related('product')
+            .annotate(
+                line_total=LINE_TOTAL,
+                cart_total=Window(Sum(LINE_TOTAL)),
+                cart_quantity=Window(Sum('quantity')),
+                product_live_available=live_available('product__'),
+            )
+            .order_by('id')
+        )
+
+    def snapshot(self):
+        lines = with_live_products(self.lines())
+        if not lines:
+            return CartSnapshot([], Decimal('0.00'), 0)
+        return CartSnapshot(lines, lines[0].cart_total, lines[0].cart_quantity)
+
+    def total(self):
+        """Cart total only; single aggregate query."""
+        total = CartItem.objects.filter(user=self.user).aggregate(total=Sum(LINE_TOTAL))['total']
+        return total or Decimal('0.00')
+
+    def summary(self):
+        """{'items', 'quantity', 'total'} in one aggregate query."""
+        v = CartItem.objects.filter(user=self.user).aggregate(
+            items=Count('id'), quantity=Sum('quantity'), total=Sum(LINE_TOTAL),
+        )
+        return {'items': v['items'], 'quantity': v['quantity'] or 0, 'total': v['total'] or Decimal('0.00')}
+
+    def flush(self):
+        """Writes buffered changes to CartItem; nothing to do without write-behind."""
+
+    def clear(self):
+        CartItem.objects.filter(user=self.user).delete()
+
+    # ----- Mutations: one statement each, safe against concurrent clicks -----
+
+    def _execute(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'user': self.user.pk, **params})
+            row = cursor.fetchone()
+        return LineUpdate(*row) if row else None
+
+    def add(self, product_id, quantity=1):
+        """
+        Adds quantity of a product (creating the line), clamped to what's
+        available. None if the product doesn't exist; quantity 0 if it is
+        sold out.
+        """
+        return self._execute(ADD_SQL, {'product': product_id, 'delta': quantity})
+
+    def change(self, product_id, delta):
+        """Moves an existing line by delta. None if the product isn't in the cart."""
+        sql = CHANGE_SQL.format(target='c.quantity + %(delta)s')
+        return self._execute(sql, {'product': product_id, 'delta': delta})
+
+    def set_quantity(self, product_id, quantity):
+        """Sets an existing line to quantity. None if the product isn't in the cart."""
+        sql = CHANGE_SQL.format(target='%(quantity)s')
+        return self._execute(sql, {'product': product_id, 'quantity': quantity})
+
+    def apply(self, operations):
+        """
+        Applies a batch of edits in one transaction:
+        [{'product_id': 3, 'delta': 2}, {'product_id': 5, 'quantity': 0}, ...]
+
+        Operations on the same product are applied in order. Stock is checked
+        once for all products, targets are clamped to stock - allocated and
+        written with one upsert plus one delete, whatever the batch size.
+        Returns (snapshot, adjusted product ids, unknown product ids).
+        """
+        product_ids = {op['product_id'] for op in operations}
+        with transaction.atomic():
+            current = dict(
+                CartItem.objects.select_for_update()
+                .filter(user=self.user, product_id__in=product_ids)
+                .values_list('product_id', 'quantity')
+            )
+            available = dict(
+                Product.objects.filter(id__in=product_ids).values_list('id', live_available())
+            )
+
+            targets, adjusted, unknown = plan_operations(operations, current, available)
+            upserts = [
+                CartItem(user=self.user, product_id=product_id, quantity=quantity)
+                for product_id, quantity in targets.items() if quantity > 0
+            ]
+            deletes = [
+                product_id for product_id, quantity in targets.items()
+                if quantity == 0 and product_id in current
+            ]
+
+            if upserts:
+                CartItem.objects.bulk_create(
+                    upserts,
+                    update_conflicts=True,
+                    unique_fields=['user', 'product'],
+                    update_fields=['quantity', 'updated_at'],
+                )
+            if deletes:
+                CartItem.objects.filter(user=self.user, product_id__in=deletes).delete()
+
+            return self.snapshot(), adjusted, unknown
+
+    def merge(self, quantities):
+        """Adds a guest cart {product_id: quantity} to this user's cart in one upsert."""
+        if not quantities:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(MERGE_SQL, {
+                'user': self.user.pk,
+                'products': list(quantities),
+                'quantities': list(quantities.values()),
+            })
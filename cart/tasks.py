@@ -0,0 +1,20 @@
+from celery import shared_task
+from django.conf import settings
+
+from .buffer import FLUSH_BATCH, flush_buffers
+
+
+@shared_task
+def flush_cart_buffers_task(max_batches=20):
+    """Drains buffered cart changes into CartItem (CART_WRITE_BEHIND only)."""
+    if not settings.CART_WRITE_BEHIND:
+        return
+    total_users = total_lines = 0
+    for _ in range(max_batches):
+        users, lines = flush_buffers()
+        total_users += users
+        total_lines += lines
+        if users < FLUSH_BATCH:
+            break
+    if total_users:
+        print(f"✅ Flushed {total_lines} buffered cart line(s) for {total_users} user(s)")
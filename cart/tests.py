@@ -1,3 +1,344 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import SkipTest, mock
 
-# Create your tests here.
+import redis
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from products.models import InventoryMovement, Product
+from .models import CartItem
+from .services import CartService, cart_for
+from . import buffer
+from . import utils as cart_utils
+from .utils import get_cart_summary, get_user_cart_total
+
+User = get_user_model()
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CartQueryCountTests(TestCase):
+    """Cart reads must cost the same number of queries for 1 line or many."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.small = User.objects.create_user('small', email='small@example.com', password='pw')
+        cls.large = User.objects.create_user('large', email='large@example.com', password='pw')
+        products = [
+            Product.objects.create(name=f'Product {i}', description='', price=Decimal('10.50'), stock=100)
+            for i in range(5)
+        ]
+        CartItem.objects.create(user=cls.small, product=products[0], quantity=2)
+        for i, product in enumerate(products, start=1):
+            CartItem.objects.create(user=cls.large, product=product, quantity=i)
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def test_snapshot_is_one_query(self):
+        for user in (self.small, self.large):
+            self.assertEqual(self.count_queries(lambda: CartService(user).snapshot()), 1)
+
+    def test_snapshot_totals(self):
+        cart = CartService(self.large).snapshot()
+        self.assertEqual(len(cart), 5)
+        self.assertEqual(cart.quantity, 15)
+        self.assertEqual(cart.total, Decimal('157.50'))
+        self.assertEqual(cart.line(cart.lines[1].product_id).line_total, Decimal('21.00'))
+        with self.assertNumQueries(0):
+            [item.product.name for item in cart]
+
+    def test_snapshot_reads_live_stock(self):
+        product = CartItem.objects.filter(user=self.small).get().product
+        InventoryMovement.objects.create(
+            product=product, reason=InventoryMovement.RESERVE, stock_delta=0, allocated_delta=30,
+        )
+        cart = CartService(self.small).snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.lines[0].product.available, 70)
+
+    def test_empty_snapshot(self):
+        user = User.objects.create_user('empty', email='empty@example.com', password='pw')
+        cart = CartService(user).snapshot()
+        self.assertEqual((len(cart), cart.quantity, cart.total), (0, 0, Decimal('0.00')))
+
+    def test_cart_total_is_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_cart_total(self.large), Decimal('157.50'))
+
+    def test_cart_pages_do_not_grow_with_lines(self):
+        for name in ('cart:cart_detail', 'cart:cart_mini_preview'):
+            counts = []
+            for user in (self.small, self.large):
+                self.client.force_login(user)
+                counts.append(self.count_queries(lambda: self.client.get(reverse(name))))
+            self.assertEqual(counts[0], counts[1], name)
+
+    def test_increase_ajax_does_not_grow_with_lines(self):
+        counts = []
+        for user in (self.small, self.large):
+            self.client.force_login(user)
+            product_id = CartItem.objects.filter(user=user).values_list('product_id', flat=True).first()
+            url = reverse('cart:cart_increase', args=[product_id])
+            counts.append(self.count_queries(
+                lambda: self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            ))
+        self.assertEqual(counts[0], counts[1])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CartMutationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('shopper', email='shopper@example.com', password='pw')
+        cls.product = Product.objects.create(name='Lamp', description='', price=Decimal('4.00'), stock=5, allocated=2)
+
+    def setUp(self):
+        self.cart = CartService(self.user)
+
+    def test_add_is_one_statement_and_clamps_to_available(self):
+        with self.assertNumQueries(1):
+            line = self.cart.add(self.product.id, 2)
+        self.assertEqual((line.name, line.quantity, line.line_total), ('Lamp', 2, Decimal('8.00')))
+        line = self.cart.add(self.product.id, 5)
+        self.assertEqual(line.quantity, 3)
+        self.assertEqual(CartItem.objects.get(user=self.user).quantity, 3)
+
+    def test_add_sold_out_and_missing_product(self):
+        Product.objects.filter(id=self.product.id).update(allocated=5)
+        self.assertEqual(self.cart.add(self.product.id).quantity, 0)
+        self.assertFalse(CartItem.objects.exists())
+        self.assertIsNone(self.cart.add(self.product.id + 1000))
+
+    def test_change_deletes_at_zero(self):
+        self.cart.add(self.product.id, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.cart.change(self.product.id, -1).quantity, 1)
+        line = self.cart.change(self.product.id, -1)
+        self.assertEqual((line.quantity, line.line_total), (0, 0))
+        self.assertFalse(CartItem.objects.exists())
+        self.assertIsNone(self.cart.change(self.product.id, -1))
+
+    def test_set_quantity_clamps(self):
+        self.cart.add(self.product.id)
+        self.assertEqual(self.cart.set_quantity(self.product.id, 10).quantity, 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CartBatchUpdateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('batch', email='batch@example.com', password='pw')
+        cls.products = [
+            Product.objects.create(name=f'Item {i}', description='', price=Decimal('2.00'), stock=3)
+            for i in range(6)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def post(self, operations):
+        return self.client.post(
+            reverse('cart:cart_update'), {'operations': operations}, content_type='application/json'
+        )
+
+    def test_applies_coalesced_operations_and_returns_cart(self):
+        a, b = self.products[:2]
+        CartItem.objects.create(user=self.user, product=b, quantity=2)
+        data = self.post([
+            {'product_id': a.id, 'delta': 1},
+            {'product_id': a.id, 'delta': 5},
+            {'product_id': b.id, 'quantity': 0},
+            {'product_id': 999999, 'delta': 1},
+        ]).json()
+        self.assertTrue(data['success'])
+        self.assertEqual([(i['product_id'], i['quantity']) for i in data['items']], [(a.id, 3)])
+        self.assertEqual(data['cart_total'], 6.0)
+        self.assertEqual(data['adjusted'], [a.id])
+        self.assertEqual(data['unknown'], [999999])
+        self.assertFalse(CartItem.objects.filter(product=b).exists())
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        counts = []
+        for products in (self.products[:1], self.products[1:]):
+            with CaptureQueriesContext(connection) as ctx:
+                self.post([{'product_id': p.id, 'delta': 1} for p in products])
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_rejects_malformed_operations(self):
+        for operations in ([], [{'product_id': 1}], [{'product_id': 1, 'delta': 1, 'quantity': 2}],
+                           [{'product_id': '1', 'delta': 1}], [{'product_id': 1, 'quantity': -1}]):
+            response = self.post(operations)
+            self.assertEqual(response.status_code, 400, operations)
+            self.assertFalse(response.json()['success'])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class GuestCartTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('returning', email='returning@example.com', password='pw')
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+        cls.desk = Product.objects.create(name='Desk', description='', price=Decimal('50.00'), stock=2)
+
+    def ajax_post(self, url):
+        return self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_guest_cart_lives_in_a_cookie(self):
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.ajax_post(reverse('cart:cart_add', args=[self.lamp.id])).json()
+        self.assertTrue(data['success'])
+        self.assertFalse([q for q in ctx.captured_queries if not q['sql'].startswith('SELECT')])
+        self.assertIn('cart', self.client.cookies)
+
+        self.ajax_post(reverse('cart:cart_add', args=[self.lamp.id]))
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['cart_count'], 2)
+        response = self.client.get(reverse('cart:cart_detail'))
+        self.assertEqual(response.context['total_price'], Decimal('10.00'))
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['cart'] = 'not-signed'
+        self.assertEqual(self.client.get(reverse('cart:cart_count')).json()['cart_count'], 0)
+
+    def test_login_merges_guest_cart(self):
+        CartItem.objects.create(user=self.user, product=self.lamp, quantity=3)
+        self.ajax_post(reverse('cart:cart_add', args=[self.lamp.id]))
+        self.ajax_post(reverse('cart:cart_add', args=[self.lamp.id]))
+        self.ajax_post(reverse('cart:cart_add', args=[self.desk.id]))
+
+        self.client.post(reverse('login'), {'username': 'returning', 'password': 'pw'})
+
+        lines = dict(CartItem.objects.filter(user=self.user).values_list('product_id', 'quantity'))
+        self.assertEqual(lines, {self.lamp.id: 4, self.desk.id: 1})
+        self.assertEqual(self.client.cookies['cart'].value, '')
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CartSummaryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('counted', email='counted@example.com', password='pw')
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+
+    def test_summary_computed_before_a_mutation_is_not_served(self):
+        compute = cart_utils.compute_cart_summary
+
+        def stale_then_mutate(user):
+            summary = compute(user)
+            # Lands between the reader's query and its cache write
+            with self.captureOnCommitCallbacks(execute=True):
+                cart_utils.add_to_user_cart(user, self.lamp.id)
+            return summary
+
+        with mock.patch.object(cart_utils, 'compute_cart_summary', stale_then_mutate):
+            self.assertEqual(get_cart_summary(self.user)['quantity'], 0)
+        self.assertEqual(get_cart_summary(self.user)['quantity'], 1)
+
+    def test_mutation_stores_the_changed_cart_summary(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            cart = cart_for(self.user)
+            cart.add(self.lamp.id)
+            cart_utils.update_cart_summary(self.user, cart.snapshot())
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(get_cart_summary(self.user)['quantity'], 1)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, CART_WRITE_BEHIND=True)
+class WriteBehindCartTests(TestCase):
+    """Runs against CART_BUFFER_REDIS_URL under its own key prefix."""
+
+    KEY_PREFIX = 'test:cart:buf:'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            buffer.get_redis().ping()
+        except redis.RedisError:
+            raise SkipTest('needs the cart buffer Redis')
+        # Test user ids would otherwise hit real users' buffers and the dirty set
+        cls.prefix_patch = mock.patch.multiple(
+            buffer, KEY_PREFIX=cls.KEY_PREFIX, DIRTY_KEY=f'{cls.KEY_PREFIX}dirty',
+        )
+        cls.prefix_patch.start()
+        cls.addClassCleanup(cls.prefix_patch.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buffered', email='buffered@example.com', password='pw')
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+        cls.desk = Product.objects.create(name='Desk', description='', price=Decimal('50.00'), stock=2)
+
+    def setUp(self):
+        client = buffer.get_redis()
+        stale = list(client.scan_iter(match=f'{self.KEY_PREFIX}*'))
+        if stale:
+            client.delete(*stale)
+        self.cart = cart_for(self.user)
+
+    def test_mutations_are_buffered_and_reads_merge(self):
+        CartItem.objects.create(user=self.user, product=self.desk, quantity=1)
+        self.cart.add(self.lamp.id, 2)
+        self.cart.change(self.lamp.id, 5)
+        self.assertEqual(self.cart.change(self.desk.id, -1).quantity, 0)
+
+        self.assertFalse(CartItem.objects.filter(product=self.lamp).exists())
+        cart = self.cart.snapshot()
+        self.assertEqual([(item.product_id, item.quantity) for item in cart], [(self.lamp.id, 4)])
+        self.assertEqual(cart.total, Decimal('20.00'))
+
+    def test_flush_writes_and_empties_buffer(self):
+        CartItem.objects.create(user=self.user, product=self.desk, quantity=1)
+        self.cart.add(self.lamp.id, 3)
+        self.cart.set_quantity(self.desk.id, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.flush_users([self.user.pk])
+
+        self.assertEqual(
+            dict(CartItem.objects.filter(user=self.user).values_list('product_id', 'quantity')),
+            {self.lamp.id: 3},
+        )
+        self.assertEqual(buffer.read_buffer(self.user.pk), {})
+        self.assertFalse(buffer.get_redis().sismember(buffer.DIRTY_KEY, self.user.pk))
+
+    def test_rolled_back_flush_keeps_the_buffer(self):
+        self.cart.add(self.lamp.id, 2)
+        try:
+            with transaction.atomic():
+                buffer.flush_users([self.user.pk])
+                raise InterruptedError('checkout failed')
+        except InterruptedError:
+            pass
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+        self.assertEqual(buffer.read_buffer(self.user.pk), {self.lamp.id: 2})
+        self.assertTrue(buffer.get_redis().sismember(buffer.DIRTY_KEY, self.user.pk))
+
+    def test_flush_skips_a_cart_being_cleared(self):
+        CartItem.objects.create(user=self.user, product=self.desk, quantity=1)
+        self.cart.add(self.lamp.id, 2)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.cart.clear()
+            # A flush that runs before the clear's buffer drop writes nothing back
+            self.assertEqual(buffer.flush_users([self.user.pk]), 0)
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+        self.assertEqual(buffer.read_buffer(self.user.pk), {self.lamp.id: 2})
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(buffer.read_buffer(self.user.pk), {})
+        self.assertFalse(buffer.get_redis().sismember(buffer.DIRTY_KEY, self.user.pk))
+        self.assertFalse(buffer.get_redis().exists(buffer._cleared_key(self.user.pk)))
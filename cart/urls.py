@@ -9,6 +9,7 @@ urlpatterns = [
     path('remove/<int:product_id>/', views.cart_remove, name='cart_remove'),
     path('increase/<int:product_id>/', views.cart_increase, name='cart_increase'),
     path('decrease/<int:product_id>/', views.cart_decrease, name='cart_decrease'),
+    path('update/', views.cart_update, name='cart_update'),
     path('mini/', views.cart_mini_preview, name='cart_mini_preview'),
     path('count/', views.cart_count_view, name='cart_count'),
 ]
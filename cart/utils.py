@@ -1,27 +1,113 @@
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
 from .models import CartItem
-from products.models import Product
+from .services import cart_for
+from products.cache import catalog_generation
+
+CART_SUMMARY_TIMEOUT = 60 * 15
+
+def get_cart(request):
+    """CartService for logged-in users, the cookie-backed GuestCart otherwise."""
+    if request.user.is_authenticated:
+        return cart_for(request.user)
+    from .guest import get_guest_cart
+    return get_guest_cart(request)
+
+def get_cart_count(request):
+    """Navbar item count; no query for guests, cached for users."""
+    if request.user.is_authenticated:
+        return get_cart_summary(request.user)['quantity']
+    from .guest import get_guest_cart
+    return get_guest_cart(request).quantity
 
 def get_user_cart(user):
+    # Callers use the rows directly, so buffered changes must be in the table first
+    cart_for(user).flush()
     return CartItem.objects.filter(user=user).select_related('product')
 
 def add_to_user_cart(user, product_id, quantity=1):
-    product = Product.objects.get(id=product_id)
-    item, created = CartItem.objects.get_or_create(user=user, product=product)
-    if not created:
-        item.quantity += quantity
-    item.save()
+    line = cart_for(user).add(product_id, quantity)
+    update_cart_summary(user)
+    return line
 
 def remove_from_user_cart(user, product_id):
-    CartItem.objects.filter(user=user, product_id=product_id).delete()
+    cart_for(user).set_quantity(product_id, 0)
+    update_cart_summary(user)
+
+def clear_user_cart(user):
+    cart_for(user).clear()
+    update_cart_summary(user)
 
 def update_user_cart_quantity(user, product_id, delta):
-    item = CartItem.objects.filter(user=user, product_id=product_id).first()
-    if item:
-        item.quantity += delta
-        if item.quantity <= 0:
-            item.delete()
-        else:
-            item.save()
+    line = cart_for(user).change(product_id, delta)
+    if line:
+        update_cart_summary(user)
+    return line
 
 def get_user_cart_total(user):
-    return sum(item.total_price for item in get_user_cart(user))
+    return cart_for(user).total()
+
+# ---------- Cached cart summary ----------
+# {'items', 'quantity', 'total', 'version'} per user, so page renders (navbar
+# count, ETags) make no cart queries. The key includes the catalog generation,
+# so a product/price change rebuilds every summary on next use, and a per-user
+# cart generation that every mutation bumps on commit. A reader stores its
+# summary under the generation it saw before computing, so one computed before
+# a concurrent mutation lands under a key nobody reads any more.
+
+def _generation_key(user_id):
+    return f'cart:generation:{user_id}'
+
+def _cart_generation(user_id):
+    key = _generation_key(user_id)
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock so an evicted counter never reuses an old value
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+def _bump_cart_generation(user_id):
+    key = _generation_key(user_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+        return cache.incr(key)
+
+def _summary_key(user_id, generation):
+    return f'cart:summary:{user_id}:{generation}:{catalog_generation()}'
+
+def compute_cart_summary(user):
+    return {**cart_for(user).summary(), 'version': uuid.uuid4().hex[:12]}
+
+def get_cart_summary(user):
+    key = _summary_key(user.pk, _cart_generation(user.pk))
+    summary = cache.get(key)
+    if summary is None:
+        summary = compute_cart_summary(user)
+        cache.add(key, summary, timeout=CART_SUMMARY_TIMEOUT)
+    return summary
+
+def update_cart_summary(user, cart=None):
+    """
+    Call after every cart mutation. Pass the cart that was changed to store
+    its summary right away; otherwise the next read rebuilds it.
+    """
+    seen = _cart_generation(user.pk)
+    summary = {**cart.summary(), 'version': uuid.uuid4().hex[:12]} if cart is not None else None
+
+    def publish():
+        generation = _bump_cart_generation(user.pk)
+        # Another mutation committed since ours: our summary may miss it
+        if summary is not None and generation == seen + 1:
+            cache.set(_summary_key(user.pk, generation), summary, timeout=CART_SUMMARY_TIMEOUT)
+
+    transaction.on_commit(publish)
+
+def get_cart_version(user):
+    """Changes whenever the user's cart (or a product in it) changes; no query when cached."""
+    return get_cart_summary(user)['version']
@@ -1,132 +1,145 @@
-from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.auth.decorators import login_required
+import json
+
+from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.http import JsonResponse
-from products.models import Product
-from .models import CartItem
+from django.http import Http404, JsonResponse
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import require_POST
+from .utils import get_cart, get_cart_count, update_cart_summary
 from django.template.loader import render_to_string
+from core.utils.http import conditional_page
+
+def _cart_changed(request, cart=None):
+    # Guest carts are saved by GuestCartMiddleware; users have a cached summary
+    if request.user.is_authenticated:
+        update_cart_summary(request.user, cart)
 
-def _get_stock(product):
-    """
-    Safely get available stock from the Product.
-    If your field name is different, add it below.
-    """
-    for attr in ("stock", "available_stock", "quantity", "inventory"):
-        if hasattr(product, attr):
-            try:
-                return max(0, int(getattr(product, attr) or 0))
-            except (TypeError, ValueError):
-                return 0
-    return 0
-
-@login_required
 def cart_detail(request):
-    cart_items = CartItem.objects.filter(user=request.user)
-    total_price = sum(item.total_price for item in cart_items)
+    cart = get_cart(request).snapshot()
     return render(request, 'cart/cart.html', {
-        'cart_items': cart_items,
-        'total_price': total_price,
+        'cart_items': cart.lines,
+        'total_price': cart.total,
     })
 
-@login_required
 def cart_add(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    cart_item, created = CartItem.objects.get_or_create(user=request.user, product=product)
-
-    # --- STOCK CLAMP (minimal) ---
-    stock = _get_stock(product)
-    current_qty = 0 if created else cart_item.quantity
-    desired = current_qty + 1
-    clamped = min(desired, stock)
+    # One upsert, clamped to available stock in SQL
+    line = get_cart(request).add(product_id)
+    if line is None:
+        raise Http404("No Product matches the given query.")
 
-    if clamped <= 0:
+    if line.quantity <= 0:
         if request.headers.get("x-requested-with") == "XMLHttpRequest":
             return JsonResponse({"success": False, "message": "This item is out of stock."})
         messages.error(request, "This item is out of stock.")
         return redirect('products:product_list')
-    # -----------------------------
 
-    cart_item.quantity = clamped
-    cart_item.save()
+    _cart_changed(request)
 
     if request.headers.get("x-requested-with") == "XMLHttpRequest":
         return JsonResponse({
             "success": True,
-            "message": f"{product.name} added to cart.",
-            "quantity": cart_item.quantity,
-            "item_total": float(cart_item.total_price),
+            "message": f"{line.name} added to cart.",
+            "quantity": line.quantity,
+            "item_total": float(line.line_total),
         })
 
-    messages.success(request, f"{product.name} added to cart.")
+    messages.success(request, f"{line.name} added to cart.")
     return redirect('products:product_list')
 
-@login_required
 def cart_remove(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
-    CartItem.objects.filter(user=request.user, product=product).delete()
-    messages.info(request, f"{product.name} removed from cart.")
+    line = get_cart(request).set_quantity(product_id, 0)
+    if line is not None:
+        _cart_changed(request)
+        messages.info(request, f"{line.name} removed from cart.")
     return redirect('cart:cart_detail')
 
-@login_required
-def cart_increase(request, product_id):
-    cart_item = get_object_or_404(CartItem, user=request.user, product_id=product_id)
-
-    # --- STOCK CLAMP (minimal) ---
-    stock = _get_stock(cart_item.product)
-    if cart_item.quantity < stock:
-        cart_item.quantity += 1
-        cart_item.save()
-    # else: already at max; do not increment
-    # --------------------------------
+def _change_line(request, product_id, delta):
+    # Clamped to available stock in SQL; the line is deleted when it hits 0
+    line = get_cart(request).change(product_id, delta)
+    if line is None:
+        raise Http404("No CartItem matches the given query.")
 
     if request.headers.get("x-requested-with") == "XMLHttpRequest":
-        cart_items = CartItem.objects.filter(user=request.user)
-        cart_total = sum(item.total_price for item in cart_items)
+        cart = get_cart(request).snapshot()
+        _cart_changed(request, cart)
         return JsonResponse({
-            'quantity': cart_item.quantity,
-            'item_total': float(cart_item.total_price),
-            'cart_total': float(cart_total),
+            'quantity': line.quantity,
+            'item_total': float(line.line_total),
+            'cart_total': float(cart.total),
         })
 
+    _cart_changed(request)
     return redirect('cart:cart_detail')
 
-@login_required
+MAX_BATCH_OPERATIONS = 100
+
+def _parse_operations(body):
+    """
+    Validates [{product_id, quantity | delta}, ...]. Returns (operations, error).
+    """
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return None, 'Invalid JSON.'
+    operations = data.get('operations') if isinstance(data, dict) else data
+    if not isinstance(operations, list) or not operations:
+        return None, 'Expected a non-empty list of operations.'
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return None, f'At most {MAX_BATCH_OPERATIONS} operations per request.'
+
+    parsed = []
+    for op in operations:
+        if not isinstance(op, dict) or ('quantity' in op) == ('delta' in op):
+            return None, 'Each operation needs a product_id and either quantity or delta.'
+        values = {key: op[key] for key in ('product_id', 'quantity', 'delta') if key in op}
+        if not all(isinstance(v, int) and not isinstance(v, bool) for v in values.values()):
+            return None, 'product_id, quantity and delta must be integers.'
+        if values.get('quantity', 0) < 0:
+            return None, 'quantity cannot be negative.'
+        parsed.append(values)
+    return parsed, None
+
+@require_POST
+def cart_update(request):
+    """
+    Batch edit for the cart page: the UI coalesces +/- clicks and sends them
+    together. Responds with the whole recomputed cart.
+    """
+    operations, error = _parse_operations(request.body)
+    if error:
+        return JsonResponse({'success': False, 'error': error}, status=400)
+
+    cart, adjusted, unknown = get_cart(request).apply(operations)
+    _cart_changed(request, cart)
+    return JsonResponse({
+        'success': True,
+        **cart.as_json(),
+        'adjusted': adjusted,
+        'unknown': unknown,
+    })
+
+def cart_increase(request, product_id):
+    return _change_line(request, product_id, 1)
+
 def cart_decrease(request, product_id):
-    cart_item = get_object_or_404(CartItem, user=request.user, product_id=product_id)
-    if cart_item.quantity > 1:
-        cart_item.quantity -= 1
-        cart_item.save()
-        quantity = cart_item.quantity
-        item_total = cart_item.total_price
-    else:
-        cart_item.delete()
-        quantity = 0
-        item_total = 0
+    return _change_line(request, product_id, -1)
 
-    if request.headers.get("x-requested-with") == "XMLHttpRequest":
-        cart_items = CartItem.objects.filter(user=request.user)
-        cart_total = sum(item.total_price for item in cart_items)
-        return JsonResponse({
-            'quantity': quantity,
-            'item_total': float(item_total),
-            'cart_total': float(cart_total),
-        })
+def _mini_cart_version(request):
+    # The per-user part of the ETag already carries the cart version (or the guest cart)
+    return None, ('mini',)
 
-    return redirect('cart:cart_detail')
 
-@login_required
+@conditional_page(_mini_cart_version)
 def cart_mini_preview(request):
-    cart_items = CartItem.objects.filter(user=request.user)
-    total_price = sum(item.total_price for item in cart_items)
+    cart = get_cart(request).snapshot()
     html = render_to_string('cart/_mini_cart.html', {
-        'cart_items': cart_items,
-        'total_price': total_price,
+        'cart_items': cart.lines,
+        'total_price': cart.total,
     })
     return JsonResponse({'html': html})
 
-@login_required
+# Fetched on every page load; also hands out the CSRF cookie that publicly
+# cached pages leave out
+@ensure_csrf_cookie
 def cart_count_view(request):
-    count = 0
-    if request.user.is_authenticated:
-        count = sum(item.quantity for item in CartItem.objects.filter(user=request.user))
-    return JsonResponse({"cart_count": count})
+    return JsonResponse({"cart_count": get_cart_count(request)})
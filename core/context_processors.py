@@ -0,0 +1,9 @@
+# core/context_processors.py
+
+
+def shared_page(request):
+    # Publicly cached pages must not embed a per-visitor CSRF token
+    # (see core.utils.http.conditional_page); cart.js fills it in
+    if getattr(request, 'shared_page', False):
+        return {'csrf_token': 'NOTPROVIDED'}
+    return {}
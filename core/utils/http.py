@@ -0,0 +1,95 @@
+# core/utils/http.py
+"""
+Conditional GET helpers.
+
+A view decorated with @conditional_page supplies a cheap "version" of what it
+would render (timestamps/counters from a single small query). The version is
+turned into an ETag/Last-Modified, and a matching If-None-Match or
+If-Modified-Since returns 304 before the view's heavy queries and template
+rendering run.
+"""
+
+import hashlib
+from functools import wraps
+
+from django.contrib import messages
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+
+def make_etag(*parts):
+    return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def conditional_page(version_func, public=False, max_age=60):
+    """
+    version_func(request, *args, **kwargs) -> (last_modified or None, parts)
+    or None to skip validators for this request.
+
+    public=True lets shared caches (reverse proxy) keep anonymous responses
+    for max_age seconds; logged-in users and guests with a cart get private
+    responses. Those shared pages are rendered without a CSRF token
+    (request.shared_page, see core.context_processors); one that still sets
+    a cookie is sent private instead.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            memo = {}
+            request.shared_page = public and _is_shared(request)
+
+            def version(req, *a, **kw):
+                if 'v' not in memo:
+                    # Pending flash messages are rendered once; never answer 304 over them
+                    memo['v'] = None if len(messages.get_messages(req)) else version_func(req, *a, **kw)
+                    if memo['v'] is not None:
+                        memo['v'] = (memo['v'][0], (_user_part(req), *memo['v'][1]))
+                return memo['v']
+
+            def etag(req, *a, **kw):
+                v = version(req, *a, **kw)
+                return make_etag(*v[1]) if v else None
+
+            def last_modified(req, *a, **kw):
+                v = version(req, *a, **kw)
+                return v[0] if v else None
+
+            response = condition(etag_func=etag, last_modified_func=last_modified)(view)(
+                request, *args, **kwargs
+            )
+
+            if request.shared_page and not _sets_cookies(request, response):
+                patch_cache_control(response, public=True, max_age=max_age)
+            else:
+                patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
+
+
+def _is_shared(request):
+    # Anonymous, no flash messages and nothing in a guest cart: the page is
+    # the same for everyone
+    if request.user.is_authenticated or len(messages.get_messages(request)):
+        return False
+    from cart.guest import get_guest_cart
+    return not get_guest_cart(request).quantities
+
+
+def _sets_cookies(request, response):
+    # The CSRF cookie is added by the middleware on the way out
+    return bool(response.cookies) or request.META.get('CSRF_COOKIE_NEEDS_UPDATE', False)
+
+
+def _user_part(request):
+    # The navbar (username, cart count) is part of every page
+    if not request.user.is_authenticated:
+        from cart.guest import get_guest_cart
+        from products.cache import catalog_generation
+        guest = get_guest_cart(request)
+        if not guest.quantities:
+            return 'anon'
+        return f"g{catalog_generation()}:{guest.version()}"
+    from cart.utils import get_cart_version
+    return f"u{request.user.pk}:{get_cart_version(request.user)}"
@@ -5,7 +5,7 @@ from django.conf import settings
 import openpyxl
 import json
 
-from .models import Order, OrderItem
+from .models import Order, OrderItem, PaymentEvent
 
 # Use the unified client
 from core.api_clients.shiprocket import create_shiprocket_shipment
@@ -167,7 +167,7 @@ class OrderAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'order_date', 'status', 'expected_delivery', 'total_price', 'order_items_list']
     list_filter = [RealOrderStatusFilter, TotalPriceRangeFilter, 'status', 'order_date']
     list_editable = ['status']
-    readonly_fields = ['colored_status', 'expected_delivery']
+    readonly_fields = ['colored_status', 'expected_delivery', 'refund_requested_at', 'refund_id']
     inlines = [OrderItemInline]
     actions = [export_as_excel, mark_as_shipped, mark_as_cancelled]
 
@@ -181,3 +181,16 @@ class OrderAdmin(admin.ModelAdmin):
 
 admin.site.register(Order, OrderAdmin)
 admin.site.register(OrderItem)  # optional
+
+
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ('received_at', 'event', 'event_id', 'local_order_id', 'processed_at', 'outcome')
+    list_filter = ('event', 'outcome')
+    search_fields = ('event_id', 'local_order_id')
+    readonly_fields = [f.name for f in PaymentEvent._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(PaymentEvent, PaymentEventAdmin)
@@ -0,0 +1,152 @@
+"""
+Redis admission gate for checkout (settings.STOCK_GATE).
+
+Each product gets a counter in Redis (stock:gate:<id>) that estimates its
+live available stock. create_razorpay_order_reserved asks admit() first: one
+Lua script checks every cart line and either decrements them all or none.
+A sold-out cart is turned away before Postgres is touched; an admitted one
+still goes through reserve_inventory(), which stays the source of truth.
+
+The counters only need to be close. Over-admitting costs a failed
+reservation, and under-admitting (units held by orders that were later
+released) lasts until the next reconcile(), which resets every counter
+from Postgres (Celery beat). A counter that is missing (cold Redis, new
+product) is primed from Postgres on first use. If Redis is down, the gate
+lets everyone through.
+"""
+
+import redis
+from django.conf import settings
+
+from products.ledger import with_live_stock
+from products.models import Product
+
+KEY_PREFIX = 'stock:gate:'
+RECONCILE_BATCH = 500
+
+# KEYS: counters; ARGV: quantities. Returns 0 if admitted (all decremented),
+# i if line i is short, -i if counter i doesn't exist yet.
+ADMIT_LUA = """
+for i, key in ipairs(KEYS) do
+  local have = redis.call('GET', key)
+  if not have then return -i end
+  if tonumber(have) < tonumber(ARGV[i]) then return i end
+end
+for i, key in ipairs(KEYS) do
+  redis.call('DECRBY', key, ARGV[i])
+end
+return 0
+"""
+
+_client = None
+
+
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.STOCK_GATE_REDIS_URL, decode_responses=True)
+    return _client
+
+
+def _key(product_id):
+    return f'{KEY_PREFIX}{product_id}'
+
+
+def _live_available(product_ids):
+    return dict(
+        with_live_stock(Product.objects.filter(id__in=list(product_ids)))
+        .values_list('id', 'live_available')
+    )
+
+
+def prime(product_ids):
+    """Creates the missing counters for product_ids from Postgres."""
+    pipe = get_redis().pipeline()
+    for product_id, available in _live_available(product_ids).items():
+        pipe.set(_key(product_id), max(available, 0), nx=True)
+    pipe.execute()
+
+
+def admit(lines):
+    """
+    Takes {product_id: quantity} from the counters, all or nothing. Returns
+    (taken, sold_out): the lines that were taken, for give_back(), and the
+    product id that is sold out, if any. ({}, None) lets the cart through
+    without taking anything (gate off or unreachable, product gone).
+    """
+    if not settings.STOCK_GATE or not lines:
+        return {}, None
+    product_ids = sorted(lines)
+    keys = [_key(product_id) for product_id in product_ids]
+    quantities = [lines[product_id] for product_id in product_ids]
+    try:
+        script = get_redis().register_script(ADMIT_LUA)
+        result = script(keys=keys, args=quantities)
+        if result < 0:
+            prime(product_ids)
+            result = script(keys=keys, args=quantities)
+    except redis.RedisError as e:
+        print(f"❌ Stock gate unavailable, admitting: {e}")
+        return {}, None
+    if result > 0:
+        return {}, product_ids[result - 1]
+    # Still missing after priming: the product is gone, let checkout report it
+    return (dict(lines) if result == 0 else {}), None
+
+
+def give_back(lines):
+    """Returns an admitted cart's units when its reservation didn't happen."""
+    if not settings.STOCK_GATE or not lines:
+        return
+    try:
+        pipe = get_redis().pipeline()
+        for product_id, quantity in lines.items():
+            pipe.incrby(_key(product_id), quantity)
+        pipe.execute()
+    except redis.RedisError:
+        pass  # reconcile() resets the counter anyway
+
+
+def reconcile(batch_size=RECONCILE_BATCH):
+    """
+    Resets every existing counter to the product's live available.
+    Returns (counters checked, counters that had drifted).
+    """
+    client = get_redis()
+    keys = list(client.scan_iter(match=f'{KEY_PREFIX}*', count=batch_size))
+    drifted = sum(_reconcile_keys(client, keys[i:i + batch_size]) for i in range(0, len(keys), batch_size))
+    return len(keys), drifted
+
+
+def _reconcile_keys(client, keys):
+    product_ids = [int(key[len(KEY_PREFIX):]) for key in keys]
+    live = _live_available(product_ids)
+    current = client.mget(keys)
+    pipe = client.pipeline()
+    drifted = 0
+    for key, product_id, value in zip(keys, product_ids, current):
+        if product_id not in live:
+            pipe.delete(key)
+            continue
+        available = max(live[product_id], 0)
+        if value is None or int(value) != available:
+            drifted += 1
+            pipe.set(key, available)
+    pipe.execute()
+    return drifted
+
+
+def rebuild(batch_size=RECONCILE_BATCH):
+    """Cold start: drops every counter and loads all products from Postgres. Returns the count."""
+    client = get_redis()
+    stale = list(client.scan_iter(match=f'{KEY_PREFIX}*', count=batch_size))
+    for i in range(0, len(stale), batch_size):
+        client.delete(*stale[i:i + batch_size])
+
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+    for i in range(0, len(product_ids), batch_size):
+        pipe = client.pipeline()
+        for product_id, available in _live_available(product_ids[i:i + batch_size]).items():
+            pipe.set(_key(product_id), max(available, 0))
+        pipe.execute()
+    return len(product_ids)
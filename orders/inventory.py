@@ -0,0 +1,194 @@
+"""
+Set-based stock moves for the order workflow, written to the inventory
+ledger (products.ledger) instead of the product rows.
+
+Every move is a constant number of round trips regardless of order size:
+the order's lines (summed per product), one statement taking a
+transaction-scoped advisory lock per product in id order (so concurrent
+checkouts of the same product serialize without deadlocks, and without
+locking the product row itself), then a single INSERT ... SELECT FROM
+(VALUES ...) that checks every line against live stock (snapshot + pending
+movements) and appends a movement for each line whose guard holds. Lines
+that didn't come back failed; the caller decides whether that aborts the
+transaction. Sharded products (products.shards) skip the advisory lock and
+claim their units from a shard row before the INSERT (one statement per
+sharded line); releases hand them back to a shard afterwards.
+"""
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from products import shards
+from products.ledger import LIVE_STOCK_SQL, MOVEMENT_TABLE, lock_products
+from products.cache import bump_product_versions
+from products.models import InventoryMovement
+
+SWEEP_BATCH = 500
+SWEEP_ORDERS_KEY = 'orders:expiry:orders'
+SWEEP_UNITS_KEY = 'orders:expiry:units'
+SWEEP_MISMATCH_KEY = 'orders:expiry:mismatches'
+
+# name -> (stock delta, allocated delta, guard) in terms of live stock and v.qty
+MOVES = {
+    'reserve': ('0', 'v.qty', 'live.allocated + v.qty <= live.stock'),
+    'confirm': ('-v.qty', '-v.qty', 'live.allocated >= v.qty AND live.stock >= v.qty'),
+    'release': ('0', '-v.qty', 'live.allocated >= v.qty'),
+}
+
+
+def order_lines(order):
+    """{product_id: quantity} for an order, in product id order."""
+    return dict(
+        order.items.values('product_id')
+        .annotate(qty=Sum('quantity'))
+        .order_by('product_id')
+        .values_list('product_id', 'qty')
+    )
+
+
+def apply_move(move, lines, order=None):
+    """
+    Appends one MOVES entry for all {product_id: quantity} lines in a single
+    INSERT. Returns the product ids whose guard failed (nothing recorded for
+    those). Call inside a transaction, after lock_products().
+    """
+    if not lines:
+        return []
+    out_of_stock = []
+    if move == 'reserve':
+        # Sharded products claim their units from a shard row first
+        out_of_stock = shards.take(lines)
+        lines = {product_id: qty for product_id, qty in lines.items() if product_id not in out_of_stock}
+        if not lines:
+            return out_of_stock
+    stock_delta, allocated_delta, guard = MOVES[move]
+    values = ', '.join(['(%s::bigint, %s::bigint)'] * len(lines))
+    params = [x for line in lines.items() for x in line]
+    sql = f"""
+        WITH v(id, qty) AS (VALUES {values}),
+        live AS ({LIVE_STOCK_SQL})
+        INSERT INTO {MOVEMENT_TABLE}
+            (product_id, order_id, reason, stock_delta, allocated_delta, created_at, compacted)
+        SELECT v.id, %s, %s, {stock_delta}, {allocated_delta}, now(), false
+        FROM v JOIN live ON live.id = v.id
+        WHERE {guard}
+        RETURNING product_id
+    """
+    params += [list(lines), order.id if order else None, move]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        applied = {row[0] for row in cursor.fetchall()}
+    if move == 'release':
+        shards.give({product_id: qty for product_id, qty in lines.items() if product_id in applied})
+    return out_of_stock + [product_id for product_id in lines if product_id not in applied]
+
+
+# ---------- Reservation expiry ----------
+
+def _incr(key, delta):
+    if not delta:
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, timeout=None)
+
+
+def release_expired_reservations(batch_size=SWEEP_BATCH):
+    """
+    Releases up to batch_size unpaid reservations whose reserved_until has
+    passed and marks those orders Failed. Orders another request has locked
+    (e.g. a payment being finalized right now) are skipped until next run.
+    Stock goes back with one INSERT ... SELECT over the batch's order items,
+    one EXPIRE movement per order and product. Orders holding a product
+    with less allocated than the batch releases are left as they are for
+    reconcile. Returns {'orders', 'units', 'products', 'mismatches',
+    'skipped'}, skipped being the ids of those orders.
+    """
+    from .models import Order, OrderItem
+
+    with transaction.atomic():
+        order_ids = list(
+            Order.objects.select_for_update(skip_locked=True)
+            .filter(
+                inventory_reserved=True, inventory_finalized=False,
+                reserved_until__lt=timezone.now(), status='Pending',
+            )
+            .filter(Q(payment_id__isnull=True) | Q(payment_id=''))
+            .order_by('reserved_until')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not order_ids:
+            return {'orders': 0, 'units': 0, 'products': 0, 'mismatches': 0, 'skipped': []}
+
+        rows = list(
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .values('order_id', 'product_id')
+            .annotate(qty=Sum('quantity'))
+            .order_by('product_id')
+            .values_list('order_id', 'product_id', 'qty')
+        )
+        product_ids = sorted({product_id for _, product_id, _ in rows})
+        lock_products(product_ids)
+        with connection.cursor() as cursor:
+            # Products the whole batch can't be released from take every
+            # order holding them out of the INSERT; the rest is guarded by
+            # that same check, since dropping orders only lowers their sums
+            cursor.execute(f"""
+                WITH i AS (
+                    SELECT order_id, product_id, SUM(quantity) AS qty
+                    FROM {OrderItem._meta.db_table} WHERE order_id = ANY(%s)
+                    GROUP BY order_id, product_id
+                ),
+                live AS ({LIVE_STOCK_SQL}),
+                bad AS (
+                    SELECT i.product_id FROM i LEFT JOIN live ON live.id = i.product_id
+                    GROUP BY i.product_id, live.allocated
+                    HAVING COALESCE(live.allocated, 0) < SUM(i.qty)
+                ),
+                moved AS (
+                    INSERT INTO {MOVEMENT_TABLE}
+                        (product_id, order_id, reason, stock_delta, allocated_delta, created_at, compacted)
+                    SELECT i.product_id, i.order_id, %s, 0, -i.qty, now(), false FROM i
+                    WHERE i.order_id NOT IN (SELECT held.order_id FROM i AS held JOIN bad USING (product_id))
+                )
+                SELECT product_id FROM bad
+            """, [order_ids, product_ids, InventoryMovement.EXPIRE])
+            mismatches = {row[0] for row in cursor.fetchall()}
+
+        skipped = {order_id for order_id, product_id, _ in rows if product_id in mismatches}
+        released = {}
+        for order_id, product_id, qty in rows:
+            if order_id not in skipped:
+                released[product_id] = released.get(product_id, 0) + qty
+        shards.give(released)
+
+        Order.objects.filter(id__in=order_ids).exclude(id__in=skipped).update(
+            status='Failed', inventory_reserved=False, reserved_until=None,
+        )
+        released_ids = list(released)
+        transaction.on_commit(lambda: bump_product_versions(released_ids))
+
+    stats = {
+        'orders': len(order_ids) - len(skipped),
+        'units': sum(released.values()),
+        'products': len(released),
+        'mismatches': len(mismatches),
+        'skipped': sorted(skipped),
+    }
+    _incr(SWEEP_ORDERS_KEY, stats['orders'])
+    _incr(SWEEP_UNITS_KEY, stats['units'])
+    _incr(SWEEP_MISMATCH_KEY, stats['mismatches'])
+    return stats
+
+
+def reservation_sweep_stats():
+    """Running totals from the expiry sweeper."""
+    stats = cache.get_many([SWEEP_ORDERS_KEY, SWEEP_UNITS_KEY, SWEEP_MISMATCH_KEY])
+    return {
+        'orders': stats.get(SWEEP_ORDERS_KEY, 0),
+        'units': stats.get(SWEEP_UNITS_KEY, 0),
+        'mismatches': stats.get(SWEEP_MISMATCH_KEY, 0),
+    }
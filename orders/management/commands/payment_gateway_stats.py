@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from orders.payments import gateway_stats
+
+
+class Command(BaseCommand):
+    help = "Shows call, error and latency counters for the payment gateway"
+
+    def handle(self, *args, **kwargs):
+        for operation, stats in gateway_stats().items():
+            self.stdout.write(
+                f"💳 {operation}: {stats['calls']} call(s), {stats['errors']} error(s), "
+                f"{stats['avg_ms']} ms average"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from orders.inventory import SWEEP_BATCH, release_expired_reservations, reservation_sweep_stats
+
+
+class Command(BaseCommand):
+    help = "Releases stock held by unpaid orders whose reservation expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', help="Only show the sweeper's running totals")
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            orders = units = 0
+            while True:
+                stats = release_expired_reservations()
+                orders += stats['orders']
+                units += stats['units']
+                if stats['orders'] < SWEEP_BATCH:
+                    break
+            self.stdout.write(f"✅ Released {units} unit(s) from {orders} expired order(s)")
+
+        totals = reservation_sweep_stats()
+        self.stdout.write(
+            f"📦 Sweeper totals: {totals['orders']} order(s), {totals['units']} unit(s) reclaimed, "
+            f"{totals['mismatches']} mismatch(es)"
+        )
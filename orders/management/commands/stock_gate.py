@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from orders.admission import rebuild, reconcile
+
+
+class Command(BaseCommand):
+    help = "Rebuilds or reconciles the checkout stock gate's Redis counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help="Drop every counter and reload all products")
+        parser.add_argument('--reconcile', action='store_true', help="Reset existing counters from Postgres")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write(f"✅ Loaded {rebuild()} product counter(s) from Postgres")
+        if options['reconcile'] or not options['rebuild']:
+            checked, drifted = reconcile()
+            self.stdout.write(f"✅ Checked {checked} counter(s), reset {drifted}")
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-17 23:57
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_order_inventory_finalized_order_inventory_reserved'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='affinity_counted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('affinity_counted', False), ('inventory_finalized', True)), fields=['id'], name='order_affinity_pending'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.4 on 2026-10-18 00:07
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def expire_open_reservations(apps, schema_editor):
+    # Reservations made before this field existed get a deadline too
+    Order = apps.get_model('orders', 'Order')
+    Order.objects.filter(inventory_reserved=True, inventory_finalized=False).update(
+        reserved_until=models.F('order_date') + timedelta(seconds=settings.ORDER_RESERVATION_TTL)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_order_affinity_counted'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='reserved_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('inventory_finalized', False), ('inventory_reserved', True)), fields=['reserved_until'], name='order_reservation_expiry'),
+        ),
+        migrations.RunPython(expire_open_reservations, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,11 @@
 from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
-from django.db.models import F
+from django.db.models import Q
 from datetime import timedelta
 from products.models import Product
+from products.cache import bump_product_versions
+from .inventory import apply_move, lock_products, order_lines
 
 
 class InventoryError(Exception):
@@ -14,6 +16,10 @@ class InsufficientStock(InventoryError):
     pass
 
 
+class OrderCancelled(Exception):
+    pass
+
+
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, null=True, blank=True)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -46,12 +52,92 @@ class Order(models.Model):
     # ✅ New: inventory reservation state (idempotency & safety)
     inventory_reserved = models.BooleanField(default=False)
     inventory_finalized = models.BooleanField(default=False)
+    # Unpaid reservations past this are released by the expiry sweeper
+    reserved_until = models.DateTimeField(null=True, blank=True)
+
+    # Already folded into products.ProductAffinity ("frequently bought together")
+    affinity_counted = models.BooleanField(default=False)
+
+    # Paid but not fulfilled: refunded after commit by orders.refunds.
+    # Set when the refund is owed; pushed ahead while a worker is sending it
+    refund_requested_at = models.DateTimeField(null=True, blank=True)
+    refund_id = models.CharField(max_length=100, blank=True, null=True)
 
     def __str__(self):
         return f"Order {self.id} - {self.status}"
 
+    class Meta:
+        indexes = [
+            # Orders still to be folded into "frequently bought together"
+            models.Index(
+                fields=['id'], name='order_affinity_pending',
+                condition=Q(inventory_finalized=True, affinity_counted=False),
+            ),
+            # Open reservations, for the expiry sweeper
+            models.Index(
+                fields=['reserved_until'], name='order_reservation_expiry',
+                condition=Q(inventory_reserved=True, inventory_finalized=False),
+            ),
+            # Refunds still owed, for the refund sweeper
+            models.Index(
+                fields=['refund_requested_at'], name='order_refund_pending',
+                condition=Q(refund_requested_at__isnull=False, refund_id__isnull=True),
+            ),
+        ]
+
+    @classmethod
+    def from_cart(cls, user, cart, **fields):
+        """
+        Creates a Pending order from a cart snapshot (cart.services.CartSnapshot):
+        one INSERT for the order and one for all of its lines.
+        """
+        order = cls.objects.create(user=user, total_price=cart.total, status='Pending', **fields)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=item.product, price=item.product.price, quantity=item.quantity)
+            for item in cart
+        ])
+        return order
+
     # ---------- Convenience & UX ----------
 
+    def confirm_payment(self, payment_id):
+        """
+        Records a captured payment and finalizes the order (allocated -> sold,
+        confirmation email queued, the user's cart cleared). Idempotent: the
+        browser callback and the webhook may both get here. If the stock is
+        gone, queues a refund, marks the order Failed and raises
+        InsufficientStock; a cancelled order is refunded and raises
+        OrderCancelled without touching inventory. Returns True if this call
+        finalized the order. Call with the order row locked.
+        """
+        from cart.utils import clear_user_cart
+        from .notifications import queue_order_email
+        from .refunds import queue_refund
+
+        if self.inventory_finalized:
+            return False
+        if self.status == 'Cancelled':
+            # confirm_inventory() would re-reserve and sell its released stock
+            queue_refund(self, payment_id)
+            raise OrderCancelled(f"Order #{self.id} was cancelled; your payment will be refunded.")
+
+        self.payment_id = payment_id
+        self.save(update_fields=['payment_id'])
+        try:
+            self.confirm_inventory()
+        except InsufficientStock:
+            # Extremely unlikely; in this case refund (after commit) and fail
+            queue_refund(self)
+            self.mark_as_failed()
+            raise
+
+        if self.email:
+            queue_order_email(self, OrderEmail.CONFIRMATION, self.email)
+        if self.user_id:
+            # Whichever of the callback and the webhook finalizes empties the cart
+            clear_user_cart(self.user)
+        return True
+
     def mark_as_failed(self):
         self.status = 'Failed'
         self.save(update_fields=['status'])
@@ -97,9 +183,11 @@ class Order(models.Model):
 
     # ---------- Inventory reservation workflow ----------
 
-    def _items_for_lock(self):
-        # Lock products in a deterministic order to avoid deadlocks
-        return list(self.items.select_related("product").order_by("product_id"))
+    @staticmethod
+    def _invalidate_product_cards(product_ids):
+        # Live stock changed through the ledger, which sends no signals
+        product_ids = list(product_ids)
+        transaction.on_commit(lambda: bump_product_versions(product_ids))
 
     def reserve_inventory(self):
         """
@@ -111,25 +199,23 @@ class Order(models.Model):
             return
 
         with transaction.atomic():
-            order_items = self._items_for_lock()
-            if not order_items:
+            lines = order_lines(self)
+            if not lines:
                 return  # empty order, nothing to do
 
-            # Lock the product rows we're about to update
-            Product.objects.select_for_update().filter(
-                id__in=[it.product_id for it in order_items]
-            ).order_by('id')
-
-            for it in order_items:
-                updated = Product.objects.filter(
-                    id=it.product_id,
-                    allocated__lte=F('stock') - it.quantity
-                ).update(allocated=F('allocated') + it.quantity)
-                if updated == 0:
-                    raise InsufficientStock(f"{it.product.name} just ran out")
+            names = lock_products(lines)
+            failed = apply_move('reserve', lines, order=self)
+            if failed:
+                # Leaving the atomic block rolls back the lines that did apply
+                raise InsufficientStock(
+                    ", ".join(names.get(product_id, f"Product {product_id}") for product_id in failed)
+                    + " just ran out"
+                )
 
+            self._invalidate_product_cards(lines)
             self.inventory_reserved = True
-            self.save(update_fields=['inventory_reserved'])
+            self.reserved_until = timezone.now() + timedelta(seconds=settings.ORDER_RESERVATION_TTL)
+            self.save(update_fields=['inventory_reserved', 'reserved_until'])
 
     def confirm_inventory(self):
         """
@@ -141,29 +227,27 @@ class Order(models.Model):
             return
 
         with transaction.atomic():
-            order_items = self._items_for_lock()
-            if not order_items:
+            update_fields = ['inventory_finalized', 'reserved_until']
+            if not self.inventory_reserved:
+                # Paid after the expiry sweeper released it: reserve again first
+                self.reserve_inventory()
+                if self.status == 'Failed':
+                    self.status = 'Pending'
+                    update_fields.append('status')
+
+            lines = order_lines(self)
+            if not lines:
                 return
 
-            Product.objects.select_for_update().filter(
-                id__in=[it.product_id for it in order_items]
-            ).order_by('id')
-
-            for it in order_items:
-                updated = Product.objects.filter(
-                    id=it.product_id,
-                    allocated__gte=it.quantity,
-                    stock__gte=it.quantity
-                ).update(
-                    allocated=F('allocated') - it.quantity,
-                    stock=F('stock') - it.quantity
-                )
-                if updated == 0:
-                    # Very rare: allocation missing or stock shrank unexpectedly
-                    raise InsufficientStock("Inventory mismatch during finalize")
+            lock_products(lines)
+            if apply_move('confirm', lines, order=self):
+                # Very rare: allocation missing or stock shrank unexpectedly
+                raise InsufficientStock("Inventory mismatch during finalize")
 
+            self._invalidate_product_cards(lines)
             self.inventory_finalized = True
-            self.save(update_fields=['inventory_finalized'])
+            self.reserved_until = None
+            self.save(update_fields=update_fields)
 
     def release_inventory(self):
         """
@@ -174,23 +258,18 @@ class Order(models.Model):
             return
 
         with transaction.atomic():
-            order_items = self._items_for_lock()
-            if not order_items:
+            lines = order_lines(self)
+            if not lines:
                 return
 
-            Product.objects.select_for_update().filter(
-                id__in=[it.product_id for it in order_items]
-            ).order_by('id')
-
-            for it in order_items:
-                # Guard with allocated__gte to avoid going negative if retried
-                Product.objects.filter(
-                    id=it.product_id,
-                    allocated__gte=it.quantity
-                ).update(allocated=F('allocated') - it.quantity)
+            lock_products(lines)
+            # Lines whose allocation is already gone are skipped (retries)
+            apply_move('release', lines, order=self)
 
+            self._invalidate_product_cards(lines)
             self.inventory_reserved = False
-            self.save(update_fields=['inventory_reserved'])
+            self.reserved_until = None
+            self.save(update_fields=['inventory_reserved', 'reserved_until'])
 
 
 class OrderItem(models.Model):
@@ -205,3 +284,67 @@ class OrderItem(models.Model):
     @property
     def subtotal(self):
         return self.price * self.quantity
+
+
+class OrderEmail(models.Model):
+    """
+    Outbox for order notifications. Rows are written inside the order's
+    transaction and sent after commit by orders.notifications.
+    """
+    CONFIRMATION = 'confirmation'
+    CANCELLED = 'cancelled'
+    KIND_CHOICES = [
+        (CONFIRMATION, 'Order confirmation'),
+        (CANCELLED, 'Order cancelled'),
+    ]
+
+    order = models.ForeignKey(Order, related_name='emails', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    recipient = models.EmailField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # None once sent or given up on
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            # Unsent mail, for the sender's batches
+            models.Index(
+                fields=['next_attempt_at'], name='order_email_pending',
+                condition=Q(sent_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for order {self.order_id} to {self.recipient}"
+
+
+class PaymentEvent(models.Model):
+    """
+    Raw Razorpay webhook deliveries, one row per event id, so a redelivery
+    is dropped on insert. Processed in order per local order by
+    orders.webhooks.
+    """
+    event_id = models.CharField(max_length=64, unique=True)
+    event = models.CharField(max_length=64)
+    # Not a FK: the notes may name an order that doesn't exist (any more)
+    local_order_id = models.BigIntegerField(null=True, blank=True)
+    payload = models.JSONField()
+    created_at = models.DateTimeField()  # Razorpay's event time
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    outcome = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        indexes = [
+            # Unprocessed events, per order in event order
+            models.Index(
+                fields=['local_order_id', 'created_at'], name='payment_event_pending',
+                condition=Q(processed_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event} {self.event_id} (order {self.local_order_id})"
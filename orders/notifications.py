@@ -0,0 +1,139 @@
+"""
+Order emails, sent outside the request.
+
+Views call queue_order_email() inside their transaction. That only inserts
+an OrderEmail row, and on commit a Celery task is kicked to send it, so
+checkout no longer waits on (or holds locks through) the SMTP handshake.
+An order that rolls back never mails anyone.
+
+send_pending() claims a batch of unsent rows in a short transaction (a
+lease, see _claim()), sends them over one SMTP connection with no
+transaction open, then records the results in a second short transaction.
+A failed message is retried with exponential backoff (RETRY_BASE seconds,
+doubling) until MAX_ATTEMPTS; Celery beat picks up the retries.
+"""
+
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import OrderEmail
+
+EMAIL_BATCH = 50
+MAX_ATTEMPTS = 6
+RETRY_BASE = 30
+# How long a claimed batch is kept from other senders
+LEASE = timedelta(minutes=5)
+
+# kind -> (subject, template)
+TEMPLATES = {
+    OrderEmail.CONFIRMATION: ("Photon Cure - Order #{id} Confirmation", 'orders/email/order_confirmation.txt'),
+    OrderEmail.CANCELLED: ("Photon Cure - Order #{id} Cancelled", 'orders/email/order_cancelled.txt'),
+}
+
+
+def queue_order_email(order, kind, recipient):
+    """Adds an email to the outbox; it is sent once the current transaction commits."""
+    OrderEmail.objects.create(order=order, kind=kind, recipient=recipient)
+    transaction.on_commit(_kick_sender)
+
+
+def _kick_sender():
+    from .tasks import send_order_emails_task
+
+    try:
+        send_order_emails_task.delay()
+    except Exception as e:
+        # Broker down: the row stays queued for the beat schedule
+        print(f"❌ Could not queue order email task: {e}")
+
+
+def _message(email, connection):
+    order = email.order
+    subject, template = TEMPLATES[email.kind]
+    context = {'order': order, 'expected_start': None, 'expected_end': None}
+    if email.kind == OrderEmail.CONFIRMATION:
+        context['expected_start'], context['expected_end'] = order.expected_delivery_range
+    else:
+        context['user'] = order.user
+    return EmailMessage(
+        subject.format(id=order.id), render_to_string(template, context),
+        settings.DEFAULT_FROM_EMAIL, [email.recipient], connection=connection,
+    )
+
+
+def _retry_at(attempts, now):
+    if attempts >= MAX_ATTEMPTS:
+        return None
+    return now + timedelta(seconds=RETRY_BASE * 2 ** (attempts - 1))
+
+
+def _claim(batch_size):
+    """
+    Leases up to batch_size due emails to this worker and returns their ids.
+    The attempt is counted and next_attempt_at pushed past LEASE up front, so
+    other senders skip the rows while we talk to SMTP outside any transaction;
+    if we die, the rows come due again when the lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OrderEmail.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, next_attempt_at__lte=now, attempts__lt=MAX_ATTEMPTS)
+            .order_by('next_attempt_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        OrderEmail.objects.filter(id__in=ids).update(attempts=F('attempts') + 1, next_attempt_at=now + LEASE)
+    return ids
+
+
+def send_pending(batch_size=EMAIL_BATCH):
+    """
+    Sends up to batch_size due emails over one SMTP connection.
+    Returns (sent, failed).
+    """
+    ids = _claim(batch_size)
+    if not ids:
+        return 0, 0
+    emails = list(OrderEmail.objects.filter(id__in=ids).select_related('order__user').order_by('next_attempt_at', 'id'))
+    prefetch_related_objects([email.order for email in emails], 'items__product')
+
+    errors = {}
+    connection = get_connection()
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError) as e:
+        errors = {email.id: str(e) for email in emails}
+    else:
+        try:
+            for email in emails:
+                try:
+                    _message(email, connection).send()
+                except (smtplib.SMTPException, OSError) as e:
+                    errors[email.id] = str(e)
+                    if isinstance(e, smtplib.SMTPServerDisconnected):
+                        connection.close()
+                        try:
+                            connection.open()
+                        except (smtplib.SMTPException, OSError):
+                            pass  # the next send reconnects or fails and is retried
+        finally:
+            connection.close()
+
+    now = timezone.now()
+    for email in emails:
+        if email.id in errors:
+            email.last_error = errors[email.id]
+            email.next_attempt_at = _retry_at(email.attempts, now)
+        else:
+            email.sent_at = now
+            email.next_attempt_at = None
+    OrderEmail.objects.bulk_update(emails, ['last_error', 'next_attempt_at', 'sent_at'])
+
+    return len(emails) - len(errors), len(errors)
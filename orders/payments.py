@@ -0,0 +1,187 @@
+"""
+Payment gateway, one per process.
+
+get_gateway() returns a RazorpayGateway built once per process, instead of
+a razorpay.Client per call. Its requests.Session keeps connections to the
+API alive (no TLS handshake per checkout), every request has connect/read
+timeouts, and urllib3 retries with backoff:
+  - failed connects, for any call (nothing reached Razorpay yet);
+  - read errors and 502/503/504, only for idempotent GETs (fetch_payment).
+Order creation and refunds are never resent after the request went out.
+
+Every call records its count, errors and total latency in the cache (see
+gateway_stats()). settings.PAYMENT_GATEWAY = 'fake' swaps in FakeGateway,
+which needs no network and keeps the calls it got, for tests and local
+development.
+"""
+
+import hashlib
+import hmac
+import itertools
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+STATS_PREFIX = 'payments:gateway'
+OPERATIONS = ('create_order', 'refund', 'fetch_payment')
+
+
+class PaymentGatewayError(Exception):
+    pass
+
+
+def _incr(key, delta):
+    if not delta:
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, timeout=None)
+
+
+def _record(operation, started, failed):
+    _incr(f'{STATS_PREFIX}:{operation}:calls', 1)
+    _incr(f'{STATS_PREFIX}:{operation}:ms', int((time.monotonic() - started) * 1000))
+    if failed:
+        _incr(f'{STATS_PREFIX}:{operation}:errors', 1)
+
+
+def gateway_stats():
+    """{operation: {'calls', 'errors', 'avg_ms'}} since the counters were created."""
+    keys = [f'{STATS_PREFIX}:{op}:{field}' for op in OPERATIONS for field in ('calls', 'errors', 'ms')]
+    values = cache.get_many(keys)
+    stats = {}
+    for op in OPERATIONS:
+        calls = values.get(f'{STATS_PREFIX}:{op}:calls', 0)
+        stats[op] = {
+            'calls': calls,
+            'errors': values.get(f'{STATS_PREFIX}:{op}:errors', 0),
+            'avg_ms': values.get(f'{STATS_PREFIX}:{op}:ms', 0) // calls if calls else 0,
+        }
+    return stats
+
+
+def sign(secret, *parts):
+    return hmac.new(secret.encode(), '|'.join(parts).encode(), hashlib.sha256).hexdigest()
+
+
+class _TimeoutAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default (connect, read) timeout."""
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class RazorpayGateway:
+
+    def __init__(self, key_id, key_secret):
+        import razorpay
+
+        self.key_secret = key_secret
+        retry = Retry(
+            total=settings.RAZORPAY_MAX_RETRIES,
+            connect=settings.RAZORPAY_MAX_RETRIES,
+            read=settings.RAZORPAY_MAX_RETRIES,
+            status=settings.RAZORPAY_MAX_RETRIES,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        session = requests.Session()
+        session.mount('https://', _TimeoutAdapter(
+            timeout=(settings.RAZORPAY_CONNECT_TIMEOUT, settings.RAZORPAY_READ_TIMEOUT),
+            pool_maxsize=settings.RAZORPAY_POOL_SIZE,
+            max_retries=retry,
+        ))
+        self.client = razorpay.Client(session=session, auth=(key_id, key_secret))
+        self._errors = (requests.RequestException, razorpay.errors.BadRequestError,
+                        razorpay.errors.GatewayError, razorpay.errors.ServerError)
+
+    def _call(self, operation, func, *args, **kwargs):
+        started, failed = time.monotonic(), True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        except self._errors as e:
+            raise PaymentGatewayError(f"Razorpay {operation} failed: {e}") from e
+        finally:
+            _record(operation, started, failed)
+
+    def create_order(self, amount, notes=None, currency='INR'):
+        """Auto-capture order for amount (paise); returns Razorpay's order dict."""
+        data = {'amount': amount, 'currency': currency, 'payment_capture': '1'}
+        if notes:
+            data['notes'] = notes
+        return self._call('create_order', self.client.order.create, data=data)
+
+    def refund(self, payment_id, amount):
+        return self._call('refund', self.client.payment.refund, payment_id, {'amount': amount})
+
+    def fetch_payment(self, payment_id):
+        return self._call('fetch_payment', self.client.payment.fetch, payment_id)
+
+    def verify_payment(self, order_id, payment_id, signature):
+        """Checks the checkout handler's razorpay_signature."""
+        expected = sign(self.key_secret, order_id or '', payment_id or '')
+        return hmac.compare_digest(expected, signature or '')
+
+    def verify_webhook(self, body, signature):
+        """Checks X-Razorpay-Signature against the raw request body."""
+        secret = settings.RAZORPAY_WEBHOOK_SECRET
+        if not secret:
+            return False
+        expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or '')
+
+
+class FakeGateway(RazorpayGateway):
+    """Offline stand-in: ids are made up, calls are kept in self.calls."""
+
+    def __init__(self, key_secret='fake-secret'):
+        self.key_secret = key_secret
+        self.calls = []
+        self._ids = itertools.count(1)
+
+    def _call(self, operation, result):
+        started = time.monotonic()
+        self.calls.append((operation, result))
+        _record(operation, started, False)
+        return result
+
+    def create_order(self, amount, notes=None, currency='INR'):
+        order = {'id': f'order_fake{next(self._ids)}', 'amount': amount, 'currency': currency,
+                 'notes': notes or {}, 'status': 'created'}
+        return self._call('create_order', order)
+
+    def refund(self, payment_id, amount):
+        return self._call('refund', {'id': f'rfnd_fake{next(self._ids)}', 'payment_id': payment_id, 'amount': amount})
+
+    def fetch_payment(self, payment_id):
+        return self._call('fetch_payment', {'id': payment_id, 'status': 'captured'})
+
+
+_gateway = None
+
+
+def get_gateway():
+    global _gateway
+    name = settings.PAYMENT_GATEWAY
+    if _gateway is None or _gateway[0] != name:
+        if name == 'fake':
+            gateway = FakeGateway(settings.RAZORPAY_KEY_SECRET)
+        else:
+            gateway = RazorpayGateway(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
+        _gateway = (name, gateway)
+    return _gateway[1]
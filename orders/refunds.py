@@ -0,0 +1,98 @@
+"""
+Refunds for orders that were paid but can't be fulfilled.
+
+queue_refund() runs inside the transaction that fails the order, usually
+with the order row locked. It only records the request on the order
+(refund_requested_at) and, on commit, kicks a Celery task that calls
+Razorpay. No lock or transaction is held while the gateway answers, and an
+order that rolls back refunds nothing. refund_id is set once Razorpay
+accepted the refund; requests still without one are retried by
+refund_pending() from Celery beat. refund_order() claims the order before
+calling the gateway, so two workers never send the same refund.
+"""
+
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Order
+from .payments import PaymentGatewayError, get_gateway
+
+# Leave fresh requests to the task their own commit kicked
+REFUND_GRACE = timedelta(minutes=5)
+REFUND_BATCH = 50
+
+
+def queue_refund(order, payment_id=None):
+    """
+    Records that order's payment (payment_id if the order has none yet) must
+    be refunded; it is, once the current transaction commits. A refund that
+    was already requested isn't requested again.
+    """
+    if order.refund_requested_at:
+        return
+    update_fields = ['refund_requested_at']
+    if payment_id and not order.payment_id:
+        order.payment_id = payment_id
+        update_fields.append('payment_id')
+    order.refund_requested_at = timezone.now()
+    order.save(update_fields=update_fields)
+    transaction.on_commit(lambda: _kick(order.id))
+
+
+def _kick(order_id):
+    from .tasks import refund_order_task
+
+    try:
+        refund_order_task.delay(order_id)
+    except Exception as e:
+        # Broker down: refund_pending() gets to it from beat
+        print(f"❌ Could not queue refund for order {order_id}: {e}")
+
+
+def refund_order(order_id):
+    """
+    Refunds the order's payment in full if a refund is still owed. Returns
+    True if this call refunded it. Raises PaymentGatewayError.
+
+    The order is claimed first: one conditional UPDATE pushes a due
+    refund_requested_at REFUND_GRACE ahead (far longer than the gateway
+    timeouts), so the on-commit task and the beat sweep can't both call
+    Razorpay. A failed call makes it due again; if we die mid-call, it comes
+    due when the lease runs out.
+    """
+    now = timezone.now()
+    claimed = (
+        Order.objects
+        .filter(id=order_id, refund_requested_at__lte=now, refund_id__isnull=True, payment_id__isnull=False)
+        .update(refund_requested_at=now + REFUND_GRACE)
+    )
+    if not claimed:
+        return False  # nothing owed, or another worker has it
+    payment_id, total_price = Order.objects.values_list('payment_id', 'total_price').get(id=order_id)
+    try:
+        refund = get_gateway().refund(payment_id, int(total_price * 100))
+    except PaymentGatewayError:
+        Order.objects.filter(id=order_id, refund_id__isnull=True).update(refund_requested_at=timezone.now())
+        raise
+    Order.objects.filter(id=order_id, refund_id__isnull=True).update(refund_id=refund['id'])
+    return True
+
+
+def refund_pending(batch_size=REFUND_BATCH):
+    """Retries refunds requested a while ago and still owed. Returns (refunded, failed)."""
+    order_ids = (
+        Order.objects
+        .filter(refund_requested_at__lt=timezone.now() - REFUND_GRACE, refund_id__isnull=True)
+        .order_by('refund_requested_at')
+        .values_list('id', flat=True)[:batch_size]
+    )
+    refunded = failed = 0
+    for order_id in list(order_ids):
+        try:
+            refunded += refund_order(order_id)
+        except PaymentGatewayError as e:
+            print(f"❌ Refund for order {order_id} failed: {e}")
+            failed += 1
+    return refunded, failed
@@ -0,0 +1,95 @@
+from celery import shared_task
+from django.conf import settings
+
+from . import admission
+from .inventory import SWEEP_BATCH, release_expired_reservations
+from .notifications import EMAIL_BATCH, send_pending
+from .refunds import refund_order, refund_pending
+from .webhooks import process_order_events, process_pending
+
+
+@shared_task
+def release_expired_reservations_task(max_batches=20):
+    orders = units = 0
+    for _ in range(max_batches):
+        stats = release_expired_reservations()
+        orders += stats['orders']
+        units += stats['units']
+        if stats['mismatches']:
+            print(
+                f"❌ {stats['mismatches']} product(s) had less allocated stock than expired orders held; "
+                f"left order(s) {', '.join(map(str, stats['skipped']))} reserved for reconcile"
+            )
+        if stats['orders'] + len(stats['skipped']) < SWEEP_BATCH:
+            break
+    if orders:
+        print(f"✅ Released {units} reserved unit(s) from {orders} expired order(s)")
+
+
+@shared_task
+def reconcile_stock_gate_task():
+    """Resets the checkout gate's Redis counters from Postgres (STOCK_GATE only)."""
+    if not settings.STOCK_GATE:
+        return
+    checked, drifted = admission.reconcile()
+    if not checked:
+        # Empty Redis (restart, flush): load every product up front
+        print(f"✅ Stock gate: rebuilt {admission.rebuild()} counter(s) from Postgres")
+    elif drifted:
+        print(f"✅ Stock gate: reset {drifted} of {checked} counter(s)")
+
+
+@shared_task
+def send_order_emails_task(max_batches=10):
+    """Sends queued order emails; kicked on commit and run by beat for retries."""
+    sent = failed = 0
+    for _ in range(max_batches):
+        batch_sent, batch_failed = send_pending()
+        sent += batch_sent
+        failed += batch_failed
+        if batch_sent + batch_failed < EMAIL_BATCH:
+            break
+    if sent:
+        print(f"✅ Sent {sent} order email(s)")
+    if failed:
+        print(f"❌ {failed} order email(s) failed, will retry")
+
+
+@shared_task(bind=True, max_retries=5)
+def process_payment_events_task(self, local_order_id):
+    """Applies a local order's Razorpay webhook events; kicked when one arrives."""
+    try:
+        processed = process_order_events(local_order_id)
+    except Exception as e:
+        print(f"❌ Payment events for order {local_order_id} failed: {e}")
+        raise self.retry(exc=e, countdown=5 * 2 ** self.request.retries)
+    if processed:
+        print(f"✅ Processed {processed} payment event(s) for order {local_order_id}")
+
+
+@shared_task
+def process_pending_payment_events_task():
+    processed = process_pending()
+    if processed:
+        print(f"✅ Processed {processed} left-over payment event(s)")
+
+
+@shared_task(bind=True, max_retries=5)
+def refund_order_task(self, order_id):
+    """Refunds a paid order that couldn't be fulfilled; kicked when the refund is queued."""
+    try:
+        refunded = refund_order(order_id)
+    except Exception as e:
+        print(f"❌ Refund for order {order_id} failed: {e}")
+        raise self.retry(exc=e, countdown=5 * 2 ** self.request.retries)
+    if refunded:
+        print(f"✅ Refunded order {order_id}")
+
+
+@shared_task
+def refund_pending_orders_task():
+    refunded, failed = refund_pending()
+    if refunded:
+        print(f"✅ Refunded {refunded} left-over order(s)")
+    if failed:
+        print(f"❌ {failed} refund(s) failed, will retry")
@@ -1,3 +1,520 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import smtplib
+from datetime import timedelta
+from decimal import Decimal
+from unittest import SkipTest, mock
 
-# Create your tests here.
+import redis
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from cart.models import CartItem
+from products.ledger import adjust_stock, compact, with_live_stock
+from products.models import InventoryMovement, Product, StockShard
+from products.shards import rebalance, set_shard_count
+from . import admission
+from .inventory import release_expired_reservations
+from .models import InsufficientStock, Order, OrderCancelled, OrderEmail, OrderItem, PaymentEvent
+from .notifications import queue_order_email, send_pending
+from .payments import FakeGateway, gateway_stats, get_gateway, sign
+from .refunds import refund_order
+from .views import _checkout_cart
+from .webhooks import process_order_events
+
+User = get_user_model()
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class InventoryWorkflowTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', email='buyer@example.com', password='pw')
+        cls.products = [
+            Product.objects.create(name=f'Item {i}', description='', price=Decimal('10.00'), stock=5)
+            for i in range(6)
+        ]
+
+    def make_order(self, quantities):
+        order = Order.objects.create(user=self.user, total_price=0, address='x', phone='1', email='b@example.com')
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=qty)
+            for product, qty in quantities
+        ])
+        return order
+
+    def stock(self):
+        """Live (stock, allocated) per product name: snapshot + pending movements."""
+        compact()
+        return {
+            p.name: (p.stock, p.allocated)
+            for p in Product.objects.filter(id__in=[p.id for p in self.products])
+        }
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as ctx:
+            func()
+        return len(ctx.captured_queries)
+
+    def test_round_trips_do_not_grow_with_order_size(self):
+        small = self.make_order([(self.products[0], 1)])
+        large = self.make_order([(p, 1) for p in self.products[1:]])
+        for method in ('reserve_inventory', 'confirm_inventory'):
+            counts = [self.count_queries(getattr(order, method)) for order in (small, large)]
+            self.assertEqual(counts[0], counts[1], method)
+
+    def test_reserve_confirm_release(self):
+        a, b = self.products[:2]
+        order = self.make_order([(a, 2), (b, 1)])
+        order.reserve_inventory()
+        self.assertEqual(self.stock()['Item 0'], (5, 2))
+
+        order.release_inventory()
+        self.assertEqual(self.stock()['Item 0'], (5, 0))
+
+        order.reserve_inventory()
+        order.confirm_inventory()
+        self.assertEqual((self.stock()['Item 0'], self.stock()['Item 1']), ((3, 0), (4, 0)))
+
+    def test_failed_reservation_reports_lines_and_changes_nothing(self):
+        a, b = self.products[:2]
+        Product.objects.filter(id=b.id).update(allocated=5)
+        order = self.make_order([(a, 2), (b, 1)])
+        with self.assertRaisesMessage(InsufficientStock, 'Item 1 just ran out'):
+            order.reserve_inventory()
+        self.assertEqual(self.stock()['Item 0'], (5, 0))
+        order.refresh_from_db()
+        self.assertFalse(order.inventory_reserved)
+
+    def test_sweeper_releases_expired_unpaid_reservations(self):
+        a, b = self.products[:2]
+        expired = self.make_order([(a, 2), (b, 1)])
+        other = self.make_order([(a, 1)])
+        paid = self.make_order([(b, 1)])
+        live = self.make_order([(a, 1)])
+        for order in (expired, other, paid, live):
+            order.reserve_inventory()
+        past = timezone.now() - timedelta(minutes=1)
+        Order.objects.filter(id__in=[expired.id, other.id, paid.id]).update(reserved_until=past)
+        Order.objects.filter(id=paid.id).update(payment_id='pay_123')
+
+        stats = release_expired_reservations()
+
+        self.assertEqual((stats['orders'], stats['units'], stats['products']), (2, 4, 2))
+        self.assertEqual(self.stock()['Item 0'], (5, 1))   # live order still holds 1
+        self.assertEqual(self.stock()['Item 1'], (5, 1))   # paid order still holds 1
+        expired.refresh_from_db()
+        self.assertEqual((expired.status, expired.inventory_reserved), ('Failed', False))
+
+    def test_sweeper_records_movements_per_order(self):
+        a, b = self.products[:2]
+        first = self.make_order([(a, 2), (b, 1)])
+        second = self.make_order([(a, 1)])
+        for order in (first, second):
+            order.reserve_inventory()
+        Order.objects.filter(id__in=[first.id, second.id]).update(reserved_until=timezone.now() - timedelta(minutes=1))
+
+        release_expired_reservations()
+
+        self.assertEqual(
+            sorted(
+                InventoryMovement.objects.filter(reason=InventoryMovement.EXPIRE)
+                .values_list('order_id', 'product_id', 'allocated_delta')
+            ),
+            sorted([(first.id, a.id, -2), (first.id, b.id, -1), (second.id, a.id, -1)]),
+        )
+
+    def test_sweeper_leaves_mismatched_orders_reserved(self):
+        a, b = self.products[:2]
+        mismatched = self.make_order([(a, 2), (b, 1)])
+        clean = self.make_order([(b, 1)])
+        for order in (mismatched, clean):
+            order.reserve_inventory()
+        Order.objects.filter(id__in=[mismatched.id, clean.id]).update(reserved_until=timezone.now() - timedelta(minutes=1))
+        # Someone released a's allocation behind the order's back
+        compact()
+        Product.objects.filter(id=a.id).update(allocated=1)
+
+        stats = release_expired_reservations()
+
+        self.assertEqual((stats['orders'], stats['mismatches'], stats['skipped']), (1, 1, [mismatched.id]))
+        self.assertEqual(self.stock()['Item 0'], (5, 1))
+        self.assertEqual(self.stock()['Item 1'], (5, 1))   # only the clean order's unit went back
+        mismatched.refresh_from_db()
+        clean.refresh_from_db()
+        self.assertEqual((mismatched.status, mismatched.inventory_reserved), ('Pending', True))
+        self.assertEqual((clean.status, clean.inventory_reserved), ('Failed', False))
+
+    def test_late_payment_reserves_again(self):
+        order = self.make_order([(self.products[0], 2)])
+        order.reserve_inventory()
+        Order.objects.filter(id=order.id).update(reserved_until=timezone.now() - timedelta(minutes=1))
+        release_expired_reservations()
+
+        order.refresh_from_db()
+        order.confirm_inventory()
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Pending')
+        self.assertEqual(self.stock()['Item 0'], (3, 0))
+
+    def test_ledger_is_read_live_and_compacted(self):
+        a = self.products[0]
+        order = self.make_order([(a, 2)])
+        order.reserve_inventory()
+
+        snapshot = Product.objects.get(id=a.id)
+        self.assertEqual((snapshot.stock, snapshot.allocated), (5, 0))
+        self.assertEqual(with_live_stock(Product.objects.filter(id=a.id)).get().available, 3)
+        self.assertEqual(order.inventory_movements.get().reason, InventoryMovement.RESERVE)
+
+        self.assertEqual(compact(), (1, 1))
+        self.assertEqual(self.stock()['Item 0'], (5, 2))
+        self.assertEqual(compact(), (0, 0))
+
+    def test_adjustment_cannot_go_below_allocated(self):
+        a = self.products[0]
+        self.make_order([(a, 4)]).reserve_inventory()
+        self.assertFalse(adjust_stock(a.id, -2))
+        self.assertTrue(adjust_stock(a.id, -1))
+        self.assertEqual(self.stock()['Item 0'], (4, 4))
+
+    def shard_total(self, product):
+        return sum(StockShard.objects.filter(product=product).values_list('available', flat=True))
+
+    def test_sharded_product_takes_units_from_shards(self):
+        a = self.products[0]
+        set_shard_count(a.id, 4)
+        self.assertEqual(sorted(StockShard.objects.filter(product=a).values_list('available', flat=True)), [1, 1, 1, 2])
+
+        # 3 doesn't fit in any one shard: falls back to taking from several
+        order = self.make_order([(a, 3)])
+        order.reserve_inventory()
+        self.assertEqual(self.shard_total(a), 2)
+        product = Product.objects.get(id=a.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(product.available, 2)
+            self.assertTrue(product.is_in_stock())
+        self.assertEqual(self.stock()['Item 0'], (5, 3))
+
+        with self.assertRaisesMessage(InsufficientStock, 'Item 0 just ran out'):
+            self.make_order([(a, 3)]).reserve_inventory()
+        self.assertEqual(self.shard_total(a), 2)
+
+        order.release_inventory()
+        self.assertEqual(self.shard_total(a), 5)
+        self.assertEqual(rebalance(a.id), 0)
+
+    def test_rebalance_corrects_drifted_shards(self):
+        a = self.products[0]
+        set_shard_count(a.id, 2)
+        StockShard.objects.filter(product=a, shard=0).update(available=0)
+        self.assertEqual(rebalance(a.id), -3)
+        self.assertEqual(sorted(StockShard.objects.filter(product=a).values_list('available', flat=True)), [2, 3])
+
+        set_shard_count(a.id, 0)
+        self.assertFalse(StockShard.objects.filter(product=a).exists())
+        self.assertEqual(Product.objects.get(id=a.id).available, 5)
+
+
+# Cart snapshot, order + lines, reservation; must not grow with the cart
+CHECKOUT_QUERY_BUDGET = 11
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CheckoutQueryBudgetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = [
+            Product.objects.create(name=f'Item {i}', description='', price=Decimal('10.00'), stock=5)
+            for i in range(8)
+        ]
+        cls.small = User.objects.create_user('small', email='small@example.com', password='pw')
+        cls.large = User.objects.create_user('large', email='large@example.com', password='pw')
+        CartItem.objects.create(user=cls.small, product=cls.products[0], quantity=1)
+        CartItem.objects.bulk_create([CartItem(user=cls.large, product=p, quantity=2) for p in cls.products])
+
+    def place(self, user):
+        cart = _checkout_cart(user)
+        order = Order.from_cart(user, cart, address='x', phone='1', email='b@example.com')
+        order.reserve_inventory()
+        return order
+
+    def test_checkout_stays_within_query_budget(self):
+        counts = []
+        for user in (self.small, self.large):
+            with CaptureQueriesContext(connection) as ctx:
+                order = self.place(user)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertLessEqual(counts[1], CHECKOUT_QUERY_BUDGET)
+
+        self.assertEqual(order.total_price, Decimal('160.00'))
+        self.assertEqual(order.items.count(), 8)
+        self.assertTrue(order.inventory_reserved)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class OrderEmailTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('mailer', email='mailer@example.com', password='pw')
+        product = Product.objects.create(name='Lamp', description='', price=Decimal('10.00'), stock=5)
+        cls.order = Order.objects.create(user=cls.user, total_price=20, address='x', phone='1', email='m@example.com')
+        OrderItem.objects.create(order=cls.order, product=product, price=product.price, quantity=2)
+
+    def test_emails_wait_for_commit_and_go_out_in_one_batch(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            queue_order_email(self.order, OrderEmail.CONFIRMATION, 'm@example.com')
+            queue_order_email(self.order, OrderEmail.CANCELLED, 'admin@example.com')
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(send_pending(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('Lamp (x2)', mail.outbox[0].body)
+        self.assertEqual(send_pending(), (0, 0))
+
+    def test_failed_email_is_retried_after_backoff(self):
+        email = OrderEmail.objects.create(order=self.order, kind=OrderEmail.CONFIRMATION, recipient='m@example.com')
+        with mock.patch('django.core.mail.EmailMessage.send', side_effect=smtplib.SMTPException('mailbox full')):
+            self.assertEqual(send_pending(), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual((email.attempts, email.last_error, email.sent_at), (1, 'mailbox full', None))
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(send_pending(), (0, 0))   # not due yet
+
+        OrderEmail.objects.filter(id=email.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(send_pending(), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual((email.attempts, email.next_attempt_at), (2, None))
+
+    def test_rolled_back_order_sends_nothing(self):
+        try:
+            with transaction.atomic():
+                queue_order_email(self.order, OrderEmail.CONFIRMATION, 'm@example.com')
+                raise InsufficientStock('Lamp just ran out')
+        except InsufficientStock:
+            pass
+        self.assertEqual(send_pending(), (0, 0))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, PAYMENT_GATEWAY='fake')
+class PaymentGatewayTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('payer', email='payer@example.com', password='pw')
+        cls.product = Product.objects.create(name='Lamp', description='', price=Decimal('10.00'), stock=5)
+
+    def test_gateway_is_shared_and_verifies_signatures(self):
+        gateway = get_gateway()
+        self.assertIsInstance(gateway, FakeGateway)
+        self.assertIs(get_gateway(), gateway)
+        good = sign(gateway.key_secret, 'order_1', 'pay_1')
+        self.assertTrue(gateway.verify_payment('order_1', 'pay_1', good))
+        self.assertFalse(gateway.verify_payment('order_1', 'pay_2', good))
+
+    def test_reserved_checkout_runs_offline(self):
+        CartItem.objects.create(user=self.user, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+        calls_before = gateway_stats()['create_order']['calls']
+
+        response = self.client.post(
+            reverse('orders:create_razorpay_order_reserved'),
+            data=json.dumps({'name': 'P', 'address': 'x', 'phone': '1', 'email': 'p@example.com'}),
+            content_type='application/json',
+        )
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['amount'], 2000)
+        operation, rzp_order = get_gateway().calls[-1]
+        self.assertEqual((operation, rzp_order['notes']), ('create_order', {'local_order_id': str(body['local_order_id'])}))
+        self.assertTrue(Order.objects.get(id=body['local_order_id']).inventory_reserved)
+        self.assertEqual(gateway_stats()['create_order']['calls'], calls_before + 1)
+
+    def test_out_of_stock_payment_is_refunded_after_commit(self):
+        order = Order.objects.create(user=self.user, total_price=100, address='x', phone='1', email='p@example.com')
+        OrderItem.objects.create(order=order, product=self.product, price=self.product.price, quantity=10)
+        def refunds():
+            return [call for call in get_gateway().calls if call[0] == 'refund']
+
+        refunds_before = len(refunds())
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            with self.assertRaises(InsufficientStock):
+                order.confirm_payment('pay_late')
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(refunds()), refunds_before)   # nothing sent inside the transaction
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'Failed')
+        self.assertIsNotNone(order.refund_requested_at)
+
+        # What the kicked task runs; a sweep during the gateway call finds it claimed
+        gateway, during_call = get_gateway(), []
+        send_refund = gateway.refund
+
+        def refund_with_concurrent_sweep(payment_id, amount):
+            during_call.append(refund_order(order.id))
+            return send_refund(payment_id, amount)
+
+        with mock.patch.object(gateway, 'refund', side_effect=refund_with_concurrent_sweep):
+            self.assertTrue(refund_order(order.id))
+        self.assertEqual(during_call, [False])
+        self.assertEqual(len(refunds()), refunds_before + 1)
+        self.assertEqual(refunds()[-1][1]['payment_id'], 'pay_late')
+        order.refresh_from_db()
+        self.assertTrue(order.refund_id.startswith('rfnd_fake'))
+        self.assertFalse(refund_order(order.id))
+
+
+@override_settings(CACHES=LOCMEM_CACHE, PAYMENT_GATEWAY='fake', RAZORPAY_WEBHOOK_SECRET='whsec')
+class RazorpayWebhookTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('hooked', email='hooked@example.com', password='pw')
+        cls.product = Product.objects.create(name='Lamp', description='', price=Decimal('10.00'), stock=5)
+
+    def make_order(self):
+        order = Order.objects.create(user=self.user, total_price=20, address='x', phone='1', email='h@example.com')
+        OrderItem.objects.create(order=order, product=self.product, price=self.product.price, quantity=2)
+        order.reserve_inventory()
+        return order
+
+    def deliver(self, event_id, event, order, created_at, secret='whsec'):
+        body = json.dumps({
+            'event': event,
+            'created_at': created_at,
+            'payload': {'payment': {'entity': {'id': f'pay_{event_id}', 'notes': {'local_order_id': str(order.id)}}}},
+        }).encode()
+        return self.client.post(
+            reverse('orders:razorpay_webhook'), data=body, content_type='application/json',
+            HTTP_X_RAZORPAY_SIGNATURE=hmac.new(secret.encode(), body, hashlib.sha256).hexdigest(),
+            HTTP_X_RAZORPAY_EVENT_ID=event_id,
+        )
+
+    def test_rejects_bad_signatures(self):
+        response = self.deliver('evt_bad', 'payment.captured', self.make_order(), 1, secret='wrong')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    def test_captured_event_finalizes_once_despite_redelivery(self):
+        order = self.make_order()
+        CartItem.objects.create(user=self.user, product=self.product, quantity=2)
+        for _ in range(2):
+            self.assertEqual(self.deliver('evt_1', 'payment.captured', order, 100).status_code, 200)
+        self.assertEqual(PaymentEvent.objects.count(), 1)
+
+        self.assertEqual(process_order_events(order.id), 1)
+        order.refresh_from_db()
+        self.assertEqual((order.payment_id, order.inventory_finalized), ('pay_evt_1', True))
+        self.assertEqual(OrderEmail.objects.filter(order=order).count(), 1)
+        self.assertFalse(CartItem.objects.filter(user=self.user).exists())
+        self.assertEqual(process_order_events(order.id), 0)
+
+    def test_capture_for_cancelled_order_queues_refund(self):
+        order = self.make_order()
+        order.mark_as_cancelled()
+        self.deliver('evt_c', 'payment.captured', order, 100)
+
+        process_order_events(order.id)
+        self.assertEqual(PaymentEvent.objects.get(event_id='evt_c').outcome, 'order cancelled, refund queued')
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.inventory_finalized, order.payment_id), ('Cancelled', False, 'pay_evt_c'))
+        self.assertIsNotNone(order.refund_requested_at)
+
+    def test_cancelled_order_is_refunded_not_sold(self):
+        order = self.make_order()
+        order.mark_as_cancelled()
+        with self.assertRaises(OrderCancelled):
+            order.confirm_payment('pay_after_cancel')
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.inventory_reserved, order.inventory_finalized), ('Cancelled', False, False))
+        self.assertIsNotNone(order.refund_requested_at)
+        self.assertEqual(with_live_stock(Product.objects.filter(id=self.product.id)).get().available, 5)
+
+    def test_events_apply_in_event_order(self):
+        order = self.make_order()
+        # Delivered out of order: the failure happened before the capture
+        self.deliver('evt_b', 'payment.captured', order, 200)
+        self.deliver('evt_a', 'payment.failed', order, 100)
+
+        process_order_events(order.id)
+        outcomes = list(PaymentEvent.objects.order_by('created_at').values_list('outcome', flat=True))
+        self.assertEqual(outcomes, ['recorded', 'finalized'])
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.inventory_finalized), ('Pending', True))
+
+    def test_failed_payment_keeps_the_reservation(self):
+        order = self.make_order()
+        self.deliver('evt_f', 'payment.failed', order, 100)
+        process_order_events(order.id)
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.inventory_reserved), ('Pending', True))
+        self.assertEqual(with_live_stock(Product.objects.filter(id=self.product.id)).get().available, 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, STOCK_GATE=True)
+class StockGateTests(TestCase):
+    """Runs against STOCK_GATE_REDIS_URL under its own key prefix."""
+
+    KEY_PREFIX = 'test:stock:gate:'
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            admission.get_redis().ping()
+        except redis.RedisError:
+            raise SkipTest('needs the stock gate Redis')
+        # reconcile() scans every counter under the prefix: keep off the real ones
+        cls.prefix_patch = mock.patch.object(admission, 'KEY_PREFIX', cls.KEY_PREFIX)
+        cls.prefix_patch.start()
+        cls.addClassCleanup(cls.prefix_patch.stop)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.a = Product.objects.create(name='Drop A', description='', price=Decimal('10.00'), stock=3)
+        cls.b = Product.objects.create(name='Drop B', description='', price=Decimal('10.00'), stock=1)
+
+    def setUp(self):
+        client = admission.get_redis()
+        stale = list(client.scan_iter(match=f'{self.KEY_PREFIX}*'))
+        if stale:
+            client.delete(*stale)
+
+    def counter(self, product):
+        return int(admission.get_redis().get(admission._key(product.id)))
+
+    def test_admits_all_or_nothing_and_primes_cold_counters(self):
+        taken, sold_out = admission.admit({self.a.id: 2, self.b.id: 1})
+        self.assertEqual((taken, sold_out), ({self.a.id: 2, self.b.id: 1}, None))
+        self.assertEqual((self.counter(self.a), self.counter(self.b)), (1, 0))
+
+        taken, sold_out = admission.admit({self.a.id: 1, self.b.id: 1})
+        self.assertEqual((taken, sold_out), ({}, self.b.id))
+        self.assertEqual(self.counter(self.a), 1)   # nothing taken from A either
+
+        admission.give_back({self.b.id: 1})
+        self.assertEqual(self.counter(self.b), 1)
+
+    def test_reconcile_resets_counters_from_postgres(self):
+        admission.admit({self.a.id: 3})
+        self.assertEqual(self.counter(self.a), 0)
+        checked, drifted = admission.reconcile()
+        self.assertGreaterEqual(checked, 1)
+        self.assertGreaterEqual(drifted, 1)
+        self.assertEqual(self.counter(self.a), 3)   # nothing was actually reserved
@@ -15,5 +15,6 @@ urlpatterns = [
     path('create_razorpay_order_reserved/', views.create_razorpay_order_reserved, name='create_razorpay_order_reserved'),
     path('razorpay_finalize_reserved/', views.razorpay_finalize_reserved, name='razorpay_finalize_reserved'),
     path('release_pending_order/', views.release_pending_order, name='release_pending_order'),
+    path('razorpay_webhook/', views.razorpay_webhook, name='razorpay_webhook'),
 
 ]
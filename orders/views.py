@@ -1,41 +1,45 @@
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect, get_object_or_404
 from .forms import CheckoutForm
-from cart.models import CartItem
-from .models import Order, OrderItem, InsufficientStock  # <- InsufficientStock used by reserved flow
-from django.core.mail import send_mail
+from .models import Order, OrderEmail, InsufficientStock, OrderCancelled  # <- used by reserved flow
 from django.conf import settings
-from django.template.loader import render_to_string
-import razorpay
 import json
 from django.http import JsonResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
-import hmac
-import hashlib
 from django.contrib import messages
 from .utils import get_delivery_range
 from products.models import Review, Product
 from django.db import transaction
 from django.urls import reverse
-from cart.utils import get_user_cart_total, get_user_cart
+from cart.utils import clear_user_cart
+from cart.services import cart_for
+from . import admission, webhooks
+from .notifications import queue_order_email
+from .refunds import queue_refund
+from .payments import PaymentGatewayError, get_gateway
+
+
+def _checkout_cart(user):
+    # Orders are built from CartItem rows: write any buffered cart changes first
+    service = cart_for(user)
+    service.flush()
+    return service.snapshot()
 
 
 @login_required
 def checkout(request):
     form = CheckoutForm()
-    total_price = get_user_cart_total(request.user)
+    cart = _checkout_cart(request.user)
 
     latest_order = Order.objects.filter(user=request.user).order_by('-order_date').first()
     delivery_range = get_delivery_range(latest_order) if latest_order else None
 
-    cart_items = get_user_cart(request.user)
-
     return render(request, 'cart/checkout.html', {
         'form': form,
         'razorpay_key_id': settings.RAZORPAY_KEY_ID,
-        'cart_total': total_price,
+        'cart_total': cart.total,
         'delivery_range': delivery_range,
-        'cart_items': cart_items,
+        'cart_items': cart.lines,
     })
 
 
@@ -50,19 +54,20 @@ def create_razorpay_order(request):
     Quick availability check, then create a Razorpay order with auto-capture.
     """
     if request.method == "POST":
-        cart_items = get_user_cart(request.user)
-        for item in cart_items:
+        cart = _checkout_cart(request.user)
+        for item in cart:
             if item.product.available < item.quantity:
                 return JsonResponse(
                     {'success': False, 'error': f"Insufficient stock for {item.product.name}"},
                     status=409
                 )
 
-        total_amount = int(get_user_cart_total(request.user) * 100)
+        total_amount = int(cart.total * 100)
 
-        client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-        order_data = {"amount": total_amount, "currency": "INR", "payment_capture": "1"}
-        razorpay_order = client.order.create(data=order_data)
+        try:
+            razorpay_order = get_gateway().create_order(total_amount)
+        except PaymentGatewayError:
+            return JsonResponse({'success': False, 'error': 'Payment service unavailable, please retry.'}, status=502)
 
         return JsonResponse({
             "success": True,
@@ -82,8 +87,8 @@ def razorpay_payment(request):
     """
     if request.method == 'POST':
         data = json.loads(request.body)
-        cart_items = get_user_cart(request.user)
-        total_price = get_user_cart_total(request.user)
+        cart = _checkout_cart(request.user)
+        total_price = cart.total
 
         name = data.get('name')
         address = data.get('address')
@@ -97,50 +102,28 @@ def razorpay_payment(request):
         razorpay_order_id = data.get('razorpay_order_id')
         razorpay_signature = data.get('razorpay_signature')
 
-        generated_signature = hmac.new(
-            key=bytes(settings.RAZORPAY_KEY_SECRET, 'utf-8'),
-            msg=bytes(razorpay_order_id + "|" + razorpay_payment_id, 'utf-8'),
-            digestmod=hashlib.sha256
-        ).hexdigest()
-
-        if generated_signature != razorpay_signature:
+        if not get_gateway().verify_payment(razorpay_order_id, razorpay_payment_id, razorpay_signature):
             return JsonResponse({'success': False, 'error': 'Payment verification failed'}, status=400)
 
-        order = Order.objects.create(
+        order = Order.from_cart(
+            request.user, cart,
             name=name, address=address, city=city, state=state, pincode=pincode,
-            phone=phone, email=email, total_price=total_price, status='Pending',
-            user=request.user, payment_id=razorpay_payment_id
+            phone=phone, email=email, payment_id=razorpay_payment_id
         )
 
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order, product=item.product, price=item.product.price, quantity=item.quantity
-            )
-
         try:
             order.reserve_inventory()
             order.confirm_inventory()
         except InsufficientStock as e:
-            try:
-                client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-                client.payment.refund(razorpay_payment_id, {"amount": int(total_price * 100)})
-            except Exception:
-                pass
+            queue_refund(order)
             order.mark_as_failed()
             return JsonResponse({'success': False, 'error': str(e)}, status=409)
 
         if email:
-            subject = f"Photon Cure - Order #{order.id} Confirmation"
-            message = render_to_string('orders/email/order_confirmation.txt', {
-                'order': order,
-                'cart_items': cart_items,
-                'expected_start': order.expected_delivery_range[0],
-                'expected_end': order.expected_delivery_range[1],
-            })
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [email])
+            queue_order_email(order, OrderEmail.CONFIRMATION, email)
 
         request.session['latest_order_id'] = order.id
-        CartItem.objects.filter(user=request.user).delete()
+        clear_user_cart(request.user)
 
         return JsonResponse({'success': True, 'redirect_url': reverse('orders:order_success')})
 
@@ -214,14 +197,7 @@ def cancel_order(request, order_id):
     if request.method == 'POST':
         if order.status == 'Pending':
             order.mark_as_cancelled()
-            subject = f"Photon Cure - Order #{order.id} Cancelled"
-            message = render_to_string('orders/email/order_cancelled.txt', {
-                'order': order,
-                'user': request.user,
-                'expected_start': None,
-                'expected_end': None,
-            })
-            send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [settings.DEFAULT_FROM_EMAIL])
+            queue_order_email(order, OrderEmail.CANCELLED, settings.DEFAULT_FROM_EMAIL)
             messages.success(request, f"Order #{order_id} has been cancelled.")
         else:
             messages.warning(request, f"Order #{order.id} cannot be cancelled as it is already {order.status}.")
@@ -237,7 +213,6 @@ def cancel_order(request, order_id):
 
 @csrf_exempt
 @login_required
-@transaction.atomic
 def create_razorpay_order_reserved(request):
     """
     Create a local Order + OrderItems and RESERVE inventory BEFORE opening Razorpay.
@@ -253,14 +228,36 @@ def create_razorpay_order_reserved(request):
     except Exception:
         data = {}
 
-    cart_items = list(get_user_cart(request.user))
-    if not cart_items:
+    cart = _checkout_cart(request.user)
+    if not cart:
         return JsonResponse({"success": False, "error": "Your cart is empty."}, status=400)
 
-    total_price = get_user_cart_total(request.user)
+    # Flash sales: turn sold-out carts away before opening a transaction
+    taken, sold_out = admission.admit({item.product_id: item.quantity for item in cart})
+    if sold_out:
+        return JsonResponse({'success': False, 'error': f"{cart.line(sold_out).product.name} just ran out"}, status=409)
+
+    try:
+        response = _open_reserved_order(request, data, cart)
+    except PaymentGatewayError:
+        # The reservation rolled back with the order
+        admission.give_back(taken)
+        return JsonResponse({'success': False, 'error': 'Payment service unavailable, please retry.'}, status=502)
+    except Exception:
+        admission.give_back(taken)
+        raise
+    if response.status_code != 200:
+        admission.give_back(taken)
+    return response
+
+
+@transaction.atomic
+def _open_reserved_order(request, data, cart):
+    total_price = cart.total
 
     # Create local order snapshot
-    order = Order.objects.create(
+    order = Order.from_cart(
+        request.user, cart,
         name=data.get('name') or "Guest",
         address=data.get('address') or "",
         city=data.get('city') or "",
@@ -268,17 +265,7 @@ def create_razorpay_order_reserved(request):
         pincode=data.get('pincode') or "",
         phone=data.get('phone') or "",
         email=data.get('email') or "",
-        total_price=total_price,
-        status='Pending',
-        user=request.user,
     )
-    for item in cart_items:
-        OrderItem.objects.create(
-            order=order,
-            product=item.product,
-            price=item.product.price,
-            quantity=item.quantity
-        )
 
     # Reserve under locks
     try:
@@ -288,13 +275,7 @@ def create_razorpay_order_reserved(request):
         return JsonResponse({'success': False, 'error': str(e)}, status=409)
 
     # With stock reserved, create Razorpay order with AUTO-CAPTURE
-    client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-    rzp_order = client.order.create(data={
-        "amount": int(total_price * 100),
-        "currency": "INR",
-        "payment_capture": "1",  # <— auto-capture
-        "notes": {"local_order_id": str(order.id)}
-    })
+    rzp_order = get_gateway().create_order(int(total_price * 100), notes={"local_order_id": str(order.id)})
 
     request.session['pending_order_id'] = order.id
 
@@ -335,48 +316,18 @@ def razorpay_finalize_reserved(request):
     razorpay_signature = data.get('razorpay_signature')
 
     # Verify signature
-    generated_signature = hmac.new(
-        key=bytes(settings.RAZORPAY_KEY_SECRET, 'utf-8'),
-        msg=bytes(f"{razorpay_order_id}|{razorpay_payment_id}", 'utf-8'),
-        digestmod=hashlib.sha256
-    ).hexdigest()
-
-    if generated_signature != razorpay_signature:
+    if not get_gateway().verify_payment(razorpay_order_id, razorpay_payment_id, razorpay_signature):
         order.release_inventory()
         order.mark_as_failed()
         return JsonResponse({'success': False, 'error': 'Payment verification failed'}, status=400)
 
-    # Persist payment id (already captured by Razorpay)
-    order.payment_id = razorpay_payment_id
-    order.save(update_fields=['payment_id'])
-
-    # Confirm (allocated -> sold)
+    # Persist payment id and confirm (allocated -> sold, cart cleared); the
+    # webhook may have done this already
     try:
-        order.confirm_inventory()
-    except InsufficientStock as e:
-        # Extremely unlikely; in this case refund and fail
-        try:
-            client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-            client.payment.refund(razorpay_payment_id, {"amount": int(order.total_price * 100)})
-        except Exception:
-            pass
-        order.mark_as_failed()
+        order.confirm_payment(razorpay_payment_id)
+    except (InsufficientStock, OrderCancelled) as e:
         return JsonResponse({'success': False, 'error': str(e)}, status=409)
 
-    # Email confirmation
-    if order.email:
-        subject = f"Photon Cure - Order #{order.id} Confirmation"
-        message = render_to_string('orders/email/order_confirmation.txt', {
-            'order': order,
-            'cart_items': list(order.items.select_related('product')),
-            'expected_start': order.expected_delivery_range[0],
-            'expected_end': order.expected_delivery_range[1],
-        })
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [order.email])
-
-    # Clear the cart now that order is finalized
-    CartItem.objects.filter(user=request.user).delete()
-
     request.session['latest_order_id'] = order.id
     return JsonResponse({'success': True, 'redirect_url': reverse('orders:order_success')})
 
@@ -410,3 +361,26 @@ def release_pending_order(request):
             order.mark_as_failed()
 
     return JsonResponse({'ok': True})
+
+
+@csrf_exempt
+def razorpay_webhook(request):
+    """
+    Razorpay server-to-server events. Verifies the signature, stores the event
+    and acknowledges at once; processing happens in Celery (orders.webhooks).
+    """
+    if request.method != "POST":
+        return HttpResponseBadRequest("Invalid request method.")
+
+    if not get_gateway().verify_webhook(request.body, request.headers.get('X-Razorpay-Signature')):
+        return HttpResponseBadRequest("Invalid signature.")
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest("Bad payload.")
+    if not isinstance(payload, dict):
+        return HttpResponseBadRequest("Bad payload.")
+
+    webhooks.record(request.headers.get('X-Razorpay-Event-Id'), request.body, payload)
+    return JsonResponse({'ok': True})
@@ -0,0 +1,144 @@
+"""
+Razorpay webhook ingestion.
+
+The endpoint only verifies the signature, stores the raw event and answers
+200, so Razorpay never waits on (or retries because of) our processing.
+record() inserts the event under its X-Razorpay-Event-Id. A redelivery
+finds the row already there and is dropped with a single SELECT.
+
+A new event kicks process_order_events() for the order named in the
+notes (local_order_id, set by create_razorpay_order_reserved). That holds
+the order's row lock while it walks the order's unprocessed events in
+event time, so events of one order are applied one at a time and in
+order, through the same confirm_payment() path the browser callback uses.
+A payment.failed is only recorded: the reservation stays until the customer
+gives up or it expires. Anything left unprocessed (broker down, a crash) is
+picked up by process_pending() from Celery beat.
+"""
+
+import hashlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import InsufficientStock, Order, PaymentEvent
+from .refunds import queue_refund
+
+CAPTURED = {'payment.captured', 'order.paid'}
+FAILED = {'payment.failed'}
+# Leave fresh events to the task their own delivery kicked
+PENDING_GRACE = timedelta(seconds=30)
+PENDING_BATCH = 200
+
+
+def _local_order_id(payload):
+    entities = payload.get('payload') or {}
+    for name in ('payment', 'order'):
+        notes = (entities.get(name) or {}).get('entity', {}).get('notes')
+        # Razorpay sends [] for empty notes
+        if isinstance(notes, dict) and str(notes.get('local_order_id', '')).isdigit():
+            return int(notes['local_order_id'])
+    return None
+
+
+def _payment_id(payload):
+    return ((payload.get('payload') or {}).get('payment') or {}).get('entity', {}).get('id')
+
+
+def record(event_id, body, payload):
+    """Stores a verified delivery. Returns False if it was a duplicate."""
+    event_id = event_id or hashlib.sha256(body).hexdigest()[:64]
+    created_at = payload.get('created_at')
+    event, created = PaymentEvent.objects.get_or_create(
+        event_id=event_id,
+        defaults={
+            'event': str(payload.get('event', ''))[:64],
+            'local_order_id': _local_order_id(payload),
+            'payload': payload,
+            'created_at': (
+                datetime.fromtimestamp(created_at, tz=dt_timezone.utc)
+                if isinstance(created_at, (int, float)) else timezone.now()
+            ),
+        },
+    )
+    if created:
+        transaction.on_commit(lambda: _kick(event.local_order_id))
+    return created
+
+
+def _kick(local_order_id):
+    from .tasks import process_payment_events_task
+
+    try:
+        process_payment_events_task.delay(local_order_id)
+    except Exception as e:
+        # Broker down: process_pending() gets to it from beat
+        print(f"❌ Could not queue payment event processing: {e}")
+
+
+def _apply(order, event):
+    """Applies one event to the (locked) order; returns the outcome to store."""
+    if order is None:
+        return 'no such order'
+
+    if event.event in CAPTURED:
+        payment_id = _payment_id(event.payload) or order.payment_id
+        if order.status == 'Cancelled':
+            # Paid for an order that no longer exists: give the money back
+            if payment_id:
+                queue_refund(order, payment_id)
+                return 'order cancelled, refund queued'
+            return 'order cancelled'
+        if order.inventory_finalized:
+            return 'already finalized'
+        if not payment_id:
+            return 'no payment id'
+        try:
+            order.confirm_payment(payment_id)
+        except InsufficientStock:
+            return 'out of stock, refund queued'
+        return 'finalized'
+
+    if event.event in FAILED:
+        # One failed attempt doesn't end the checkout: the customer can retry
+        # on the same Razorpay order until the reservation runs out. Closing
+        # the modal (release_pending_order) or the expiry sweeper fails it.
+        return 'recorded'
+
+    return 'ignored'
+
+
+def process_order_events(local_order_id):
+    """
+    Applies the unprocessed events of one local order, oldest first.
+    local_order_id None settles events that name no order. Returns the count.
+    """
+    with transaction.atomic():
+        order = None
+        if local_order_id is not None:
+            # The row lock makes this the only worker on this order's events
+            order = Order.objects.select_for_update().filter(id=local_order_id).first()
+        events = list(
+            PaymentEvent.objects.select_for_update(skip_locked=True)
+            .filter(local_order_id=local_order_id, processed_at__isnull=True)
+            .order_by('created_at', 'id')
+        )
+        now = timezone.now()
+        for event in events:
+            event.outcome = _apply(order, event)
+            event.processed_at = now
+        PaymentEvent.objects.bulk_update(events, ['outcome', 'processed_at'])
+    return len(events)
+
+
+def process_pending(batch_size=PENDING_BATCH):
+    """Processes orders whose events were left behind. Returns events processed."""
+    local_order_ids = (
+        PaymentEvent.objects
+        .filter(processed_at__isnull=True, received_at__lt=timezone.now() - PENDING_GRACE)
+        .order_by('local_order_id')
+        .values_list('local_order_id', flat=True)
+        .distinct()[:batch_size]
+    )
+    return sum(process_order_events(local_order_id) for local_order_id in list(local_order_ids))
@@ -56,6 +56,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'cart.middleware.GuestCartMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -72,6 +73,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'cart.context_processors.cart_count',
+                'core.context_processors.shared_page',
                 
             ],
         },
@@ -145,9 +147,15 @@ import os
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-# Use this as a session key for storing the cart
+# Cookie holding a guest's cart (cart.guest)
 CART_SESSION_ID = 'cart'
 
+# Seconds an unpaid checkout keeps its stock reserved (orders.inventory sweeper)
+ORDER_RESERVATION_TTL = 20 * 60
+
+# Catalog pagination: 'cursor' (keyset, no COUNT) or 'pages' (numbered, estimated count)
+CATALOG_PAGINATION_MODE = 'cursor'
+
 
 
 
@@ -156,6 +164,14 @@ from decouple import config
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 RAZORPAY_KEY_ID = config('RAZORPAY_KEY_ID')
 RAZORPAY_KEY_SECRET = config('RAZORPAY_KEY_SECRET')
+# orders.payments: 'razorpay', or 'fake' for offline tests / local dev
+PAYMENT_GATEWAY = config('PAYMENT_GATEWAY', default='razorpay')
+# Secret set on the Razorpay dashboard webhook; webhooks are refused without it
+RAZORPAY_WEBHOOK_SECRET = config('RAZORPAY_WEBHOOK_SECRET', default='')
+RAZORPAY_CONNECT_TIMEOUT = 3.05
+RAZORPAY_READ_TIMEOUT = 10
+RAZORPAY_MAX_RETRIES = 2
+RAZORPAY_POOL_SIZE = 10
 
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
@@ -175,11 +191,75 @@ EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
 
+# Shared cache (product card fragments, etc.) — same Redis as Celery, separate DB
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_REDIS_URL', default='redis://localhost:6379/1'),
+    }
+}
+
+# Write-behind carts: mutations are buffered in Redis and flushed to CartItem
+# by Celery beat (cart.buffer). Off by default.
+CART_WRITE_BEHIND = config('CART_WRITE_BEHIND', default=False, cast=bool)
+CART_BUFFER_REDIS_URL = config('CART_BUFFER_REDIS_URL', default=CACHES['default']['LOCATION'])
+
+# Flash sales: Redis stock counters turn sold-out carts away before checkout
+# touches Postgres (orders.admission). Off by default.
+STOCK_GATE = config('STOCK_GATE', default=False, cast=bool)
+STOCK_GATE_REDIS_URL = config('STOCK_GATE_REDIS_URL', default=CACHES['default']['LOCATION'])
+
+
 # Celery Settings
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 
+from celery.schedules import crontab
+
+CELERY_BEAT_SCHEDULE = {
+    'update-frequently-bought-together': {
+        'task': 'products.tasks.update_affinity_task',
+        'schedule': 15 * 60,
+    },
+    'rebuild-frequently-bought-together': {
+        'task': 'products.tasks.rebuild_affinity_task',
+        'schedule': crontab(hour=3, minute=30),
+    },
+    'release-expired-reservations': {
+        'task': 'orders.tasks.release_expired_reservations_task',
+        'schedule': 60,
+    },
+    'flush-cart-buffers': {
+        'task': 'cart.tasks.flush_cart_buffers_task',
+        'schedule': 10,
+    },
+    'compact-inventory': {
+        'task': 'products.tasks.compact_inventory_task',
+        'schedule': 10,
+    },
+    'rebalance-stock-shards': {
+        'task': 'products.tasks.rebalance_stock_shards_task',
+        'schedule': 60,
+    },
+    'reconcile-stock-gate': {
+        'task': 'orders.tasks.reconcile_stock_gate_task',
+        'schedule': 15,
+    },
+    'send-order-emails': {
+        'task': 'orders.tasks.send_order_emails_task',
+        'schedule': 60,
+    },
+    'process-payment-events': {
+        'task': 'orders.tasks.process_pending_payment_events_task',
+        'schedule': 60,
+    },
+    'refund-pending-orders': {
+        'task': 'orders.tasks.refund_pending_orders_task',
+        'schedule': 5 * 60,
+    },
+}
+
 
 AUTH_USER_MODEL = 'accounts.CustomUser'
 
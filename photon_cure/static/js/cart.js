@@ -38,6 +38,23 @@ function getCSRFToken() {
   return '';
 }
 
+// Publicly cached pages are rendered without a token; /cart/count/ sets the cookie
+function ensureCSRFToken() {
+  const token = getCSRFToken();
+  if (token) return Promise.resolve(token);
+  return fetch("/cart/count/").then(() => getCSRFToken());
+}
+
+function fillCSRFInput(form, token) {
+  const input = form.querySelector("[name=csrfmiddlewaretoken]");
+  if (input) {
+    input.value = token;
+  } else {
+    form.insertAdjacentHTML("afterbegin", '<input type="hidden" name="csrfmiddlewaretoken">');
+    form.querySelector("[name=csrfmiddlewaretoken]").value = token;
+  }
+}
+
 function togglePlusUI(productId, currentQty, maxQty) {
   const row = document.querySelector(`tr[data-product-row-id="${productId}"]`);
   if (!row) return;
@@ -55,77 +72,102 @@ function togglePlusUI(productId, currentQty, maxQty) {
   if (maxMsg) maxMsg.classList.toggle('d-none', !atMax);
 }
 
-function handleIncrease(plusBtn) {
-  // If disabled, nothing to do
-  if (plusBtn.disabled) return;
+// === Batched +/- ===
+// Clicks update the row right away and are coalesced per product; after a
+// short pause they go to /cart/update/ as one request, and the response (the
+// whole cart) is rendered back.
+const CART_UPDATE_DELAY = 350;
+const pendingDeltas = {};
+let flushTimer = null;
+let updateInFlight = false;
+
+function queueDelta(productId, delta) {
+  const row = document.querySelector(`tr[data-product-row-id="${productId}"]`);
+  const qtyEl = document.getElementById(`quantity-${productId}`);
+  const maxQty = parseInt(row?.getAttribute('data-max') || '999999', 10);
+  const current = parseInt(qtyEl?.textContent || '0', 10);
+  const next = Math.max(0, Math.min(current + delta, maxQty));
+  if (next === current) {
+    if (delta > 0) toastInfo(`Only ${maxQty} in stock`);
+    return;
+  }
 
-  const productId = plusBtn.dataset.productId;
-  const row = plusBtn.closest('tr');
-  const maxAttr = plusBtn.getAttribute('data-max') || row?.getAttribute('data-max') || '999999';
-  const maxQty = parseInt(maxAttr, 10);
+  pendingDeltas[productId] = (pendingDeltas[productId] || 0) + (next - current);
+  if (qtyEl) qtyEl.textContent = next;
+  togglePlusUI(productId, next, maxQty);
 
-  fetch(`/cart/increase/${productId}/`, {
+  clearTimeout(flushTimer);
+  flushTimer = setTimeout(flushCartUpdates, CART_UPDATE_DELAY);
+}
+
+function flushCartUpdates() {
+  // Keep requests ordered: wait for the previous batch to come back
+  if (updateInFlight) {
+    flushTimer = setTimeout(flushCartUpdates, CART_UPDATE_DELAY);
+    return;
+  }
+  const operations = Object.entries(pendingDeltas)
+    .filter(([, delta]) => delta !== 0)
+    .map(([productId, delta]) => ({ product_id: parseInt(productId, 10), delta }));
+  Object.keys(pendingDeltas).forEach(k => delete pendingDeltas[k]);
+  if (!operations.length) return;
+
+  updateInFlight = true;
+  fetch('/cart/update/', {
     method: 'POST',
-    headers: { 'X-CSRFToken': getCSRFToken(), 'Accept': 'application/json', 'X-Requested-With': 'XMLHttpRequest' },
+    headers: {
+      'X-CSRFToken': getCSRFToken(),
+      'Accept': 'application/json',
+      'Content-Type': 'application/json',
+      'X-Requested-With': 'XMLHttpRequest',
+    },
+    body: JSON.stringify({ operations }),
   })
   .then(r => r.json())
-  .then(data => {
-    if (typeof data.quantity !== 'number') return;
+  .then(data => { if (data.success) renderCartState(data); })
+  .finally(() => { updateInFlight = false; });
+}
 
-    const qtyEl = document.getElementById(`quantity-${productId}`);
-    const priceEl = document.getElementById(`price-${productId}`);
-    const cartTotalEl = document.getElementById('cart-total');
+function renderCartState(data) {
+  const items = new Map(data.items.map(item => [String(item.product_id), item]));
 
-    if (qtyEl) qtyEl.textContent = data.quantity;
-    if (priceEl) priceEl.textContent = `₹${data.item_total.toFixed(2)}`;
-    if (cartTotalEl) cartTotalEl.textContent = `₹${data.cart_total.toFixed(2)}`;
+  document.querySelectorAll('tr[data-product-row-id]').forEach(row => {
+    const productId = row.dataset.productRowId;
+    const item = items.get(productId);
+    if (!item) {
+      row.remove();
+      return;
+    }
+    // Newer local clicks are queued; the next response will cover this row
+    if (pendingDeltas[productId]) return;
 
-    updateCartCount();
-    updateMiniCart();
+    row.setAttribute('data-max', item.available);
+    const plusBtn = row.querySelector('.cart-increase-btn');
+    if (plusBtn) plusBtn.setAttribute('data-max', item.available);
 
-    if (!isNaN(maxQty)) {
-      togglePlusUI(productId, data.quantity, maxQty);
-      if (data.quantity >= maxQty) toastInfo(`Only ${maxQty} in stock`);
-    }
-  });
-}
+    const qtyEl = document.getElementById(`quantity-${productId}`);
+    const priceEl = document.getElementById(`price-${productId}`);
+    if (qtyEl) qtyEl.textContent = item.quantity;
+    if (priceEl) priceEl.textContent = `₹${item.item_total.toFixed(2)}`;
+    togglePlusUI(productId, item.quantity, item.available);
 
-function handleDecrease(minusBtn) {
-  const productId = minusBtn.dataset.productId;
-  const row = minusBtn.closest('tr');
-  const maxAttr = row?.getAttribute('data-max') || '999999';
-  const maxQty = parseInt(maxAttr, 10);
+    if (data.adjusted.includes(item.product_id)) toastInfo(`Only ${item.available} in stock`);
+  });
 
-  fetch(`/cart/decrease/${productId}/`, {
-    method: 'POST',
-    headers: { 'X-CSRFToken': getCSRFToken(), 'Accept': 'application/json', 'X-Requested-With': 'XMLHttpRequest' },
-  })
-  .then(r => r.json())
-  .then(data => {
-    if (typeof data.quantity !== 'number') return;
-
-    if (data.quantity > 0) {
-      const qtyEl = document.getElementById(`quantity-${productId}`);
-      const priceEl = document.getElementById(`price-${productId}`);
-      if (qtyEl) qtyEl.textContent = data.quantity;
-      if (priceEl) priceEl.textContent = `₹${data.item_total.toFixed(2)}`;
-    } else {
-      // removed
-      const tr = row || document.querySelector(`tr[data-product-row-id="${productId}"]`);
-      if (tr) tr.remove();
-    }
+  const cartTotalEl = document.getElementById('cart-total');
+  if (cartTotalEl) cartTotalEl.textContent = `₹${data.cart_total.toFixed(2)}`;
 
-    const cartTotalEl = document.getElementById('cart-total');
-    if (cartTotalEl) cartTotalEl.textContent = `₹${data.cart_total.toFixed(2)}`;
+  updateCartCount();
+  updateMiniCart();
+}
 
-    updateCartCount();
-    updateMiniCart();
+function handleIncrease(plusBtn) {
+  if (plusBtn.disabled) return;
+  queueDelta(plusBtn.dataset.productId, 1);
+}
 
-    // Immediately re-enable + and hide "max" message if below ceiling
-    if (!isNaN(maxQty) && data.quantity > 0) {
-      togglePlusUI(productId, data.quantity, maxQty);
-    }
-  });
+function handleDecrease(minusBtn) {
+  queueDelta(minusBtn.dataset.productId, -1);
 }
 
 function setupAddToCartForms() {
@@ -133,14 +175,18 @@ function setupAddToCartForms() {
   forms.forEach(form => {
     form.addEventListener("submit", function(e) {
       e.preventDefault();
-      fetch(this.action, {
-        method: "POST",
-        headers: {
-          "X-CSRFToken": this.querySelector("[name=csrfmiddlewaretoken]").value,
-          "X-Requested-With": "XMLHttpRequest",
-          "Content-Type": "application/x-www-form-urlencoded"
-        },
-        body: new URLSearchParams(new FormData(this))
+      ensureCSRFToken()
+      .then(token => {
+        fillCSRFInput(this, token);
+        return fetch(this.action, {
+          method: "POST",
+          headers: {
+            "X-CSRFToken": token,
+            "X-Requested-With": "XMLHttpRequest",
+            "Content-Type": "application/x-www-form-urlencoded"
+          },
+          body: new URLSearchParams(new FormData(this))
+        });
       })
       .then(res => res.json())
       .then(() => {
@@ -155,6 +201,19 @@ function setupAddToCartForms() {
   });
 }
 
+// Plain POST forms on a tokenless page get the token just before they go out
+document.addEventListener('submit', (e) => {
+  const form = e.target;
+  if (form.method !== 'post' || form.classList.contains('add-to-cart-form')) return;
+  const input = form.querySelector('[name=csrfmiddlewaretoken]');
+  if (input && input.value) return;
+  e.preventDefault();
+  ensureCSRFToken().then(token => {
+    fillCSRFInput(form, token);
+    form.submit();
+  });
+});
+
 // === Event delegation: robustly handles clicks even if buttons start disabled or change ===
 document.addEventListener('click', (e) => {
   const plus = e.target.closest('.cart-increase-btn');
@@ -0,0 +1,33 @@
+// suggest.js — search-as-you-type for the product search box
+
+(function () {
+  const input = document.getElementById('product-search');
+  const list = document.getElementById('search-suggestions');
+  if (!input || !list) return;
+
+  let timer = null;
+  let lastQuery = '';
+
+  function render(data) {
+    list.innerHTML = '';
+    const names = [...data.products, ...data.categories].map(item => item.name);
+    [...new Set(names)].forEach(name => {
+      const opt = document.createElement('option');
+      opt.value = name;
+      list.appendChild(opt);
+    });
+  }
+
+  input.addEventListener('input', () => {
+    clearTimeout(timer);
+    const q = input.value.trim();
+    if (q.length < 2 || q === lastQuery) return;
+    timer = setTimeout(() => {
+      lastQuery = q;
+      fetch(`/suggest/?q=${encodeURIComponent(q)}`, { headers: { 'Accept': 'application/json' } })
+        .then(res => res.json())
+        .then(data => { if (input.value.trim() === q) render(data); })
+        .catch(() => {});
+    }, 120);
+  });
+})();
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'photon_cure.settings')
 
 application = get_wsgi_application()
+
+# Build the search-suggestion index before the first request hits this worker
+try:
+    from products.suggest import warm_index
+    warm_index()
+except Exception as e:
+    # e.g. database not reachable yet; the index builds lazily on first use
+    print(f"❌ Search suggestions not warmed at startup: {e!r}")
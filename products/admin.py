@@ -1,13 +1,60 @@
-from django.contrib import admin
-from .models import Product, Category
+from django import forms
+from django.contrib import admin, messages
+
+from .ledger import live_stock, set_stock
+from .models import Category, InventoryMovement, Product
+
+class ProductAdminForm(forms.ModelForm):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Edit the live stock (see ProductAdmin.get_queryset), not the snapshot
+        if 'stock' in self.fields and hasattr(self.instance, 'live_stock'):
+            self.initial['stock'] = self.instance.live_stock
+            self.fields['stock'].help_text = 'Live stock, pending ledger movements included.'
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock')
+    form = ProductAdminForm
+    list_display = ('name', 'category', 'price', 'stock', 'rating_count')
     list_filter = ('category',)
     search_fields = ('name',)
     list_editable = ('stock',)
+    readonly_fields = ('allocated', 'stock_shards')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(live_stock=live_stock())
+
+    def get_changelist_form(self, request, **kwargs):
+        kwargs.setdefault('form', ProductAdminForm)
+        return super().get_changelist_form(request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        # stock/allocated are ledger snapshots the compactor rewrites; a stock
+        # edit becomes an adjustment movement instead of overwriting them,
+        # sized against the live stock at the time it is written.
+        if not change:
+            return super().save_model(request, obj, form, change)
+        fields = [f for f in form.changed_data if f != 'stock']
+        if fields:
+            obj.save(update_fields=fields + ['updated_at'])
+        if 'stock' in form.changed_data and not set_stock(obj.pk, obj.stock):
+            self.message_user(
+                request, f"{obj.name}: stock can't go below what unpaid orders hold", messages.ERROR,
+            )
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name',)
+
+@admin.register(InventoryMovement)
+class InventoryMovementAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'product', 'reason', 'stock_delta', 'allocated_delta', 'order', 'compacted')
+    list_filter = ('reason', 'compacted')
+    search_fields = ('product__name',)
+    raw_id_fields = ('product', 'order')
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,109 @@
+"""
+"Frequently bought together" precomputation.
+
+Co-occurrence is counted from finalized orders in one streamed pass over
+(order_id, product_id) rows: lines are grouped per order and every product
+pair in an order adds 1 to a sparse {(a, b): n} counter. Only the
+KEEP_PER_PRODUCT strongest neighbours per product are stored in
+ProductAffinity, so product_detail needs one indexed lookup.
+
+rebuild_affinity() recounts everything (exact). update_affinity() folds in
+orders finalized since the last run. Pairs that were pruned earlier restart
+from their new count, so run a full rebuild now and then (e.g. nightly).
+"""
+
+import heapq
+from collections import Counter, defaultdict
+from itertools import combinations, groupby
+from operator import itemgetter
+
+from django.db import transaction
+
+from .models import ProductAffinity
+
+KEEP_PER_PRODUCT = 50
+SHOW_PER_PRODUCT = 4
+
+
+def _pair_counts(orders):
+    from orders.models import OrderItem
+
+    rows = (
+        OrderItem.objects.filter(order__in=orders)
+        .order_by('order_id')
+        .values_list('order_id', 'product_id')
+        .distinct()
+        .iterator(chunk_size=5000)
+    )
+    counts = Counter()
+    for _, lines in groupby(rows, key=itemgetter(0)):
+        products = sorted({product_id for _, product_id in lines})
+        for a, b in combinations(products, 2):
+            counts[(a, b)] += 1
+            counts[(b, a)] += 1
+    return counts
+
+
+def _top_rows(counts):
+    by_product = defaultdict(list)
+    for (product_id, related_id), n in counts.items():
+        by_product[product_id].append((n, related_id))
+
+    rows = []
+    for product_id, neighbours in by_product.items():
+        for n, related_id in heapq.nlargest(KEEP_PER_PRODUCT, neighbours):
+            rows.append(ProductAffinity(product_id=product_id, related_id=related_id, count=n))
+    return rows
+
+
+def _pending_orders():
+    from orders.models import Order
+    return Order.objects.filter(inventory_finalized=True, affinity_counted=False)
+
+
+def rebuild_affinity():
+    """Recount every finalized order. Returns the number of stored pairs."""
+    from orders.models import Order
+
+    with transaction.atomic():
+        _pending_orders().update(affinity_counted=True)
+        counts = _pair_counts(Order.objects.filter(inventory_finalized=True, affinity_counted=True))
+        rows = _top_rows(counts)
+        ProductAffinity.objects.all().delete()
+        ProductAffinity.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def update_affinity(batch_size=1000):
+    """Fold newly finalized orders into the stored counts. Returns orders processed."""
+    from orders.models import Order
+
+    with transaction.atomic():
+        order_ids = list(
+            _pending_orders().select_for_update(skip_locked=True)
+            .order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not order_ids:
+            return 0
+        Order.objects.filter(id__in=order_ids).update(affinity_counted=True)
+
+        delta = _pair_counts(Order.objects.filter(id__in=order_ids))
+        affected = {a for a, _ in delta}
+        merged = Counter({
+            (product_id, related_id): n
+            for product_id, related_id, n in ProductAffinity.objects.filter(
+                product_id__in=affected
+            ).values_list('product_id', 'related_id', 'count')
+        })
+        merged.update(delta)
+
+        ProductAffinity.objects.filter(product_id__in=affected).delete()
+        ProductAffinity.objects.bulk_create(_top_rows(merged), batch_size=1000)
+    return len(order_ids)
+
+
+def frequently_bought_with(product, limit=SHOW_PER_PRODUCT):
+    return [
+        affinity.related
+        for affinity in product.affinities.select_related('related').order_by('-count')[:limit]
+    ]
@@ -0,0 +1,203 @@
+"""
+Catalog caches.
+
+Product cards: every product has a version token in the cache; a card is
+cached under (product id, version). Changing a product, its stock/allocated
+or its reviews bumps the token, so stale cards are simply never looked up
+again and expire on their own. Every bump also moves the card generation,
+which listing ETags include. A listing page costs two get_many calls when
+everything is warm.
+
+Listing results: the ordered product ids (plus pagination state) for a
+canonical set of listing parameters, tagged with the catalog generation.
+Any Product/Category/Review write bumps the generation. After a bump only
+one worker recomputes a hot key; the others keep serving the stale entry.
+"""
+
+import hashlib
+import json
+import time
+import uuid
+
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+CARD_TEMPLATE = 'products/_product_card.html'
+CARD_TIMEOUT = 60 * 60 * 24
+
+CARD_GENERATION_KEY = 'product:card:gen'
+CARD_HITS_KEY = 'product:card:hits'
+CARD_MISSES_KEY = 'product:card:misses'
+
+CATALOG_GENERATION_KEY = 'catalog:gen'
+RESULT_TIMEOUT = 60 * 15
+RESULT_LOCK_TIMEOUT = 10
+RESULT_WAIT_STEPS = 20     # x 50ms: how long to wait for another worker's first computation
+RESULT_HITS_KEY = 'catalog:result:hits'
+RESULT_MISSES_KEY = 'catalog:result:misses'
+RESULT_STALE_KEY = 'catalog:result:stale'
+
+# Rendered in place of the per-user CSRF token so cards can be shared
+_CSRF_PLACEHOLDER = 'CSRF-PLACEHOLDER-9f2c'
+
+
+def _version_key(product_id):
+    return f'product:v:{product_id}'
+
+
+def _card_key(product_id, version):
+    return f'product:card:{product_id}:{version}'
+
+
+def _new_version():
+    return uuid.uuid4().hex[:12]
+
+
+def bump_product_versions(product_ids):
+    """Invalidate cached fragments for these products."""
+    product_ids = set(product_ids)
+    if product_ids:
+        cache.set_many({_version_key(pid): _new_version() for pid in product_ids}, timeout=None)
+        # Listing pages embed the cards (stock included), so their ETags move too
+        _bump_generation(CARD_GENERATION_KEY)
+
+
+def get_product_versions(product_ids):
+    keys = {_version_key(pid): pid for pid in product_ids}
+    found = cache.get_many(keys)
+    versions = {keys[k]: v for k, v in found.items()}
+
+    # Evicted/never-set versions get a fresh token (never matches an old card)
+    missing = {_version_key(pid): _new_version() for pid in product_ids if pid not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update({keys[k]: v for k, v in missing.items()})
+    return versions
+
+
+def _incr(key, delta):
+    if not delta:
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.set(key, delta, timeout=None)
+
+
+def card_cache_stats():
+    stats = cache.get_many([CARD_HITS_KEY, CARD_MISSES_KEY])
+    return {'hits': stats.get(CARD_HITS_KEY, 0), 'misses': stats.get(CARD_MISSES_KEY, 0)}
+
+
+def result_cache_stats():
+    stats = cache.get_many([RESULT_HITS_KEY, RESULT_MISSES_KEY, RESULT_STALE_KEY])
+    return {
+        'hits': stats.get(RESULT_HITS_KEY, 0),
+        'misses': stats.get(RESULT_MISSES_KEY, 0),
+        'stale': stats.get(RESULT_STALE_KEY, 0),
+    }
+
+
+def render_product_cards(request, products):
+    """Returns the rendered card HTML for each product, in order."""
+    products = list(products)
+    if not products:
+        return []
+
+    versions = get_product_versions([p.id for p in products])
+    keys = {p.id: _card_key(p.id, versions[p.id]) for p in products}
+    cached = cache.get_many(list(keys.values()))
+
+    rendered = {}
+    for product in products:
+        if keys[product.id] in cached:
+            continue
+        html = render_to_string(CARD_TEMPLATE, {
+            'product': product,
+            'csrf_token': _CSRF_PLACEHOLDER,
+        })
+        rendered[keys[product.id]] = html
+    if rendered:
+        cache.set_many(rendered, timeout=CARD_TIMEOUT)
+
+    _incr(CARD_HITS_KEY, len(products) - len(rendered))
+    _incr(CARD_MISSES_KEY, len(rendered))
+
+    cached.update(rendered)
+    # Shared (publicly cacheable) pages carry no token; cart.js supplies it
+    csrf_token = '' if getattr(request, 'shared_page', False) else get_token(request)
+    return [
+        mark_safe(cached[keys[p.id]].replace(_CSRF_PLACEHOLDER, csrf_token))
+        for p in products
+    ]
+
+
+def _generation(key):
+    generation = cache.get(key)
+    if generation is None:
+        # Start from the clock so an evicted counter never reuses an old value
+        cache.add(key, time.time_ns(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def _bump_generation(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def catalog_generation():
+    return _generation(CATALOG_GENERATION_KEY)
+
+
+def bump_catalog_generation():
+    _bump_generation(CATALOG_GENERATION_KEY)
+
+
+def card_generation():
+    """Moves whenever any product's card version is bumped."""
+    return _generation(CARD_GENERATION_KEY)
+
+
+def get_cached_result(params, compute, timeout=RESULT_TIMEOUT):
+    """
+    Return compute() for the canonical params dict, cached per generation.
+    compute() must return plain (picklable) data.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+    key = f'catalog:result:{digest}'
+    generation = catalog_generation()
+
+    entry = cache.get(key)
+    if entry is not None and entry['gen'] == generation:
+        _incr(RESULT_HITS_KEY, 1)
+        return entry['data']
+
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, 1, timeout=RESULT_LOCK_TIMEOUT):
+        try:
+            data = compute()
+            cache.set(key, {'gen': generation, 'data': data}, timeout=timeout)
+        finally:
+            cache.delete(lock_key)
+        _incr(RESULT_MISSES_KEY, 1)
+        return data
+
+    # Someone else is recomputing: serve the previous generation meanwhile
+    if entry is not None:
+        _incr(RESULT_STALE_KEY, 1)
+        return entry['data']
+
+    for _ in range(RESULT_WAIT_STEPS):
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None and entry['gen'] == generation:
+            _incr(RESULT_HITS_KEY, 1)
+            return entry['data']
+
+    _incr(RESULT_MISSES_KEY, 1)
+    return compute()
@@ -0,0 +1,80 @@
+"""
+Faceted navigation counts for the catalog.
+
+All facets come from one GROUP BY (category, price bucket) over the searched
+products. Each facet ignores its own filter so the counts show what picking
+another value would give:
+  - category counts honour the price filter,
+  - price bucket counts honour the category filter,
+  - the in-stock count honours both.
+"""
+
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.db.models.lookups import GreaterThan
+
+from .ledger import live_available
+
+# (label, min, max) — max is exclusive; None means open-ended
+PRICE_BUCKETS = [
+    ('Below ₹500', None, 500),
+    ('₹500 - ₹1000', 500, 1000),
+    ('₹1000 - ₹5000', 1000, 5000),
+    ('Above ₹5000', 5000, None),
+]
+
+
+def _bucket_expression():
+    whens = []
+    for index, (_, low, high) in enumerate(PRICE_BUCKETS):
+        condition = Q()
+        if low is not None:
+            condition &= Q(price__gte=low)
+        if high is not None:
+            condition &= Q(price__lt=high)
+        whens.append(When(condition, then=Value(index)))
+    return Case(*whens, output_field=IntegerField())
+
+
+def catalog_facets(products, category_id=None, min_price=None, max_price=None):
+    """
+    products: the searched queryset *before* category/price filters.
+    Returns plain data (safe to cache).
+    """
+    price_q = Q()
+    if min_price is not None:
+        price_q &= Q(price__gte=min_price)
+    if max_price is not None:
+        price_q &= Q(price__lte=max_price)
+    # Live stock, pending ledger movements included (see products.ledger)
+    in_stock_q = Q(GreaterThan(live_available(), 0))
+
+    rows = (
+        products.order_by()
+        .annotate(price_bucket=_bucket_expression())
+        .values('category_id', 'price_bucket')
+        .annotate(
+            total=Count('id'),
+            price_match=Count('id', filter=price_q),
+            price_match_in_stock=Count('id', filter=price_q & in_stock_q),
+        )
+    )
+
+    categories = {}
+    buckets = [0] * len(PRICE_BUCKETS)
+    in_stock = 0
+    for row in rows:
+        if row['category_id'] is not None:
+            categories[row['category_id']] = categories.get(row['category_id'], 0) + row['price_match']
+        if category_id is None or row['category_id'] == category_id:
+            buckets[row['price_bucket']] += row['total']
+            in_stock += row['price_match_in_stock']
+
+    return {
+        'categories': categories,
+        'price_buckets': [
+            # 'max' is inclusive, ready for the max_price filter
+            {'label': label, 'min': low, 'max': high - 0.01 if high is not None else None, 'count': count}
+            for (label, low, high), count in zip(PRICE_BUCKETS, buckets)
+        ],
+        'in_stock': in_stock,
+    }
@@ -0,0 +1,101 @@
+"""
+Responsive image variants for Product.image.
+
+Each upload is resized (never upscaled) to a few widths and written as WebP
+and JPEG under a directory named after the original's content hash, e.g.
+product_images/variants/3fa9c1d2e4b5a6f7/card.webp. The same bytes always
+map to the same URLs, so variants can be served with far-future caching.
+"""
+
+import hashlib
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# name -> target width in px
+VARIANT_WIDTHS = {
+    'thumb': 160,
+    'card': 400,
+    'detail': 1000,
+}
+
+# format -> (Pillow format, extension, save options)
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 6}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+VARIANTS_DIR = 'product_images/variants'
+
+
+def variant_path(digest, name, fmt):
+    _, ext, _ = VARIANT_FORMATS[fmt]
+    return f'{VARIANTS_DIR}/{digest}/{name}.{ext}'
+
+
+def _flatten(img):
+    # JPEG has no alpha channel
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        return background
+    return img.convert('RGB')
+
+
+def build_variants(product):
+    """
+    Writes any missing variants for product.image and returns the metadata
+    to store in Product.image_variants.
+    """
+    with product.image.open('rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+
+    original = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    widths = {}
+    for name, width in VARIANT_WIDTHS.items():
+        resized = original.copy()
+        resized.thumbnail((width, resized.height), Image.LANCZOS)
+        widths[name] = resized.width
+
+        for fmt, (pil_format, _, options) in VARIANT_FORMATS.items():
+            path = variant_path(digest, name, fmt)
+            if default_storage.exists(path):
+                continue
+            image = _flatten(resized) if pil_format == 'JPEG' else resized
+            buffer = BytesIO()
+            image.save(buffer, pil_format, **options)
+            default_storage.save(path, ContentFile(buffer.getvalue()))
+
+    return {'hash': digest, 'source': product.image.name, 'widths': widths}
+
+
+def variants_ready(product):
+    variants = product.image_variants or {}
+    return bool(product.image) and variants.get('source') == product.image.name
+
+
+def variant_url(product, name, fmt='jpeg'):
+    if not variants_ready(product):
+        return product.image.url if product.image else ''
+    return default_storage.url(variant_path(product.image_variants['hash'], name, fmt))
+
+
+def variant_srcset(product, fmt='jpeg'):
+    """'url 160w, url 400w, ...' using the real widths (small originals aren't upscaled)."""
+    if not variants_ready(product):
+        return ''
+    digest = product.image_variants['hash']
+    widths = product.image_variants['widths']
+    seen = set()
+    entries = []
+    for name in VARIANT_WIDTHS:
+        width = widths.get(name)
+        if not width or width in seen:
+            continue
+        seen.add(width)
+        entries.append(f"{default_storage.url(variant_path(digest, name, fmt))} {width}w")
+    return ', '.join(entries)
@@ -0,0 +1,189 @@
+"""
+Inventory ledger: snapshot + pending movements.
+
+The order workflow never updates Product.stock/allocated. It appends
+InventoryMovement rows under a per-product advisory lock (see
+orders.inventory), so checkouts don't queue on the product row that every
+other writer touches (admin edits, rating aggregates, the catalog). Live
+stock is the Product snapshot plus the movements with compacted=False.
+
+compact() folds pending movements into the snapshots and flags them in the
+same transaction, so a reader always sees either "old snapshot + pending"
+or "new snapshot", never both or neither. It folds every visible movement of
+the products it picks, so a partially folded product can't break the
+allocated <= stock constraint.
+"""
+
+from django.db import connection, transaction
+from django.db.models import BigIntegerField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .cache import bump_product_versions
+from .models import InventoryMovement, Product
+
+PRODUCT_TABLE = Product._meta.db_table
+MOVEMENT_TABLE = InventoryMovement._meta.db_table
+
+COMPACT_BATCH = 500
+# Advisory lock namespace for per-product stock locks
+STOCK_LOCK_NAMESPACE = 7_301
+# pg_try_advisory_xact_lock key: one compactor at a time
+COMPACT_LOCK = 7_301_001
+
+
+def live_available_sql(alias):
+    """SQL for stock - allocated of the product row `alias`, pending movements included."""
+    return (
+        f"({alias}.stock - {alias}.allocated + COALESCE(("
+        f"SELECT SUM(m.stock_delta - m.allocated_delta) FROM {MOVEMENT_TABLE} m "
+        f"WHERE m.product_id = {alias}.id AND NOT m.compacted), 0))"
+    )
+
+
+# Live (id, name, stock, allocated) rows for a subquery/CTE; %s = id array
+LIVE_STOCK_SQL = f"""
+    SELECT p.id, p.name,
+           p.stock + COALESCE(SUM(m.stock_delta), 0) AS stock,
+           p.allocated + COALESCE(SUM(m.allocated_delta), 0) AS allocated
+    FROM {PRODUCT_TABLE} p
+    LEFT JOIN {MOVEMENT_TABLE} m ON m.product_id = p.id AND NOT m.compacted
+    WHERE p.id = ANY(%s)
+    GROUP BY p.id
+"""
+
+
+def _pending(product_ref, delta):
+    return Coalesce(
+        Subquery(
+            InventoryMovement.objects.filter(product=OuterRef(product_ref), compacted=False)
+            .order_by()
+            .values('product')
+            .annotate(total=Sum(delta))
+            .values('total'),
+            output_field=BigIntegerField(),
+        ),
+        Value(0),
+        output_field=BigIntegerField(),
+    )
+
+
+def _pending_available(product_ref):
+    return _pending(product_ref, F('stock_delta') - F('allocated_delta'))
+
+
+def live_stock():
+    """On-hand stock of Product rows, pending movements included."""
+    return ExpressionWrapper(F('stock') + _pending('id', F('stock_delta')), output_field=BigIntegerField())
+
+
+def live_available(prefix=''):
+    """
+    ORM counterpart of live_available_sql(), for Product querysets; pass
+    prefix='product__' to compute it for the product of a related row.
+    """
+    return ExpressionWrapper(
+        F(f'{prefix}stock') - F(f'{prefix}allocated') + _pending_available(f'{prefix}id'),
+        output_field=BigIntegerField(),
+    )
+
+
+def with_live_stock(products):
+    """Annotates live_available, which Product.available then prefers."""
+    return products.annotate(live_available=live_available())
+
+
+def lock_products(product_ids):
+    """
+    Takes the per-product stock locks (released at commit) in id order;
+    returns {id: name}. Sharded products are skipped: their reservations
+    lock a shard row instead (see products.shards).
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id, name,
+                   CASE WHEN stock_shards = 0 THEN pg_advisory_xact_lock(%s, (id %% 2147483647)::integer) END
+            FROM {PRODUCT_TABLE} WHERE id = ANY(%s) ORDER BY id
+        """, [STOCK_LOCK_NAMESPACE, sorted(product_ids)])
+        return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def adjust_stock(product_id, delta):
+    """
+    Records a manual stock change. Refused (returns False) if it would take
+    live stock below what is allocated to unpaid orders.
+    """
+    return _adjust(product_id, '%s::bigint', [delta])
+
+
+def set_stock(product_id, stock):
+    """
+    adjust_stock() to an absolute live stock; the difference is taken under
+    the stock lock, so movements recorded meanwhile aren't overwritten.
+    """
+    return _adjust(product_id, '%s::bigint - live.stock', [stock])
+
+
+def _adjust(product_id, delta_sql, params):
+    from .shards import lock as lock_shards, rebalance
+
+    with transaction.atomic():
+        lock_products([product_id])
+        lock_shards(product_id)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH live AS ({LIVE_STOCK_SQL}),
+                change AS (SELECT live.*, {delta_sql} AS delta FROM live)
+                INSERT INTO {MOVEMENT_TABLE}
+                    (product_id, reason, stock_delta, allocated_delta, created_at, compacted)
+                SELECT change.id, %s, change.delta, 0, now(), false FROM change
+                WHERE change.stock + change.delta >= change.allocated
+                RETURNING id
+            """, [[product_id], *params, InventoryMovement.ADJUST])
+            if cursor.fetchone() is None:
+                return False
+        rebalance(product_id)
+        transaction.on_commit(lambda: bump_product_versions([product_id]))
+    return True
+
+
+def pending_movements():
+    return InventoryMovement.objects.filter(compacted=False).count()
+
+
+def compact(batch_size=COMPACT_BATCH):
+    """
+    Folds the pending movements of up to batch_size products into their
+    snapshots. Returns (products, movements) folded; (0, 0) if another
+    compactor is running.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", [COMPACT_LOCK])
+        if not cursor.fetchone()[0]:
+            return 0, 0
+
+        cursor.execute(f"""
+            WITH targets AS (
+                SELECT DISTINCT product_id FROM {MOVEMENT_TABLE} WHERE NOT compacted LIMIT %s
+            ),
+            folded AS (
+                UPDATE {MOVEMENT_TABLE} m SET compacted = true
+                FROM targets t
+                WHERE m.product_id = t.product_id AND NOT m.compacted
+                RETURNING m.product_id, m.stock_delta, m.allocated_delta
+            ),
+            sums AS (
+                SELECT product_id, SUM(stock_delta) AS stock, SUM(allocated_delta) AS allocated,
+                       COUNT(*) AS movements
+                FROM folded GROUP BY product_id
+            )
+            UPDATE {PRODUCT_TABLE} p
+            SET stock = p.stock + sums.stock, allocated = p.allocated + sums.allocated, updated_at = now()
+            FROM sums
+            WHERE p.id = sums.product_id
+            RETURNING p.id, sums.movements
+        """, [batch_size])
+        rows = cursor.fetchall()
+
+        product_ids = [product_id for product_id, _ in rows]
+        transaction.on_commit(lambda: bump_product_versions(product_ids))
+    return len(rows), sum(movements for _, movements in rows)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from products.affinity import rebuild_affinity, update_affinity
+
+
+class Command(BaseCommand):
+    help = "Builds 'frequently bought together' neighbours from finalized orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Recount all orders instead of only new ones")
+
+    def handle(self, *args, **options):
+        if options['full']:
+            self.stdout.write("🛍️ Rebuilding frequently-bought-together from all finalized orders...")
+            pairs = rebuild_affinity()
+            self.stdout.write(f"✅ Stored {pairs} product pair(s)")
+            return
+
+        total = 0
+        while True:
+            processed = update_affinity()
+            if not processed:
+                break
+            total += processed
+        self.stdout.write(f"✅ Folded {total} new order(s) into frequently-bought-together")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from products.cache import card_cache_stats, result_cache_stats
+
+
+class Command(BaseCommand):
+    help = "Shows hit/miss counters for the catalog caches"
+
+    def handle(self, *args, **kwargs):
+        stats = card_cache_stats()
+        self.stdout.write(
+            f"🃏 Product cards: {stats['hits']} hits / {stats['misses']} misses "
+            f"({self._ratio(stats['hits'], stats['misses'])} hit rate)"
+        )
+
+        stats = result_cache_stats()
+        self.stdout.write(
+            f"📋 Listing results: {stats['hits']} hits / {stats['misses']} misses / "
+            f"{stats['stale']} stale ({self._ratio(stats['hits'] + stats['stale'], stats['misses'])} hit rate)"
+        )
+
+    @staticmethod
+    def _ratio(hits, misses):
+        total = hits + misses
+        return f"{(hits / total * 100) if total else 0:.1f}%"
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from products.ledger import COMPACT_BATCH, compact, pending_movements
+
+
+class Command(BaseCommand):
+    help = "Folds pending inventory ledger movements into the product stock snapshots"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', help="Only show how many movements are pending")
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            products = movements = 0
+            while True:
+                folded, count = compact()
+                products += folded
+                movements += count
+                if folded < COMPACT_BATCH:
+                    break
+            self.stdout.write(f"✅ Compacted {movements} movement(s) into {products} product(s)")
+
+        self.stdout.write(f"📒 Pending movements: {pending_movements()}")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from products.images import variants_ready
+from products.models import Product
+from products.tasks import generate_image_variants_task
+
+
+class Command(BaseCommand):
+    help = "Generates resized WebP/JPEG variants for product images that don't have them yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sync', action='store_true', help="Run in this process instead of queueing Celery tasks")
+        parser.add_argument('--force', action='store_true', help="Rebuild even if variants look up to date")
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').only('id', 'image', 'image_variants').order_by('id')
+
+        queued = 0
+        for product in products.iterator():
+            if variants_ready(product) and not options['force']:
+                continue
+            if options['sync']:
+                generate_image_variants_task.apply(args=[product.id])
+            else:
+                generate_image_variants_task.delay(product.id)
+            queued += 1
+
+        action = "Generated" if options['sync'] else "Queued"
+        self.stdout.write(f"🖼️ {action} image variants for {queued} product(s)")
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+from products.models import Product, Review
+
+RATING_FIELDS = [
+    'rating_sum', 'rating_count',
+    'rating_count_1', 'rating_count_2', 'rating_count_3', 'rating_count_4', 'rating_count_5',
+]
+
+
+class Command(BaseCommand):
+    help = "Backfills/rebuilds the stored rating aggregates on Product from the Review table"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        # One grouped query over reviews
+        rows = Review.objects.values('product_id').annotate(
+            rating_sum=Sum('rating'),
+            rating_count=Count('id'),
+            **{f'rating_count_{i}': Count('id', filter=Q(rating=i)) for i in range(1, 6)},
+        )
+        aggregates = {row.pop('product_id'): row for row in rows}
+        empty = {field: 0 for field in RATING_FIELDS}
+
+        self.stdout.write("⭐ Rebuilding rating aggregates...")
+        updated = 0
+        with transaction.atomic():
+            batch = []
+            for product in Product.objects.only('id', *RATING_FIELDS).order_by('id').iterator(chunk_size=batch_size):
+                values = aggregates.get(product.id, empty)
+                if all(getattr(product, f) == values[f] for f in RATING_FIELDS):
+                    continue
+                for field in RATING_FIELDS:
+                    setattr(product, field, values[field])
+                batch.append(product)
+                if len(batch) >= batch_size:
+                    Product.objects.bulk_update(batch, RATING_FIELDS)
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                Product.objects.bulk_update(batch, RATING_FIELDS)
+                updated += len(batch)
+
+        self.stdout.write(f"✅ Rating aggregates rebuilt ({updated} product(s) changed)")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+
+from products.models import Product
+from products.utils import update_search_vector
+
+
+class Command(BaseCommand):
+    help = "Rebuilds Product.search_vector (weighted name/description) in id-range batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        bounds = Product.objects.aggregate(lo=Min('id'), hi=Max('id'))
+        if bounds['lo'] is None:
+            self.stdout.write("No products to index.")
+            return
+
+        self.stdout.write("🔎 Rebuilding product search vectors...")
+        updated = 0
+        # Each batch is its own short UPDATE so we never hold locks on the whole table
+        for start in range(bounds['lo'], bounds['hi'] + 1, batch_size):
+            updated += update_search_vector(
+                Product.objects.filter(id__gte=start, id__lt=start + batch_size)
+            )
+
+        self.stdout.write(f"✅ Search vectors rebuilt for {updated} product(s)")
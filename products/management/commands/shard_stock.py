@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products.models import Product
+from products.shards import MAX_SHARDS, rebalance_all, set_shard_count
+
+
+class Command(BaseCommand):
+    help = "Splits a product's stock across counter shards (flash sales), or rebalances the shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_id', nargs='?', type=int)
+        parser.add_argument('--shards', type=int, help=f"Shard count, 0 to turn sharding off (max {MAX_SHARDS})")
+        parser.add_argument('--rebalance', action='store_true', help="Even out every sharded product")
+
+    def handle(self, *args, **options):
+        if options['rebalance']:
+            drifted = rebalance_all()
+            for product_id, drift in drifted.items():
+                self.stdout.write(f"⚠️ Product {product_id} was off by {drift:+d}")
+            self.stdout.write("✅ Stock shards rebalanced")
+            return
+
+        if options['product_id'] is None or options['shards'] is None:
+            raise CommandError("Give a product id and --shards, or --rebalance")
+        if not Product.objects.filter(id=options['product_id']).exists():
+            raise CommandError(f"No product {options['product_id']}")
+
+        set_shard_count(options['product_id'], options['shards'])
+        count = Product.objects.values_list('stock_shards', flat=True).get(id=options['product_id'])
+        self.stdout.write(f"✅ Product {options['product_id']} now uses {count or 'no'} stock shard(s)")
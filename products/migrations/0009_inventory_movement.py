@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-18 00:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_order_reserved_until'),
+        ('products', '0008_product_affinity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventoryMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('reserve', 'Reserve'), ('confirm', 'Confirm'), ('release', 'Release'), ('expire', 'Expire'), ('adjust', 'Admin adjustment')], max_length=20)),
+                ('stock_delta', models.BigIntegerField(default=0)),
+                ('allocated_delta', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('compacted', models.BooleanField(default=False)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='inventory_movements', to='orders.order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='products.product')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('compacted', False)), fields=['product'], name='movement_pending')],
+            },
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_stock_shards'),
+    ]
+
+    # search_products() falls back to trigram similarity; existing databases
+    # had the extension created by hand
+    operations = [
+        TrigramExtension(),
+    ]
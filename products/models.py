@@ -1,7 +1,7 @@
 from django.db import models
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
-from django.db.models import Avg, Q, F  # added Q, F for constraints
+from django.db.models import Q, F, Sum  # added Q, F for constraints
 from django.conf import settings
 
 
@@ -20,12 +20,29 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     image = models.ImageField(upload_to='product_images/')
+    # {'hash', 'source', 'widths'} for the resized variants (see products.images)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
     stock = models.PositiveBigIntegerField(default=0)      # on-hand
     allocated = models.PositiveBigIntegerField(default=0)  # reserved for unpaid orders (NEW)
+    # > 0: sellable units are split across this many StockShard rows (flash
+    # sales); change it with products.shards.set_shard_count()
+    stock_shards = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    # Denormalized review aggregates, kept in sync by products.signals
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_count_1 = models.PositiveIntegerField(default=0)
+    rating_count_2 = models.PositiveIntegerField(default=0)
+    rating_count_3 = models.PositiveIntegerField(default=0)
+    rating_count_4 = models.PositiveIntegerField(default=0)
+    rating_count_5 = models.PositiveIntegerField(default=0)
 
     search_vector = SearchVectorField(null=True, editable=False)
 
+    # Cheap page version for conditional GET; queryset.update() callers set it explicitly
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
     def __str__(self):
         return self.name
 
@@ -43,11 +60,33 @@ class Product(models.Model):
 
     @property
     def available(self):
-        # Inventory that can still be sold now
+        # Inventory that can still be sold now. stock/allocated are snapshots;
+        # querysets from products.ledger.with_live_stock() add the ledger
+        # movements not compacted yet.
+        if hasattr(self, 'live_available'):
+            return int(self.live_available)
+        if self.stock_shards:
+            # The shards always add up to the live count (products.shards);
+            # summed once per instance, like the annotation it stands in for
+            if not hasattr(self, '_shard_available'):
+                self._shard_available = int(self.shards.aggregate(total=Sum('available'))['total'] or 0)
+            return self._shard_available
         return int(self.stock) - int(self.allocated)
 
     def average_rating(self):
-        return self.reviews.aggregate(avg=Avg('rating'))['avg'] or 0
+        # Read from the stored aggregates; no query against reviews
+        if not self.rating_count:
+            return 0
+        return self.rating_sum / self.rating_count
+
+    @property
+    def review_count(self):
+        return self.rating_count
+
+    @property
+    def rating_histogram(self):
+        # {1: n, 2: n, ..., 5: n}
+        return {i: getattr(self, f'rating_count_{i}') for i in range(1, 6)}
 
     def is_in_stock(self):
         # use available instead of raw stock
@@ -60,6 +99,7 @@ class Review(models.Model):
     rating = models.IntegerField(choices=[(i, str(i)) for i in range(1, 6)])
     comment = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('product', 'user')  # One review per user per product
@@ -67,3 +107,83 @@ class Review(models.Model):
 
     def __str__(self):
         return f"Review for {self.product.name} by {self.user.username}"
+
+
+class ProductAffinity(models.Model):
+    """
+    "Frequently bought together": how many finalized orders contained both
+    product and related. Only the strongest pairs per product are kept
+    (see products.affinity); rebuilt/updated by a batch job, never live.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='affinities')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'Product affinities'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'related'], name='product_affinity_unique_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['product', '-count'], name='product_affinity_top'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} ({self.count})"
+
+
+class InventoryMovement(models.Model):
+    """
+    Append-only stock ledger written by the order workflow and admin stock
+    edits. Product.stock and allocated are snapshots; movements not yet
+    folded in by the compactor (compacted=False) are added on read. See
+    products.ledger.
+    """
+    RESERVE = 'reserve'
+    CONFIRM = 'confirm'
+    RELEASE = 'release'
+    EXPIRE = 'expire'
+    ADJUST = 'adjust'
+    REASON_CHOICES = [
+        (RESERVE, 'Reserve'),
+        (CONFIRM, 'Confirm'),
+        (RELEASE, 'Release'),
+        (EXPIRE, 'Expire'),
+        (ADJUST, 'Admin adjustment'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='movements')
+    order = models.ForeignKey(
+        'orders.Order', on_delete=models.SET_NULL, null=True, blank=True, related_name='inventory_movements'
+    )
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    stock_delta = models.BigIntegerField(default=0)
+    allocated_delta = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    compacted = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Pending deltas per product, read with every live stock check
+            models.Index(fields=['product'], name='movement_pending', condition=Q(compacted=False)),
+        ]
+
+    def __str__(self):
+        return f"{self.reason} {self.product_id}: stock {self.stock_delta:+d}, allocated {self.allocated_delta:+d}"
+
+
+class StockShard(models.Model):
+    """One slice of a sharded product's sellable units; see products.shards."""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='shards')
+    shard = models.PositiveSmallIntegerField()
+    available = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='stock_shard_unique'),
+            models.CheckConstraint(check=Q(available__gte=0), name='stock_shard_available_gte_0'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}#{self.shard}: {self.available}"
@@ -0,0 +1,199 @@
+"""
+Catalog pagination helpers.
+
+KeysetPaginator: opaque cursor ("seek") pagination. Each page is fetched with
+a WHERE on the sort keys of the last/first row seen instead of OFFSET, so any
+page costs the same and no COUNT(*) is needed. The sort keys are read from
+the queryset's own order_by, which must end in a unique tie-breaker (id).
+
+EstimatedCountPaginator: classic page numbers, but the total comes from the
+planner's row estimate for large result sets instead of COUNT(*).
+"""
+
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_cursor(values, direction):
+    raw = json.dumps({'v': values, 'd': direction}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (values, direction) or (None, NEXT) for a missing/garbled cursor."""
+    if not cursor:
+        return None, NEXT
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        values, direction = data['v'], data['d']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None, NEXT
+    if not isinstance(values, list) or direction not in (NEXT, PREVIOUS):
+        return None, NEXT
+    return values, direction
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def state(self):
+        """Navigation state without the rows (plain data, safe to cache)."""
+        return {
+            'has_next': self.has_next,
+            'has_previous': self.has_previous,
+            'next_cursor': self.next_cursor,
+            'previous_cursor': self.previous_cursor,
+        }
+
+
+class KeysetPaginator:
+    def __init__(self, queryset, per_page):
+        ordering = [str(key) for key in queryset.query.order_by]
+        if not ordering or ordering[-1].lstrip('-') not in ('id', 'pk'):
+            raise ValueError("KeysetPaginator needs an ordering that ends with a unique 'id' tie-breaker")
+        self.queryset = queryset
+        self.per_page = per_page
+        # [(field, descending), ...]
+        self.keys = [(key.lstrip('-'), key.startswith('-')) for key in ordering]
+
+    def _seek_filter(self, values, direction):
+        # (k1, k2, k3) "after" (v1, v2, v3) with per-key directions:
+        #   k1 > v1 OR (k1 = v1 AND k2 > v2) OR (k1 = v1 AND k2 = v2 AND k3 > v3)
+        condition = Q()
+        equal_prefix = {}
+        for (field, descending), value in zip(self.keys, values):
+            forward = descending if direction == NEXT else not descending
+            lookup = f"{field}__{'lt' if forward else 'gt'}"
+            condition |= Q(**equal_prefix, **{lookup: value})
+            equal_prefix[field] = value
+        return condition
+
+    def _key_field(self, name):
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        opts = self.queryset.model._meta
+        return opts.pk if name == 'pk' else opts.get_field(name)
+
+    def _clean_values(self, values):
+        """Cursor values converted for their key fields, or None if any doesn't fit."""
+        if len(values) != len(self.keys):
+            return None
+        cleaned = []
+        for (field, _), value in zip(self.keys, values):
+            if value is None or isinstance(value, (list, dict)):
+                return None
+            try:
+                cleaned.append(self._key_field(field).clean(value, None))
+            except (ValidationError, FieldDoesNotExist):
+                return None
+        return cleaned
+
+    def _cursor_for(self, obj, direction):
+        return encode_cursor([getattr(obj, field) for field, _ in self.keys], direction)
+
+    def get_page(self, cursor):
+        values, direction = decode_cursor(cursor)
+        if values is not None:
+            # A tampered cursor falls back to the first page instead of a DB error
+            values = self._clean_values(values)
+            if values is None:
+                direction = NEXT
+
+        queryset = self.queryset
+        if values is not None:
+            queryset = queryset.filter(self._seek_filter(values, direction))
+        if direction == PREVIOUS:
+            queryset = queryset.reverse()
+
+        # One extra row tells us whether there is another page in this direction
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if direction == PREVIOUS:
+            rows.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = values is not None, has_more
+
+        return KeysetPage(
+            rows,
+            has_next=has_next and bool(rows),
+            has_previous=has_previous and bool(rows),
+            next_cursor=self._cursor_for(rows[-1], NEXT) if rows else None,
+            previous_cursor=self._cursor_for(rows[0], PREVIOUS) if rows else None,
+        )
+
+
+def estimate_count(queryset, exact_below=1000):
+    """
+    Planner row estimate for queryset (EXPLAIN, no scan). Small results fall
+    back to an exact COUNT(*) since that is cheap and keeps the last page right.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    if estimate < exact_below:
+        return queryset.count()
+    return estimate
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
+
+
+class CachedPage(KeysetPage):
+    """A page rebuilt from cached rows + navigation state (either mode)."""
+
+    def __init__(self, object_list, state):
+        self.object_list = object_list
+        self.next_cursor = self.previous_cursor = None
+        self.__dict__.update(state)
+
+
+def numbered_page_state(page):
+    """Same as KeysetPage.state() for a regular django Page."""
+    return {
+        'has_next': page.has_next(),
+        'has_previous': page.has_previous(),
+        'number': page.number,
+        'next_page_number': page.number + 1 if page.has_next() else None,
+        'previous_page_number': page.number - 1 if page.has_previous() else None,
+        'page_range': [
+            n if isinstance(n, int) else str(n)
+            for n in page.paginator.get_elided_page_range(page.number)
+        ],
+    }
@@ -0,0 +1,172 @@
+"""
+Sharded stock counters for flash-sale products (Product.stock_shards > 0).
+
+A sharded product's sellable units (live stock - allocated) are split across
+StockShard rows. A reservation takes its units from one random shard locked
+with FOR UPDATE SKIP LOCKED, so concurrent checkouts of the same product
+land on different rows instead of queuing on the product's stock lock
+(products.ledger.lock_products skips sharded products). If no free shard has
+enough, it locks all of the product's shards and takes from several.
+
+The ledger movements are written as for any other product, so stock,
+allocated and the audit trail don't change meaning; the shards only decide
+who gets the units. Invariant: a product's shards add up to its live
+available. rebalance() restores that and evens the shards out.
+"""
+
+import random
+
+from django.db import connection, transaction
+from django.db.models.functions import Now
+
+from .cache import bump_product_versions
+from .ledger import LIVE_STOCK_SQL, lock_products
+from .models import Product, StockShard
+
+SHARD_TABLE = StockShard._meta.db_table
+MAX_SHARDS = 64
+
+TAKE_ONE_SQL = f"""
+    UPDATE {SHARD_TABLE} SET available = available - %(qty)s
+    WHERE id = (
+        SELECT id FROM {SHARD_TABLE}
+        WHERE product_id = %(product)s AND available >= %(qty)s
+        ORDER BY random() LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id
+"""
+
+
+def sharded(product_ids):
+    """{product_id: shard count} for the sharded products among product_ids."""
+    return dict(
+        Product.objects.filter(id__in=list(product_ids), stock_shards__gt=0)
+        .values_list('id', 'stock_shards')
+    )
+
+
+def _lock_shards(cursor, product_id):
+    cursor.execute(
+        f"SELECT id, available FROM {SHARD_TABLE} WHERE product_id = %s ORDER BY id FOR UPDATE",
+        [product_id],
+    )
+    return cursor.fetchall()
+
+
+def _set_available(cursor, rows):
+    """rows: [(shard id, available)]"""
+    if not rows:
+        return
+    values = ', '.join(['(%s::bigint, %s::bigint)'] * len(rows))
+    cursor.execute(f"""
+        UPDATE {SHARD_TABLE} s SET available = v.available
+        FROM (VALUES {values}) AS v(id, available)
+        WHERE s.id = v.id
+    """, [x for row in rows for x in row])
+
+
+def take(lines):
+    """
+    Takes {product_id: quantity} units from the shards of the sharded products
+    among lines. Returns the product ids that ran out. Lines of unsharded
+    products are left alone. Call inside a transaction.
+    """
+    counts = sharded(lines)
+    failed = []
+    with connection.cursor() as cursor:
+        # Product id order, so the blocking fallback can't deadlock
+        for product_id in sorted(counts):
+            qty = lines[product_id]
+            cursor.execute(TAKE_ONE_SQL, {'qty': qty, 'product': product_id})
+            if cursor.fetchone():
+                continue
+
+            # Every shard with enough is busy or none has enough on its own
+            rows = _lock_shards(cursor, product_id)
+            if sum(available for _, available in rows) < qty:
+                failed.append(product_id)
+                continue
+            updates, needed = [], qty
+            for shard_id, available in sorted(rows, key=lambda row: -row[1]):
+                used = min(available, needed)
+                updates.append((shard_id, available - used))
+                needed -= used
+                if not needed:
+                    break
+            _set_available(cursor, updates)
+    return failed
+
+
+def give(lines):
+    """Returns {product_id: quantity} units to a random shard of each sharded product."""
+    counts = sharded(lines)
+    if not counts:
+        return
+    rows = [(product_id, random.randrange(counts[product_id]), lines[product_id]) for product_id in sorted(counts)]
+    values = ', '.join(['(%s::bigint, %s::integer, %s::bigint)'] * len(rows))
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {SHARD_TABLE} s SET available = s.available + v.qty
+            FROM (VALUES {values}) AS v(product_id, shard, qty)
+            WHERE s.product_id = v.product_id AND s.shard = v.shard
+        """, [x for row in rows for x in row])
+
+
+def _live_available(cursor, product_id):
+    cursor.execute(f"SELECT stock - allocated FROM ({LIVE_STOCK_SQL}) live", [[product_id]])
+    row = cursor.fetchone()
+    return max(int(row[0]), 0) if row else 0
+
+
+def _split(total, count):
+    base, extra = divmod(total, count)
+    return [base + (1 if i < extra else 0) for i in range(count)]
+
+
+def lock(product_id):
+    """Locks all shards of a sharded product, holding off its reservations."""
+    with connection.cursor() as cursor:
+        _lock_shards(cursor, product_id)
+
+
+def rebalance(product_id):
+    """
+    Resets a sharded product's shards to an even split of its live available.
+    Returns the drift that was corrected (shard total - live available).
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        rows = _lock_shards(cursor, product_id)
+        if not rows:
+            return 0
+        # With every shard locked, no reservation of this product is in flight
+        live = _live_available(cursor, product_id)
+        drift = sum(available for _, available in rows) - live
+        _set_available(cursor, [(shard_id, share) for (shard_id, _), share in zip(rows, _split(live, len(rows)))])
+    return drift
+
+
+def rebalance_all():
+    """Rebalances every sharded product. Returns {product_id: drift} for the ones that had drifted."""
+    drifted = {}
+    for product_id in Product.objects.filter(stock_shards__gt=0).values_list('id', flat=True):
+        drift = rebalance(product_id)
+        if drift:
+            drifted[product_id] = drift
+    return drifted
+
+
+def set_shard_count(product_id, count):
+    """Turns sharding on (count > 0), changes the shard count, or turns it off (0)."""
+    count = max(0, min(int(count), MAX_SHARDS))
+    with transaction.atomic(), connection.cursor() as cursor:
+        lock_products([product_id])
+        _lock_shards(cursor, product_id)
+        live = _live_available(cursor, product_id)
+        StockShard.objects.filter(product_id=product_id).delete()
+        StockShard.objects.bulk_create([
+            StockShard(product_id=product_id, shard=i, available=share)
+            for i, share in enumerate(_split(live, count))
+        ] if count else [])
+        Product.objects.filter(id=product_id).update(stock_shards=count, updated_at=Now())
+        transaction.on_commit(lambda: bump_product_versions([product_id]))
@@ -0,0 +1,104 @@
+# products/signals.py
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Now
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Category, Product, Review
+from .utils import update_search_vector
+from .cache import bump_catalog_generation, bump_product_versions
+from .images import variants_ready
+from . import suggest
+
+
+def _apply_rating(product_id, rating, sign):
+    """
+    Add (sign=1) or remove (sign=-1) a single rating from the stored
+    aggregates on Product. One UPDATE, no read-modify-write.
+    """
+    Product.objects.filter(id=product_id).update(**{
+        'rating_sum': F('rating_sum') + sign * rating,
+        'rating_count': F('rating_count') + sign,
+        f'rating_count_{rating}': F(f'rating_count_{rating}') + sign,
+        'updated_at': Now(),
+    })
+    transaction.on_commit(lambda: bump_product_versions([product_id]))
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Review)
+def invalidate_listing_results(sender, **kwargs):
+    # After commit, so a recompute can't cache pre-commit data under the new generation
+    transaction.on_commit(bump_catalog_generation)
+
+
+@receiver(post_save, sender=Product)
+def invalidate_product_card(sender, instance: Product, **kwargs):
+    # After commit for the same reason as invalidate_listing_results
+    product_id = instance.id
+    transaction.on_commit(lambda: bump_product_versions([product_id]))
+
+
+@receiver(post_save, sender=Product)
+def refresh_search_vector(sender, instance: Product, update_fields=None, raw=False, **kwargs):
+    # Skip saves that cannot change the indexed text (e.g. stock-only updates)
+    if raw or (update_fields is not None and not {'name', 'description'} & set(update_fields)):
+        return
+    update_search_vector(Product.objects.filter(id=instance.id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Category)
+def update_suggestions(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and 'name' not in update_fields):
+        return
+    kind = suggest.PRODUCT if sender is Product else suggest.CATEGORY
+    transaction.on_commit(lambda: suggest.record_change('add', kind, instance.id, instance.name))
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Category)
+def remove_suggestions(sender, instance, **kwargs):
+    kind = suggest.PRODUCT if sender is Product else suggest.CATEGORY
+    obj_id = instance.id
+    transaction.on_commit(lambda: suggest.record_change('remove', kind, obj_id))
+
+
+@receiver(post_save, sender=Product)
+def queue_image_variants(sender, instance: Product, raw=False, **kwargs):
+    if raw or not instance.image or variants_ready(instance):
+        return
+    from .tasks import generate_image_variants_task
+    transaction.on_commit(lambda: generate_image_variants_task.delay(instance.id))
+
+
+@receiver(pre_save, sender=Review)
+def remember_previous_rating(sender, instance: Review, raw=False, **kwargs):
+    # Needed so an edit can move the old rating out of the aggregates
+    instance._previous_rating = None
+    if instance.pk and not raw:
+        instance._previous_rating = (
+            Review.objects.filter(pk=instance.pk).values_list('product_id', 'rating').first()
+        )
+
+
+@receiver(post_save, sender=Review)
+def update_rating_on_save(sender, instance: Review, created, raw=False, **kwargs):
+    # Fixtures carry their own Product aggregates (see rebuild_ratings)
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rating', None)
+    current = (instance.product_id, int(instance.rating))
+
+    if created or previous is None:
+        _apply_rating(*current, 1)
+    elif previous != current:
+        _apply_rating(*previous, -1)
+        _apply_rating(*current, 1)
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_on_delete(sender, instance: Review, **kwargs):
+    _apply_rating(instance.product_id, int(instance.rating), -1)
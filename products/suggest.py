@@ -0,0 +1,204 @@
+"""
+In-process prefix index for search-as-you-type suggestions.
+
+Every product/category name is indexed under each of its word starts
+("green apple" -> "green apple", "apple") in a sorted list per kind, so a
+lookup is a bisect plus a forward scan that stops at the limit; no database
+access.
+
+Keeping workers in sync: signals apply a change to the local index right
+away and append it to a small change feed in the shared cache (change first,
+then the sequence number). Other workers poll the feed's sequence number at most once per SYNC_INTERVAL and replay the
+changes they missed. If the feed expired under them, they rebuild from the
+database once.
+"""
+
+import bisect
+import threading
+import time
+import unicodedata
+
+from django.core.cache import cache
+
+SYNC_INTERVAL = 1.0
+CHANGE_TTL = 60 * 60
+MAX_REPLAY = 500
+# Shorter prefixes match most of the catalog
+MIN_PREFIX = 2
+
+SEQ_KEY = 'suggest:seq'
+
+PRODUCT = 'product'
+CATEGORY = 'category'
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.casefold().split())
+
+
+def _word_starts(name):
+    words = normalize(name).split(' ')
+    return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+class PrefixIndex:
+    def __init__(self):
+        self._keys = {PRODUCT: [], CATEGORY: []}  # kind -> sorted [(key, id)]
+        self._names = {}     # (kind, id) -> display name
+        self._entries = {}   # (kind, id) -> [keys...]
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, kind, obj_id, name):
+        self.remove(kind, obj_id)
+        item = (kind, obj_id)
+        self._names[item] = name
+        self._entries[item] = []
+        for key in _word_starts(name):
+            row = (key, obj_id)
+            bisect.insort(self._keys[kind], row)
+            self._entries[item].append(row)
+
+    def remove(self, kind, obj_id):
+        item = (kind, obj_id)
+        keys = self._keys[kind]
+        for row in self._entries.pop(item, ()):
+            i = bisect.bisect_left(keys, row)
+            if i < len(keys) and keys[i] == row:
+                del keys[i]
+        self._names.pop(item, None)
+
+    def _scan(self, kind, prefix, limit):
+        """First limit distinct (id, name) of kind under prefix; stops at the limit."""
+        keys = self._keys[kind]
+        found, seen = [], set()
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and len(found) < limit:
+            key, obj_id = keys[i]
+            if not key.startswith(prefix):
+                break
+            i += 1
+            if obj_id not in seen:
+                seen.add(obj_id)
+                found.append((obj_id, self._names[(kind, obj_id)]))
+        return found
+
+    def search(self, prefix, limit=8):
+        """Returns {'products': [(id, name)], 'categories': [(id, name)]}."""
+        prefix = normalize(prefix)
+        if len(prefix) < MIN_PREFIX:
+            return {'products': [], 'categories': []}
+        return {
+            'products': self._scan(PRODUCT, prefix, limit),
+            'categories': self._scan(CATEGORY, prefix, limit),
+        }
+
+
+_index = None
+_index_seq = 0
+_last_sync = 0.0
+_lock = threading.Lock()
+
+
+def _build():
+    from .models import Category, Product
+
+    index = PrefixIndex()
+    for obj_id, name in Product.objects.values_list('id', 'name').iterator():
+        index.add(PRODUCT, obj_id, name)
+    for obj_id, name in Category.objects.values_list('id', 'name'):
+        index.add(CATEGORY, obj_id, name)
+    return index
+
+
+def _change_key(seq):
+    return f'suggest:change:{seq}'
+
+
+def _current_seq():
+    seq = cache.get(SEQ_KEY)
+    if seq is None:
+        # Start from the clock so an evicted counter never lands on slots
+        # still in the feed
+        cache.add(SEQ_KEY, time.time_ns() // 1000, timeout=None)
+        seq = cache.get(SEQ_KEY)
+    return seq
+
+
+def _sync():
+    """Bring the local index up to the shared change feed (called under _lock)."""
+    global _index, _index_seq, _last_sync
+
+    now = time.monotonic()
+    if _index is not None and now - _last_sync < SYNC_INTERVAL:
+        return
+    _last_sync = now
+
+    seq = _current_seq()
+    if _index is None or seq - _index_seq > MAX_REPLAY or seq < _index_seq:
+        _index_seq = seq
+        _index = _build()
+        return
+
+    if seq == _index_seq:
+        return
+
+    keys = [_change_key(n) for n in range(_index_seq + 1, seq + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) != len(keys):
+        # Part of the feed expired: start over
+        _index_seq = seq
+        _index = _build()
+        return
+    for key in keys:
+        _apply(_index, changes[key])
+    _index_seq = seq
+
+
+def _apply(index, change):
+    op, kind, obj_id, name = change
+    if op == 'add':
+        index.add(kind, obj_id, name)
+    else:
+        index.remove(kind, obj_id)
+
+
+def warm_index():
+    """Build the index now (worker startup) instead of on the first keystroke."""
+    with _lock:
+        _sync()
+
+
+def suggest(prefix, limit=8):
+    with _lock:
+        _sync()
+        return _index.search(prefix, limit)
+
+
+def record_change(op, kind, obj_id, name=''):
+    """Apply a change locally and publish it for the other workers."""
+    global _index_seq
+
+    change = (op, kind, obj_id, name)
+    # Write the change into the first free slot, then publish it: a reader
+    # that sees the new sequence number always finds every change up to it.
+    # Slots are claimed in order, so each increment covers a written one.
+    seq = _current_seq() + 1
+    while not cache.add(_change_key(seq), change, timeout=CHANGE_TTL):
+        seq += 1
+    try:
+        published = cache.incr(SEQ_KEY)
+    except ValueError:
+        # Counter evicted since we read it: restart it just below our slot
+        cache.add(SEQ_KEY, seq - 1, timeout=None)
+        published = cache.incr(SEQ_KEY)
+
+    with _lock:
+        if _index is not None:
+            _apply(_index, change)
+            # Already applied here; only skip ahead if nothing else is pending
+            if seq == published == _index_seq + 1:
+                _index_seq = seq
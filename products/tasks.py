@@ -0,0 +1,64 @@
+from celery import shared_task
+from django.db.models.functions import Now
+
+from .affinity import rebuild_affinity, update_affinity
+from .cache import bump_product_versions
+from .images import build_variants
+from .ledger import COMPACT_BATCH, compact
+from .models import Product
+from .shards import rebalance_all
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=30)
+def generate_image_variants_task(self, product_id):
+    try:
+        product = Product.objects.get(id=product_id)
+    except Product.DoesNotExist:
+        return
+    if not product.image:
+        return
+
+    try:
+        variants = build_variants(product)
+    except OSError as e:
+        # Missing/unreadable file: retry in case the upload is still landing
+        print(f"❌ Image variants failed for product {product_id}: {e}")
+        raise self.retry(exc=e)
+
+    # update() so this doesn't re-trigger the post_save hook
+    Product.objects.filter(id=product_id, image=product.image.name).update(image_variants=variants, updated_at=Now())
+    bump_product_versions([product_id])
+    print(f"✅ Image variants ready for product {product_id} ({variants['hash']})")
+
+
+@shared_task
+def update_affinity_task():
+    processed = update_affinity()
+    if processed:
+        print(f"✅ Frequently-bought-together updated from {processed} order(s)")
+
+
+@shared_task
+def rebuild_affinity_task():
+    pairs = rebuild_affinity()
+    print(f"✅ Frequently-bought-together rebuilt ({pairs} pairs)")
+
+
+@shared_task
+def compact_inventory_task(max_batches=20):
+    products = movements = 0
+    for _ in range(max_batches):
+        folded, count = compact()
+        products += folded
+        movements += count
+        if folded < COMPACT_BATCH:
+            break
+    if movements:
+        print(f"✅ Compacted {movements} inventory movement(s) into {products} product(s)")
+
+
+@shared_task
+def rebalance_stock_shards_task():
+    drifted = rebalance_all()
+    for product_id, drift in drifted.items():
+        print(f"❌ Stock shards of product {product_id} were off by {drift:+d}; reset")
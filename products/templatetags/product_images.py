@@ -0,0 +1,30 @@
+from django import template
+
+from products import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def variant_url(product, name, fmt='jpeg'):
+    return images.variant_url(product, name, fmt)
+
+
+@register.simple_tag
+def variant_srcset(product, fmt='jpeg'):
+    return images.variant_srcset(product, fmt)
+
+
+@register.inclusion_tag('products/_picture.html')
+def product_picture(product, variant='card', css_class='', sizes='100vw', style=''):
+    """<picture> with WebP + JPEG srcsets; plain <img> until variants exist."""
+    return {
+        'product': product,
+        'ready': images.variants_ready(product),
+        'src': images.variant_url(product, variant),
+        'webp_srcset': images.variant_srcset(product, 'webp'),
+        'jpeg_srcset': images.variant_srcset(product, 'jpeg'),
+        'css_class': css_class,
+        'sizes': sizes,
+        'style': style,
+    }
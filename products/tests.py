@@ -1,3 +1,478 @@
-from django.test import TestCase
+import hashlib
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .affinity import frequently_bought_with, rebuild_affinity, update_affinity
+from .cache import (
+    bump_catalog_generation, card_cache_stats, get_cached_result, get_product_versions,
+    render_product_cards, result_cache_stats,
+)
+from .facets import catalog_facets
+from .images import VARIANT_FORMATS, VARIANT_WIDTHS, build_variants, variant_path, variant_srcset, variants_ready
+from .ledger import adjust_stock, live_stock, set_stock
+from .models import Category, InventoryMovement, Product, ProductAffinity, Review
+from .pagination import NEXT, EstimatedCountPaginator, KeysetPaginator, encode_cursor, estimate_count
+from .utils import search_products
+from . import suggest
+
+User = get_user_model()
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConditionalPageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def test_unchanged_listing_is_not_modified(self):
+        url = reverse('products:product_list')
+        etag = self.get(url)['ETag']
+        self.assertEqual(self.get(url, etag).status_code, 304)
+
+    def test_product_save_and_stock_movement_change_the_etag(self):
+        url = reverse('products:product_list')
+        with self.captureOnCommitCallbacks(execute=True):
+            etag = self.get(url)['ETag']
+            self.lamp.name = 'Desk lamp'
+            self.lamp.save()
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(adjust_stock(self.lamp.id, -1))
+        self.assertEqual(self.get(url, etag).status_code, 200)
+
+        detail = reverse('products:product_detail', args=[self.lamp.id])
+        etag = self.get(detail)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            adjust_stock(self.lamp.id, -1)
+        self.assertEqual(self.get(detail, etag).status_code, 200)
+
+    def test_public_pages_carry_no_csrf_token(self):
+        for url in (reverse('products:product_list'), reverse('products:product_detail', args=[self.lamp.id])):
+            response = self.get(url)
+            self.assertIn('public', response['Cache-Control'])
+            self.assertNotIn('csrftoken', response.cookies)
+            self.assertNotRegex(response.content.decode(), r'csrfmiddlewaretoken" value="[^"]')
+
+    def test_logged_in_pages_stay_private_with_a_token(self):
+        user = User.objects.create_user('shopper', email='shopper@example.com', password='pw')
+        self.client.force_login(user)
+        response = self.get(reverse('products:product_list'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertContains(response, 'name="csrfmiddlewaretoken" value="')
+        self.assertIn('csrftoken', response.cookies)
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create(
+            Product(name=f'Item {i}', description='', price=Decimal(i % 3 + 1), stock=1) for i in range(7)
+        )
+
+    def setUp(self):
+        self.paginator = KeysetPaginator(Product.objects.order_by('price', 'id'), 3)
+
+    def test_cursors_round_trip(self):
+        seen = []
+        page = self.paginator.get_page(None)
+        while True:
+            seen += [p.id for p in page]
+            if not page.has_next:
+                break
+            page = self.paginator.get_page(page.next_cursor)
+        self.assertEqual(seen, list(Product.objects.order_by('price', 'id').values_list('id', flat=True)))
+
+        previous = self.paginator.get_page(page.previous_cursor)
+        self.assertEqual([p.id for p in previous], seen[-len(page) - 3:-len(page)])
+        self.assertTrue(previous.has_next)
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        first = [p.id for p in self.paginator.get_page(None)]
+        for values in (['x', 'y', 'z'], ['x', 'y'], [None, 1], [[1], 1], ['1.00', 2 ** 70]):
+            with self.subTest(values=values):
+                page = self.paginator.get_page(encode_cursor(values, NEXT))
+                self.assertEqual([p.id for p in page], first)
+                self.assertFalse(page.has_previous)
+        self.assertEqual([p.id for p in self.paginator.get_page('not base64!')], first)
+
+    def test_estimated_count(self):
+        products = Product.objects.order_by('id')
+        # Small results are counted exactly
+        self.assertEqual(estimate_count(products), 7)
+        # Large ones use the planner's estimate, whatever it is, without a COUNT
+        with CaptureQueriesContext(connection) as queries:
+            estimate_count(products, exact_below=0)
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('EXPLAIN'))
+
+        page = EstimatedCountPaginator(products, 3).get_page(3)
+        self.assertEqual((page.paginator.num_pages, len(page)), (3, 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RatingAggregateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+        cls.users = [
+            User.objects.create_user(f'reviewer{i}', email=f'reviewer{i}@example.com', password='pw')
+            for i in range(2)
+        ]
+
+    def aggregates(self):
+        self.lamp.refresh_from_db()
+        return self.lamp.rating_count, self.lamp.rating_sum, self.lamp.rating_histogram
+
+    def test_reviews_update_the_stored_aggregates(self):
+        first = Review.objects.create(product=self.lamp, user=self.users[0], rating=5)
+        Review.objects.create(product=self.lamp, user=self.users[1], rating=3)
+        self.assertEqual(self.aggregates(), (2, 8, {1: 0, 2: 0, 3: 1, 4: 0, 5: 1}))
+        self.assertEqual(self.lamp.average_rating(), 4)
+
+        first.rating = 2
+        first.save()
+        self.assertEqual(self.aggregates(), (2, 5, {1: 0, 2: 1, 3: 1, 4: 0, 5: 0}))
+
+        first.delete()
+        self.assertEqual(self.aggregates(), (1, 3, {1: 0, 2: 0, 3: 1, 4: 0, 5: 0}))
+
+    def test_rating_change_bumps_the_card_after_commit(self):
+        version = get_product_versions([self.lamp.id])[self.lamp.id]
+        with self.captureOnCommitCallbacks() as callbacks:
+            Review.objects.create(product=self.lamp, user=self.users[0], rating=4)
+            self.assertEqual(get_product_versions([self.lamp.id])[self.lamp.id], version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(get_product_versions([self.lamp.id])[self.lamp.id], version)
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamp = Product.objects.create(name='Desk lamp', description='Warm light', price=Decimal('5.00'))
+        cls.bulb = Product.objects.create(name='Bulb', description='Fits any desk lamp', price=Decimal('2.00'))
+        cls.chair = Product.objects.create(name='Chair', description='Oak', price=Decimal('40.00'))
+
+    def test_name_matches_outrank_description_matches(self):
+        found = search_products(Product.objects.all(), 'lamp')
+        self.assertEqual([p.id for p in found], [self.lamp.id, self.bulb.id])
+
+    def test_search_vector_follows_renames(self):
+        self.chair.name = 'Rocking chair'
+        self.chair.save()
+        self.assertEqual([p.id for p in search_products(Product.objects.all(), 'rocking')], [self.chair.id])
+
+    def test_typos_fall_back_to_trigrams(self):
+        self.assertEqual([p.id for p in search_products(Product.objects.all(), 'chairr')], [self.chair.id])
+
+    def test_filters_apply_before_the_search_mode_is_chosen(self):
+        # Full-text hits outside the filters must not decide the mode
+        cheap = Product.objects.filter(price__lt=3)
+        self.assertEqual([p.id for p in search_products(cheap, 'lamp')], [self.bulb.id])
+        self.assertEqual([p.id for p in search_products(Product.objects.filter(price__gt=10), 'lamp')], [])
+        self.assertEqual([p.id for p in search_products(Product.objects.filter(price__gt=10), 'chairr')], [self.chair.id])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ProductCardCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+        cls.desk = Product.objects.create(name='Desk', description='', price=Decimal('50.00'), stock=2)
+
+    def setUp(self):
+        cache.clear()
+        self.request = RequestFactory().get('/')
+
+    def render(self):
+        return render_product_cards(self.request, Product.objects.filter(id__in=[self.lamp.id, self.desk.id]).order_by('id'))
+
+    def test_cards_are_cached_until_their_product_changes(self):
+        first = self.render()
+        self.assertEqual(card_cache_stats(), {'hits': 0, 'misses': 2})
+        self.assertEqual(self.render(), first)
+        self.assertEqual(card_cache_stats(), {'hits': 2, 'misses': 2})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lamp.name = 'Desk lamp'
+            self.lamp.save()
+        cards = self.render()
+        self.assertEqual(card_cache_stats(), {'hits': 3, 'misses': 3})
+        self.assertIn('Desk lamp', cards[0])
+        self.assertEqual(cards[1], first[1])
+
+    def test_cached_cards_get_the_request_token(self):
+        self.render()
+        token = get_token(self.request)
+        self.assertTrue(all(token in card for card in self.render()))
+
+        other = RequestFactory().get('/')
+        other.shared_page = True
+        cards = render_product_cards(other, Product.objects.filter(id=self.lamp.id))
+        self.assertIn('name="csrfmiddlewaretoken" value=""', cards[0])
+        self.assertNotIn('CSRF_COOKIE_NEEDS_UPDATE', other.META)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ResultCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return {'ids': [self.calls]}
+
+    def test_results_are_cached_per_generation(self):
+        params = {'q': 'lamp'}
+        self.assertEqual(get_cached_result(params, self.compute), {'ids': [1]})
+        self.assertEqual(get_cached_result(dict(params), self.compute), {'ids': [1]})
+        bump_catalog_generation()
+        self.assertEqual(get_cached_result(params, self.compute), {'ids': [2]})
+        self.assertEqual(result_cache_stats(), {'hits': 1, 'misses': 2, 'stale': 0})
+
+    def test_stale_entry_is_served_while_another_worker_recomputes(self):
+        params = {'q': 'lamp'}
+        get_cached_result(params, self.compute)
+        bump_catalog_generation()
+        key = f"catalog:result:{hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()}"
+        cache.add(f'{key}:lock', 1)
+        self.assertEqual(get_cached_result(params, self.compute), {'ids': [1]})
+        self.assertEqual((self.calls, result_cache_stats()['stale']), (1, 1))
+
+    def test_equivalent_listing_requests_share_a_result(self):
+        Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=4)
+        url = reverse('products:product_list')
+        self.client.get(url, {'q': '  lamp ', 'min_price': '1', 'sort': 'bogus'})
+        self.client.get(url, {'q': 'lamp', 'min_price': '1.0'})
+        # One listing miss and one hit; each request also reads the facets
+        self.assertEqual(result_cache_stats()['hits'], 2)
+
+
+class FacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamps = Category.objects.create(name='Lamps')
+        cls.desks = Category.objects.create(name='Desks')
+        cls.small_lamp = Product.objects.create(name='Small lamp', description='', price=Decimal('100.00'), stock=1, category=cls.lamps)
+        Product.objects.create(name='Floor lamp', description='', price=Decimal('700.00'), stock=2, category=cls.lamps)
+        Product.objects.create(name='Side desk', description='', price=Decimal('700.00'), stock=2, category=cls.desks)
+        Product.objects.create(name='Oak desk', description='', price=Decimal('6000.00'), stock=1, category=cls.desks)
+        Product.objects.create(name='Bulb', description='', price=Decimal('200.00'), stock=3)
+        # Sold out through the ledger, not yet compacted into the snapshot
+        adjust_stock(cls.small_lamp.id, -1)
+
+    def counts(self, **filters):
+        facets = catalog_facets(Product.objects.all(), **filters)
+        return facets['categories'], [bucket['count'] for bucket in facets['price_buckets']], facets['in_stock']
+
+    def test_unfiltered_counts(self):
+        self.assertEqual(self.counts(), ({self.lamps.id: 2, self.desks.id: 2}, [2, 2, 0, 1], 4))
+
+    def test_each_facet_ignores_its_own_filter(self):
+        # Categories honour the price, buckets the category, in-stock both
+        self.assertEqual(
+            self.counts(category_id=self.lamps.id, max_price=800),
+            ({self.lamps.id: 2, self.desks.id: 1}, [1, 1, 0, 0], 1),
+        )
+        self.assertEqual(
+            self.counts(category_id=self.desks.id, min_price=500),
+            ({self.lamps.id: 1, self.desks.id: 2}, [0, 1, 0, 1], 2),
+        )
+
+
+class ImageVariantTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = override_settings(MEDIA_ROOT=media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_product(self, size):
+        buffer = BytesIO()
+        Image.new('RGBA', size, (200, 40, 40, 128)).save(buffer, 'PNG')
+        return Product.objects.create(
+            name='Lamp', description='', price=Decimal('5.00'),
+            image=SimpleUploadedFile('lamp.png', buffer.getvalue(), content_type='image/png'),
+        )
+
+    def test_variants_are_resized_never_upscaled(self):
+        product = self.make_product((300, 200))
+        self.assertFalse(variants_ready(product))
+
+        product.image_variants = build_variants(product)
+        self.assertTrue(variants_ready(product))
+        self.assertEqual(product.image_variants['widths'], {'thumb': 160, 'card': 300, 'detail': 300})
+        for name in VARIANT_WIDTHS:
+            for fmt in VARIANT_FORMATS:
+                self.assertTrue(default_storage.exists(variant_path(product.image_variants['hash'], name, fmt)))
+        # card and detail came out the same width, so the srcset lists it once
+        self.assertEqual(len(variant_srcset(product).split(', ')), 2)
+
+    def test_same_bytes_map_to_the_same_variants(self):
+        first, second = self.make_product((500, 100)), self.make_product((500, 100))
+        self.assertEqual(build_variants(first)['hash'], build_variants(second)['hash'])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SuggestTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # A fresh index per test, synced on every call
+        patcher = mock.patch.multiple(suggest, _index=None, _index_seq=0, _last_sync=0.0, SYNC_INTERVAL=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def names(self, prefix):
+        return [name for _, name in suggest.suggest(prefix)['products']]
+
+    def test_prefixes_follow_renames_and_deletes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            apple = Product.objects.create(name='Green apple', description='', price=Decimal('1.00'))
+        self.assertEqual(self.names('app'), ['Green apple'])
+        self.assertEqual(self.names('GRE'), ['Green apple'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apple.name = 'Red pear'
+            apple.save()
+        self.assertEqual(self.names('app'), [])
+        self.assertEqual(self.names('pe'), ['Red pear'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apple.delete()
+        self.assertEqual(self.names('pe'), [])
+
+    def test_other_workers_replay_the_change_feed(self):
+        suggest.warm_index()
+        local = suggest._index
+        # Another worker's change: published to the feed only
+        with mock.patch.object(suggest, '_index', None):
+            suggest.record_change('add', suggest.PRODUCT, 1, 'Pear drops')
+        self.assertIs(suggest._index, local)
+        self.assertEqual(self.names('pear'), ['Pear drops'])
+        self.assertIs(suggest._index, local)   # replayed, not rebuilt
+
+    def test_changes_are_written_before_they_are_published(self):
+        published = []
+        incr = cache.incr
+
+        def checked_incr(key, *args, **kwargs):
+            # What a reader that saw the new sequence number would fetch
+            published.append(cache.get(suggest._change_key(cache.get(key) + 1)))
+            return incr(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'incr', side_effect=checked_incr):
+            suggest.record_change('add', suggest.PRODUCT, 1, 'Pear drops')
+        self.assertEqual(published, [('add', suggest.PRODUCT, 1, 'Pear drops')])
+
+    def test_short_prefixes_match_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(name='Apple', description='', price=Decimal('1.00'))
+        self.assertEqual(self.names('a'), [])
+
+
+class AffinityTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer', email='buyer@example.com', password='pw')
+        cls.lamp, cls.bulb, cls.shade, cls.desk = [
+            Product.objects.create(name=name, description='', price=Decimal('5.00'), stock=10)
+            for name in ('Lamp', 'Bulb', 'Shade', 'Desk')
+        ]
+
+    def finalized_order(self, *products):
+        from orders.models import Order, OrderItem
+
+        order = Order.objects.create(
+            user=self.user, total_price=0, address='x', phone='1', email='buyer@example.com',
+            inventory_finalized=True,
+        )
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, price=product.price, quantity=1) for product in products
+        )
+        return order
+
+    def test_pairs_are_counted_from_finalized_orders(self):
+        self.finalized_order(self.lamp, self.bulb)
+        self.finalized_order(self.lamp, self.bulb, self.shade)
+        self.finalized_order(self.bulb, self.shade, self.shade)   # a product twice counts once
+        # lamp-bulb 2, lamp-shade 1, bulb-shade 2, each stored both ways
+        self.assertEqual(rebuild_affinity(), 6)
+        self.assertEqual(frequently_bought_with(self.lamp), [self.bulb, self.shade])
+        self.assertEqual(frequently_bought_with(self.desk), [])
+
+        # New orders are folded in incrementally
+        self.finalized_order(self.lamp, self.shade)
+        self.finalized_order(self.lamp, self.shade, self.desk)
+        self.assertEqual(update_affinity(), 2)
+        self.assertEqual(frequently_bought_with(self.lamp), [self.shade, self.bulb, self.desk])
+        self.assertEqual(update_affinity(), 0)
+        self.assertEqual(
+            ProductAffinity.objects.get(product=self.shade, related=self.lamp).count, 3,
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class StockAdminTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.lamp = Product.objects.create(name='Lamp', description='', price=Decimal('5.00'), stock=5)
+        cls.admin = User.objects.create_superuser('admin', email='admin@example.com', password='pw')
+        adjust_stock(cls.lamp.id, -2)   # pending, the snapshot still says 5
+
+    def live(self):
+        return Product.objects.annotate(live=live_stock()).get(id=self.lamp.id).live
+
+    def test_forms_show_live_stock(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:products_product_change', args=[self.lamp.id]))
+        self.assertContains(response, 'name="stock" value="3"')
+        response = self.client.get(reverse('admin:products_product_changelist'))
+        self.assertContains(response, 'name="form-0-stock" value="3"')
+
+    def test_set_stock_is_sized_against_live_stock(self):
+        self.assertTrue(set_stock(self.lamp.id, 10))
+        self.assertEqual(self.live(), 10)
+        self.assertEqual(
+            list(InventoryMovement.objects.filter(product=self.lamp).values_list('stock_delta', flat=True).order_by('id')),
+            [-2, 7],
+        )
+        Product.objects.filter(id=self.lamp.id).update(allocated=4)
+        self.assertFalse(set_stock(self.lamp.id, 3))
+        self.assertEqual(self.live(), 10)
@@ -5,6 +5,7 @@ app_name = 'products'
 
 urlpatterns = [
     path('', views.product_list, name='product_list'),
+    path('suggest/', views.search_suggestions, name='search_suggestions'),
     path('<int:product_id>/', views.product_detail, name='product_detail'),
     path('<int:product_id>/add_review/', views.add_review, name='add_review'),
 ]
@@ -0,0 +1,43 @@
+from django.contrib.postgres.search import (
+    SearchQuery, SearchRank, SearchVector, TrigramSimilarity,
+)
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast, Greatest
+
+SEARCH_CONFIG = 'english'
+
+# Name matches outrank description matches
+PRODUCT_SEARCH_VECTOR = (
+    SearchVector('name', weight='A', config=SEARCH_CONFIG)
+    + SearchVector('description', weight='B', config=SEARCH_CONFIG)
+)
+
+
+def update_search_vector(queryset):
+    """Recompute search_vector for every row in queryset with a single UPDATE."""
+    return queryset.update(search_vector=PRODUCT_SEARCH_VECTOR)
+
+
+def search_products(products, query):
+    """
+    Full-text search over the GIN-indexed search_vector, ranked by SearchRank.
+    Falls back to trigram similarity only when the indexed match finds nothing
+    (typos, partial words). Pass products already narrowed by the listing's
+    filters: otherwise a full-text hit outside them would suppress the fallback.
+
+    Scores are cast to double precision so they survive a round trip through
+    a keyset pagination cursor unchanged.
+    """
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    matches = products.filter(search_vector=search_query)
+    if matches.exists():
+        return matches.annotate(
+            rank=Cast(SearchRank(F('search_vector'), search_query), FloatField())
+        ).order_by('-rank', '-id')  # tie-breaker for stability
+
+    return products.annotate(
+        similarity=Cast(Greatest(
+            TrigramSimilarity('name', query),
+            TrigramSimilarity('description', query)
+        ), FloatField())
+    ).filter(similarity__gt=0.2).order_by('-similarity', '-id')
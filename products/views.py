@@ -1,108 +1,246 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import JsonResponse
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from .models import Product, Category, Review
-from django.db.models import Q, Avg, Count
-from django.contrib.postgres.search import TrigramSimilarity
-from django.db.models.functions import Greatest
+from .models import Product, ProductAffinity, Category, Review
+from .utils import search_products
+from .cache import render_product_cards, get_cached_result, catalog_generation, card_generation, get_product_versions
+from core.utils.http import conditional_page
+from .facets import catalog_facets
+from .affinity import frequently_bought_with
+from .ledger import with_live_stock
+from . import suggest
+from django.db.models import Case, Count, ExpressionWrapper, F, FloatField, Max, OuterRef, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce
+from django.conf import settings
 from django.core.paginator import Paginator
+from .pagination import KeysetPaginator, EstimatedCountPaginator, CachedPage, numbered_page_state
 
 
-def product_list(request):
-    query = request.GET.get('q', '').strip()
+# Average rating computed from the stored aggregates on Product
+# (per-row arithmetic, no join/group-by over reviews)
+RATING_AVG = Case(
+    When(rating_count=0, then=Value(0.0)),
+    default=ExpressionWrapper(
+        Cast('rating_sum', FloatField()) / F('rating_count'),
+        output_field=FloatField(),
+    ),
+    output_field=FloatField(),
+)
+
+
+# Sort options (stable tie-breakers so pagination is deterministic)
+SORT_ORDERINGS = {
+    'price_asc': ('price', 'id'),
+    'price_desc': ('-price', 'id'),
+    'newest': ('-id',),
+    'name_asc': ('name', 'id'),
+    'name_desc': ('-name', 'id'),
+    # fall back to rating_count and id as tie-breakers
+    'rating_high_low': ('-rating_avg', '-rating_count', '-id'),
+    'rating_low_high': ('rating_avg', 'rating_count', 'id'),
+}
+
+PER_PAGE = 12
+
+# Facets include stock, which changes without a catalog generation bump
+FACETS_TIMEOUT = 60
+
+
+def _parse_price(value):
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def _catalog_params(request):
+    """
+    Canonical listing parameters: equivalent requests (whitespace in q,
+    '10' vs '10.0', unknown sorts) map to the same dict and so the same
+    result-cache key.
+    """
     category_id = request.GET.get('category')
     sort = request.GET.get('sort')
-    min_price = request.GET.get('min_price')
-    max_price = request.GET.get('max_price')
-    page = request.GET.get('page', 1)
+    mode = getattr(settings, 'CATALOG_PAGINATION_MODE', 'cursor')
+    return {
+        'q': ' '.join(request.GET.get('q', '').split()),
+        'category': int(category_id) if category_id and category_id.isdigit() else None,
+        'sort': sort if sort in SORT_ORDERINGS else None,
+        'min_price': _parse_price(request.GET.get('min_price')),
+        'max_price': _parse_price(request.GET.get('max_price')),
+        'mode': mode,
+        'cursor': (request.GET.get('cursor') or None) if mode != 'pages' else None,
+        'page': (request.GET.get('page') or None) if mode == 'pages' else None,
+    }
 
+
+def _searched_queryset(params):
     products = Product.objects.all()
-    categories = Category.objects.all()
+    if params['q']:
+        products = search_products(products, params['q'])
+    return products
 
-    if query:
-        products = products.annotate(
-            similarity=Greatest(
-                TrigramSimilarity('name', query),
-                TrigramSimilarity('description', query)
-            )
-        ).filter(similarity__gt=0.2).order_by('-similarity', '-id')  # tie-breaker for stability
 
-    if category_id and category_id.isdigit():
-        products = products.filter(category_id=int(category_id))
+def _catalog_queryset(params):
+    products = Product.objects.all()
 
-    if min_price:
-        try:
-            products = products.filter(price__gte=float(min_price))
-        except ValueError:
-            pass
+    if params['category'] is not None:
+        products = products.filter(category_id=params['category'])
 
-    if max_price:
-        try:
-            products = products.filter(price__lte=float(max_price))
-        except ValueError:
-            pass
-
-    # Annotate with average rating and review count
-    products = products.annotate(
-        average_rating=Avg('reviews__rating'),
-        review_count=Count('reviews')
-    )
+    if params['min_price'] is not None:
+        products = products.filter(price__gte=params['min_price'])
 
-    # Sort options (add stable tie-breakers so pagination is deterministic)
-    sorted_applied = False
-    if sort == 'price_asc':
-        products = products.order_by('price', 'id')
-        sorted_applied = True
-    elif sort == 'price_desc':
-        products = products.order_by('-price', 'id')
-        sorted_applied = True
-    elif sort == 'newest':
-        products = products.order_by('-id')
-        sorted_applied = True
-    elif sort == 'name_asc':
-        products = products.order_by('name', 'id')
-        sorted_applied = True
-    elif sort == 'name_desc':
-        products = products.order_by('-name', 'id')
-        sorted_applied = True
-    elif sort == 'rating_high_low':
-        # fall back to review_count and id as tie-breakers
-        products = products.order_by('-average_rating', '-review_count', '-id')
-        sorted_applied = True
-    elif sort == 'rating_low_high':
-        products = products.order_by('average_rating', 'review_count', 'id')
-        sorted_applied = True
-
-    # If no explicit sort was chosen and no similarity ordering was applied,
-    # default to a deterministic order to silence the warning.
-    if not sorted_applied and not query:
+    if params['max_price'] is not None:
+        products = products.filter(price__lte=params['max_price'])
+
+    # Filter first, so the full-text vs. trigram choice sees only these rows
+    if params['q']:
+        products = search_products(products, params['q'])
+
+    sort = params['sort']
+    if sort in ('rating_high_low', 'rating_low_high'):
+        products = products.annotate(rating_avg=RATING_AVG)
+    if sort:
+        products = products.order_by(*SORT_ORDERINGS[sort])
+    elif not params['q']:
+        # If no explicit sort was chosen and no similarity ordering was applied,
+        # default to a deterministic order to silence the warning.
         products = products.order_by('-id')
+    return products
+
+
+def _catalog_page(params):
+    """Ordered ids + navigation state for one listing page (cacheable)."""
+    products = _catalog_queryset(params)
+
+    # Pagination: cursor (keyset) by default, page numbers optional
+    if params['mode'] == 'pages':
+        page = EstimatedCountPaginator(products.only('id'), PER_PAGE).get_page(params['page'])
+        state = numbered_page_state(page)
+    else:
+        page = KeysetPaginator(products, PER_PAGE).get_page(params['cursor'])
+        state = page.state()
+    return {'ids': [p.id for p in page], 'page': state}
+
+
+def _catalog_facets(params):
+    return catalog_facets(
+        _searched_queryset(params),
+        category_id=params['category'],
+        min_price=params['min_price'],
+        max_price=params['max_price'],
+    )
+
+
+def _product_list_version(request):
+    latest = Product.objects.aggregate(latest=Max('updated_at'))['latest']
+    # ETag only: deletes and category edits move the catalog generation, and
+    # ledger movements (stock on the cards) the card generation, not a timestamp
+    return None, (
+        request.GET.urlencode(), latest and latest.timestamp(), catalog_generation(), card_generation(),
+    )
 
-    # Pagination
-    paginator = Paginator(products, 12)  # 12 products per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+
+@conditional_page(_product_list_version, public=True)
+def product_list(request):
+    params = _catalog_params(request)
+    result = get_cached_result(params, lambda: _catalog_page(params))
+
+    facet_params = {
+        'facets': True,
+        **{k: params[k] for k in ('q', 'category', 'min_price', 'max_price')},
+    }
+    facets = get_cached_result(facet_params, lambda: _catalog_facets(params), timeout=FACETS_TIMEOUT)
+    categories = list(Category.objects.all())
+    for category in categories:
+        category.product_count = facets['categories'].get(category.id, 0)
+
+    # Only the id list is cached; rows are always fresh
+    by_id = with_live_stock(Product.objects.all()).in_bulk(result['ids'])
+    page_obj = CachedPage([by_id[pid] for pid in result['ids'] if pid in by_id], result['page'])
 
     return render(request, 'products/product_list.html', {
         'products': page_obj,
         'page_obj': page_obj,
+        'cards': render_product_cards(request, page_obj),
+        'pagination_mode': params['mode'],
+        'page_ellipsis': str(Paginator.ELLIPSIS),
         'categories': categories,
-        'selected_category': category_id,
-        'selected_sort': sort,
-        'query': query,
-        'min_price': min_price,
-        'max_price': max_price,
+        'facets': facets,
+        'selected_category': request.GET.get('category'),
+        'selected_sort': request.GET.get('sort'),
+        'query': request.GET.get('q', '').strip(),
+        'min_price': request.GET.get('min_price'),
+        'max_price': request.GET.get('max_price'),
     })
 
 
+def search_suggestions(request):
+    """Search-as-you-type; answered from the in-process prefix index."""
+    query = request.GET.get('q', '')[:100]
+    if len(suggest.normalize(query)) < suggest.MIN_PREFIX:
+        return JsonResponse({'q': query, 'error': 'query too short'}, status=400)
+    matches = suggest.suggest(query)
+    return JsonResponse({
+        'q': query,
+        'products': [
+            {'id': pid, 'name': name, 'url': reverse('products:product_detail', args=[pid])}
+            for pid, name in matches['products']
+        ],
+        'categories': [
+            {'id': cid, 'name': name, 'url': f"{reverse('products:product_list')}?category={cid}"}
+            for cid, name in matches['categories']
+        ],
+    })
+
+
+def _per_product(model, aggregate):
+    """Scalar subquery: aggregate over model's rows of the outer product."""
+    return Subquery(
+        model.objects.filter(product=OuterRef('pk')).order_by()
+        .values('product').annotate(value=aggregate).values('value')
+    )
+
+
+def _product_detail_version(request, product_id):
+    # One subquery per relation: joining reviews and affinities together
+    # would aggregate over their cross product
+    row = (
+        Product.objects.filter(id=product_id)
+        .annotate(
+            reviews_updated=_per_product(Review, Max('updated_at')),
+            reviews_total=Coalesce(_per_product(Review, Count('id')), 0),
+            related_updated=_per_product(ProductAffinity, Max('updated_at')),
+        )
+        .values_list('updated_at', 'reviews_updated', 'reviews_total', 'related_updated')
+        .first()
+    )
+    if row is None:
+        return None  # let the view 404
+    updated, reviews_updated, reviews_total, related_updated = row
+    # ETag only: ledger movements change the stock shown here without a
+    # timestamp; they bump the product's card version instead
+    return None, (
+        updated.timestamp(),
+        reviews_updated and reviews_updated.timestamp(),
+        reviews_total,
+        related_updated and related_updated.timestamp(),
+        get_product_versions([product_id])[product_id],
+    )
+
+
+@conditional_page(_product_detail_version, public=True)
 def product_detail(request, product_id):
-    product = get_object_or_404(Product, id=product_id)
+    product = get_object_or_404(with_live_stock(Product.objects.all()), id=product_id)
     reviews = product.reviews.select_related('user').order_by('-created_at')
-    average_rating = product.reviews.aggregate(avg=Avg('rating'))['avg'] or 0
     return render(request, 'products/product_detail.html', {
         'product': product,
         'reviews': reviews,
-        'average_rating': average_rating
+        'average_rating': product.average_rating(),
+        'rating_histogram': sorted(product.rating_histogram.items(), reverse=True),
+        'frequently_bought': frequently_bought_with(product),
     })
 
 
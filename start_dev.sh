@@ -20,6 +20,14 @@ else
     echo "[✓] Celery worker is already running."
 fi
 
+# Start Celery beat (periodic jobs) in background
+if ! pgrep -f "celery -A photon_cure beat" > /dev/null; then
+    echo "[✓] Starting Celery beat in background..."
+    nohup celery -A photon_cure beat --loglevel=info > logs/celery_beat.log 2>&1 &
+else
+    echo "[✓] Celery beat is already running."
+fi
+
 # Create logs folder if it doesn't exist
 mkdir -p logs
 